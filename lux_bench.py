@@ -0,0 +1,675 @@
+"""Module for benchmarking searches, object details and the flask routes.
+
+Replays typing traces (the searches the frontend sends while a user types, one per
+keystroke) and object page views against a database, and reports latency percentiles,
+throughput and peak memory as JSON, so runs on different commits can be compared.
+The reload scenario replays the searches while a new snapshot of the database is
+published (see lux_snapshot.py). The startup scenario starts fresh interpreters
+that import the application and send its first requests, and checks their import
+time and time to the first successful request against STARTUP_BUDGET. Use lux_synth.py to generate databases of any size.
+"""
+
+import argparse
+import gc
+import http.client
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from contextlib import closing
+from urllib.parse import urlencode, urlsplit
+
+import lux_cache
+import lux_memory
+import lux_snapshot
+from lux_index import ensure_index
+from query import LuxQuery, LuxDetailsQuery, NoSearchResultsError
+
+SCENARIOS = ("search", "details", "route_search", "route_obj", "herd", "large", "reload",
+             "startup")
+
+# scenarios that can run against a server started separately (--url)
+HTTP_SCENARIOS = ("route_search", "route_obj")
+
+# fields a typing session types into, with how often users pick them
+FIELDS = (("l", 0.5), ("a", 0.25), ("c", 0.15), ("d", 0.1))
+
+# queries reading the values users type, by search field
+FIELD_VALUES = {
+    "l": "SELECT label FROM objects WHERE label IS NOT NULL ORDER BY random() LIMIT ?",
+    "a": "SELECT name FROM agents WHERE name IS NOT NULL ORDER BY random() LIMIT ?",
+    "c": "SELECT name FROM classifiers WHERE name IS NOT NULL ORDER BY random() LIMIT ?",
+    "d": "SELECT name FROM departments WHERE name IS NOT NULL ORDER BY random() LIMIT ?",
+}
+
+# object page views follow a Zipf distribution over this many sampled ids
+POPULAR_OBJECTS = 10000
+
+# search page size of the frontend (see static/script.js)
+FRONTEND_PAGE_SIZE = 100
+
+# single letters, whose searches return the full 1000 rows on large databases
+LARGE_TERMS = "aeinorst"
+
+# number of fresh interpreters the startup scenario starts
+STARTUP_RUNS = 5
+
+# startup budget in ms: the import of luxapp as reported by python -X importtime, and
+# the time from the start of that import until the first search, object page and
+# index page have been answered (medians of the runs)
+STARTUP_BUDGET = {"import_ms": 500, "ready_ms": 1000}
+
+# run by each interpreter of the startup scenario with the paths to request: starts
+# the application as a worker does (see runserver.load_app) and prints the times
+STARTUP_CODE = """
+import json, sys, time
+start = time.perf_counter()
+import luxapp
+times = {"import": time.perf_counter() - start}
+luxapp.precompile_templates()
+times["templates"] = time.perf_counter() - start - times["import"]
+client = luxapp.app.test_client()
+for path in sys.argv[1:]:
+    status = client.get(path).status_code
+    if status != 200:
+        sys.exit(f"{path} answered {status}")
+times["ready"] = time.perf_counter() - start
+print(json.dumps(times))
+"""
+
+
+def sample_values(db_file, count, seed):
+    """Returns values users may type into each search field, read from the database.
+
+    Args:
+        db_file (str): database file
+        count (int): number of values per field
+        seed (int): random seed
+    Return:
+        dict: lists of words keyed by field (l, a, c, d)
+    """
+
+    values = {}
+    with closing(sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)) as connection:
+        # make ORDER BY random() repeatable
+        rng = random.Random(seed)
+        connection.create_function("random", 0, lambda: rng.getrandbits(63), deterministic=False)
+        for field, smt_str in FIELD_VALUES.items():
+            words = set()
+            for (text,) in connection.execute(smt_str, [count]):
+                words.update(word for word in text.split() if len(word) >= 3)
+            values[field] = sorted(words)
+    return values
+
+
+def make_trace(values, sessions, seed):
+    """Builds a typing trace: the searches sent while users type words they look for.
+
+    Each session types one word letter by letter (with the occasional typo corrected
+    with backspace), sometimes followed by a second word in another field.
+
+    Args:
+        values (dict): words per field, see sample_values
+        sessions (int): number of typing sessions
+        seed (int): random seed
+    Return:
+        list: searches as dictionaries with the l, c, a, d arguments
+    """
+
+    rng = random.Random(seed)
+    fields = [field for field, _ in FIELDS if values.get(field)]
+    weights = [weight for field, weight in FIELDS if values.get(field)]
+    trace = []
+    for _ in range(sessions):
+        terms = {"l": "", "c": "", "a": "", "d": ""}
+        for field in dict.fromkeys(rng.choices(fields, weights, k=rng.choice((1, 1, 1, 2)))):
+            word = rng.choice(values[field])
+            typed = ""
+            for letter in word:
+                if rng.random() < 0.03:
+                    terms[field] = typed + rng.choice("etaoinshr")
+                    trace.append(dict(terms))
+                typed += letter
+                terms[field] = typed
+                trace.append(dict(terms))
+    return trace
+
+
+def popular_objects(db_file, count, seed):
+    """Returns object ids ordered from most to least viewed, for Zipf-distributed views."""
+
+    with closing(sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)) as connection:
+        ids = [row[0] for row in connection.execute("SELECT id FROM objects")]
+    rng = random.Random(seed)
+    return rng.sample(ids, min(count, len(ids)))
+
+
+def percentile(sorted_samples, fraction):
+    """Returns the nearest-rank percentile of already sorted samples."""
+
+    if not sorted_samples:
+        return None
+    rank = max(1, round(fraction * len(sorted_samples) + 0.5))
+    return sorted_samples[min(rank, len(sorted_samples)) - 1]
+
+
+def peak_rss_kib():
+    """Returns the peak resident set size of this process so far, in KiB."""
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB elsewhere
+    return peak // 1024 if sys.platform == "darwin" else peak
+
+
+def run_scenario(operation, requests, threads):
+    """Runs operation on every request, spread over threads, and measures it.
+
+    Args:
+        operation (function): called with one request, raises on failure
+        requests (list): requests to run, in order
+        threads (int): number of concurrent threads
+    Return:
+        dict: latency percentiles in ms, throughput, errors and peak RSS
+    """
+
+    latencies = []
+    errors = []
+    lock = threading.Lock()
+    position = iter(range(len(requests)))
+
+    def worker():
+        samples = []
+        failed = 0
+        while True:
+            with lock:
+                index = next(position, None)
+            if index is None:
+                break
+            start = time.perf_counter()
+            try:
+                operation(requests[index])
+            except Exception:  # pylint: disable=broad-exception-caught
+                failed += 1
+                continue
+            samples.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(samples)
+            errors.append(failed)
+
+    start = time.perf_counter()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    to_ms = lambda value: None if value is None else round(value * 1000, 3)
+    return {
+        "requests": len(requests),
+        "errors": sum(errors),
+        "threads": threads,
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "mean_ms": to_ms(sum(latencies) / len(latencies)) if latencies else None,
+        "p50_ms": to_ms(percentile(latencies, 0.50)),
+        "p95_ms": to_ms(percentile(latencies, 0.95)),
+        "p99_ms": to_ms(percentile(latencies, 0.99)),
+        "max_ms": to_ms(latencies[-1]) if latencies else None,
+        "peak_rss_kib": peak_rss_kib(),
+    }
+
+
+# keep-alive connection of each thread to the server benchmarked with --url
+_connections = threading.local()
+
+
+def http_get(url, path, params=None):
+    """Sends a GET to a running server over this thread's keep-alive connection.
+
+    Args:
+        url (str): base url of the server, e.g. http://localhost:8000
+        path (str): path of the request
+        params (dict): query string arguments
+    Return:
+        int: the response status
+    """
+
+    target = path + (f"?{urlencode(params)}" if params else "")
+    for attempt in range(2):
+        connection = getattr(_connections, "connection", None)
+        if connection is None:
+            parts = urlsplit(url)
+            connection = http.client.HTTPConnection(parts.hostname, parts.port or 80,
+                                                    timeout=60)
+            _connections.connection = connection
+        try:
+            connection.request("GET", target, headers={"Accept-Encoding": "gzip"})
+            response = connection.getresponse()
+            response.read()
+            return response.status
+        except (http.client.HTTPException, OSError):
+            # the server closed the keep-alive connection, retry once on a new one
+            connection.close()
+            _connections.connection = None
+            if attempt:
+                raise
+    return None
+
+
+def scenario_operations(db_file, url=None):
+    """Returns the function running one request of each scenario.
+
+    Args:
+        db_file (str): database file
+        url (str): base url of a running server to send the route scenarios to,
+            None to run them in this process with flask's test client
+    """
+
+    def search(terms):
+        LuxQuery(db_file).search(dep=terms["d"], agt=terms["a"],
+                                 classifier=terms["c"], label=terms["l"])
+
+    # the rows come from the result cache after the first search of each term,
+    # so these time turning 1000 rows into the JSON and html responses
+    def large_rows(terms):
+        return list(LuxQuery(db_file).iter_rows(dep=terms["d"], agt=terms["a"],
+                                                classifier=terms["c"], label=terms["l"]))
+
+    def large_convert(terms):
+        rows = large_rows(terms)
+        return LuxQuery(db_file).convert_to_dict(len(rows), rows)
+
+    def large_json(terms):
+        json.dumps(large_convert(terms))
+
+    def large_html(terms):
+        "".join(app_module().generate_table(large_rows(terms)))
+
+    def large(terms):
+        large_json(terms)
+        large_html(terms)
+
+    def details(obj_id):
+        try:
+            LuxDetailsQuery(db_file).search(obj_id)
+        except NoSearchResultsError:
+            pass
+
+    # the flask app is only imported when its routes are benchmarked
+    client = {}
+
+    def app_module():
+        if "app" not in client:
+            import luxapp  # pylint: disable=import-outside-toplevel
+            lux_snapshot.configure(path=db_file)
+            client["app"] = luxapp
+        return client["app"]
+
+    def test_client():
+        if "client" not in client:
+            client["client"] = app_module().app.test_client()
+        return client["client"]
+
+    def get(path, params=None):
+        if url is not None:
+            return http_get(url, path, params)
+        return test_client().get(path, query_string=params).status_code
+
+    def route_search(terms):
+        status = get("/search", dict(terms, page_size=FRONTEND_PAGE_SIZE))
+        if status != 200:
+            raise RuntimeError(f"/search returned {status}")
+
+    def route_obj(obj_id):
+        status = get(f"/obj/{obj_id}")
+        if status not in (200, 404):
+            raise RuntimeError(f"/obj returned {status}")
+
+    return {"search": search, "details": details,
+            "route_search": route_search, "route_obj": route_obj, "herd": search,
+            "large": large, "large_convert": large_convert, "large_html": large_html}
+
+
+def reload_operation(db_file, requests, directory):
+    """Returns the operation of the reload scenario: the searches of the search
+    scenario, sent to a snapshot of the database that is replaced by a copy of itself
+    a third of the way through, while the copy is prepared in the background.
+
+    Args:
+        db_file (str): database file
+        requests (int): number of searches of the scenario
+        directory (str): empty directory the snapshots are written to
+    """
+
+    link = os.path.join(directory, "lux.sqlite")
+    for name in ("a.sqlite", "b.sqlite"):
+        shutil.copy(db_file, os.path.join(directory, name))
+    os.symlink("a.sqlite", link)
+    lux_snapshot.configure(path=link, check_interval=0.1)
+    lux_snapshot.prepare(lux_snapshot.current_database())
+    sent = iter(range(requests))
+
+    def search(terms):
+        if next(sent, None) == requests // 3:
+            os.symlink("b.sqlite", link + ".new")
+            os.replace(link + ".new", link)
+        LuxQuery(lux_snapshot.current_database()).search(
+            agt=terms["a"], dep=terms["d"], classifier=terms["c"], label=terms["l"])
+
+    return search
+
+
+def import_times(importtime_output):
+    """Returns the cumulative import time of each module, in ms, from the output of
+    python -X importtime.
+    """
+
+    times = {}
+    for line in importtime_output.splitlines():
+        fields = line.split("|")
+        if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+            times[fields[2].strip()] = int(fields[1]) / 1000
+    return times
+
+
+def run_startup(db_file, paths, engine="sql", runs=STARTUP_RUNS, budget=None):
+    """Runs the startup scenario: starts fresh interpreters that import the
+    application and request the given paths, and measures how long that takes.
+
+    Args:
+        db_file (str): database file
+        paths (list): paths requested once the application is imported
+        engine (str): search engine, see lux_memory.py
+        runs (int): number of interpreters started one after the other
+        budget (dict): limits in ms of the medians, see STARTUP_BUDGET
+    Return:
+        dict: median and maximum times in ms, the slowest imports of the first run and
+        the budget metrics that were exceeded ("errors" if an interpreter failed)
+    """
+
+    budget = STARTUP_BUDGET if budget is None else budget
+    env = dict(os.environ, LUX_DATABASE=db_file, LUX_ENGINE=engine)
+    env.pop("LUX_SHARED_CACHE", None)
+    samples = {"import_ms": [], "templates_ms": [], "ready_ms": [], "process_ms": []}
+    slowest = None
+    for _ in range(runs):
+        start = time.perf_counter()
+        child = subprocess.run([sys.executable, "-X", "importtime", "-c", STARTUP_CODE]
+                               + list(paths), capture_output=True, text=True, env=env,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), check=False)
+        process_seconds = time.perf_counter() - start
+        if child.returncode != 0:
+            lines = child.stderr.strip().splitlines()
+            return {"runs": runs, "paths": list(paths), "budget": budget, "errors": 1,
+                    "error": lines[-1] if lines else f"exit status {child.returncode}",
+                    "over_budget": ["errors"]}
+        times = json.loads(child.stdout)
+        imports = import_times(child.stderr)
+        samples["import_ms"].append(imports.get("luxapp", times["import"] * 1000))
+        samples["templates_ms"].append(times["templates"] * 1000)
+        samples["ready_ms"].append(times["ready"] * 1000)
+        samples["process_ms"].append(process_seconds * 1000)
+        if slowest is None:
+            slowest = dict(sorted(imports.items(), key=lambda item: -item[1])[:10])
+
+    report = {"runs": runs, "paths": list(paths), "budget": budget, "errors": 0}
+    for metric, values in samples.items():
+        values.sort()
+        report[metric] = round(percentile(values, 0.50), 3)
+        report[metric.replace("_ms", "_max_ms")] = round(values[-1], 3)
+    report["slowest_imports_ms"] = slowest
+    report["over_budget"] = [metric for metric, limit in budget.items()
+                             if report[metric] > limit]
+    return report
+
+
+def allocated_kib(operation, request):
+    """Returns the peak memory allocated by one run of operation, in KiB, including
+    what it returns.
+    """
+
+    # a full collection empties the free lists, so every object made is traced
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = operation(request)
+        peak = tracemalloc.get_traced_memory()[1]
+        del result
+        return peak // 1024
+    finally:
+        tracemalloc.stop()
+
+
+def clear_caches(db_file):
+    """Empties the result caches, so every scenario starts cold."""
+
+    for kind in lux_cache.CACHE_KINDS:
+        lux_cache.get_cache(db_file, kind).clear()
+
+
+def git_commit():
+    """Returns the commit of the working tree, None outside a git checkout."""
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], check=True,
+                              capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(db_file, scenarios=SCENARIOS, sessions=200, views=2000, threads=1, seed=0,
+        skew=1.1, trace=None, cache=True, url=None, engine="sql", startup_budget=None):
+    """Runs the benchmark.
+
+    Args:
+        db_file (str): database file
+        scenarios (tuple): scenarios to run, see SCENARIOS
+        sessions (int): number of typing sessions in the generated trace
+        views (int): number of object page views
+        threads (int): number of concurrent threads
+        seed (int): random seed
+        skew (float): Zipf exponent of object page popularity
+        trace (list): searches to replay instead of a generated trace
+        cache (bool): False to disable the result caches
+        url (str): base url of a running server for the route scenarios, see
+            scenario_operations; the server's caches are not emptied between scenarios
+        engine (str): search engine, see lux_memory.py
+        startup_budget (dict): limits of the startup scenario, see STARTUP_BUDGET
+    Return:
+        dict: the report
+    """
+
+    if not cache:
+        lux_cache.configure(max_entries=0, refinements=0, shared_path=None)
+
+    start = time.perf_counter()
+    ensure_index(db_file, wait=True)
+    index_seconds = time.perf_counter() - start
+
+    lux_memory.configure(engine=engine)
+    engine_report = None
+    if engine == "memory":
+        loaded = lux_memory.get_engine(db_file, wait=True)
+        engine_report = loaded.memory_report() if loaded is not None else None
+
+    if trace is None:
+        trace = make_trace(sample_values(db_file, 500, seed), sessions, seed)
+    rng = random.Random(seed)
+    object_ids = popular_objects(db_file, POPULAR_OBJECTS, seed)
+    weights = [1 / (rank ** skew) for rank in range(1, len(object_ids) + 1)]
+    page_views = rng.choices(object_ids, weights, k=views) if object_ids else []
+
+    with closing(sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)) as connection:
+        objects = connection.execute("SELECT count(*) FROM objects").fetchone()[0]
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "database": {"path": db_file, "objects": objects,
+                     "bytes": os.path.getsize(db_file)},
+        "settings": {"threads": threads, "seed": seed, "skew": skew, "cache": cache,
+                     "searches": len(trace), "views": len(page_views), "url": url,
+                     "engine": engine},
+        "index_seconds": round(index_seconds, 3),
+        "engine": engine_report,
+        "scenarios": {},
+    }
+
+    operations = scenario_operations(db_file, url)
+    for scenario in scenarios:
+        clear_caches(db_file)
+        if scenario == "herd":
+            # thundering herd: every thread sends each search at the same time
+            requests = [terms for terms in trace for _ in range(threads)]
+        elif scenario in ("search", "route_search"):
+            requests = trace
+        elif scenario == "large":
+            requests = [{"l": letter, "c": "", "a": "", "d": ""}
+                        for letter in LARGE_TERMS] * max(1, sessions // len(LARGE_TERMS))
+        else:
+            requests = page_views
+        if scenario == "startup":
+            paths = ["/api/search?" + urlencode({field: value for field, value
+                                                 in trace[0].items() if value})]
+            paths += [f"/obj/{object_id}" for object_id in object_ids[:1]] + ["/"]
+            report["scenarios"][scenario] = run_startup(db_file, paths, engine,
+                                                        budget=startup_budget)
+            continue
+        if scenario == "reload":
+            with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(db_file))) \
+                    as directory:
+                report["scenarios"][scenario] = run_scenario(
+                    reload_operation(db_file, len(trace), directory), trace, threads)
+                # the snapshot switched to once it was prepared
+                while lux_snapshot.snapshot_stats()["preparing"]:
+                    time.sleep(0.1)
+                report["scenarios"][scenario]["snapshot"] = lux_snapshot.snapshot_stats()
+            continue
+        report["scenarios"][scenario] = run_scenario(operations[scenario], requests, threads)
+        if scenario == "large":
+            report["scenarios"][scenario]["alloc_peak_kib"] = {
+                part: allocated_kib(operations[f"large_{part}"], requests[0])
+                for part in ("convert", "html")}
+    report["peak_rss_kib"] = peak_rss_kib()
+    return report
+
+
+def compare(report, baseline):
+    """Prints how each scenario's latency changed since a baseline report."""
+
+    print(f"{'scenario':<14}{'metric':<16}{'baseline':>12}{'current':>12}{'change':>9}",
+          file=sys.stderr)
+    for scenario, result in report["scenarios"].items():
+        old = baseline.get("scenarios", {}).get(scenario)
+        if not old:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            if old.get(metric) and result.get(metric) is not None:
+                change = (result[metric] - old[metric]) / old[metric] * 100
+                print(f"{scenario:<14}{metric:<16}{old[metric]:>12}{result[metric]:>12}"
+                      f"{change:>+8.1f}%", file=sys.stderr)
+
+
+def main():
+    """Command line entry point: runs the benchmark and prints the JSON report."""
+
+    parser = argparse.ArgumentParser(
+        prog='lux_bench.py', allow_abbrev=False,
+        description='Benchmark the YUAG search application')
+    parser.add_argument("database", help="the database to benchmark, see lux_synth.py")
+    parser.add_argument("--scenario", action="append", choices=SCENARIOS,
+                        help="scenario to run, may be repeated (default: all)")
+    parser.add_argument("--sessions", type=int, default=200,
+                        help="typing sessions in the generated trace (default: 200)")
+    parser.add_argument("--views", type=int, default=2000,
+                        help="object page views (default: 2000)")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="concurrent threads (default: 1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="replay the searches in FILE (one JSON object per line)")
+    parser.add_argument("--save-trace", metavar="FILE",
+                        help="write the searches of the generated trace to FILE")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="disable the result caches")
+    parser.add_argument("--url", metavar="URL",
+                        help="send the route scenarios to the server running at URL"
+                             " (e.g. http://localhost:8000) instead of flask's test client")
+    parser.add_argument("--engine", choices=lux_memory.ENGINES, default="sql",
+                        help="search engine (default: sql)")
+    parser.add_argument("--import-budget", metavar="MS", type=float,
+                        default=STARTUP_BUDGET["import_ms"],
+                        help="startup scenario: longest acceptable import of the"
+                             f" application (default: {STARTUP_BUDGET['import_ms']})")
+    parser.add_argument("--ready-budget", metavar="MS", type=float,
+                        default=STARTUP_BUDGET["ready_ms"],
+                        help="startup scenario: longest acceptable time until the first"
+                             " requests are answered"
+                             f" (default: {STARTUP_BUDGET['ready_ms']})")
+    parser.add_argument("--output", metavar="FILE", help="write the report to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="print the change from a previous report")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.database):
+        print(f"error: database {args.database} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    trace = None
+    try:
+        if args.trace:
+            with open(args.trace, encoding="utf-8") as trace_file:
+                trace = [dict({"l": "", "c": "", "a": "", "d": ""}, **json.loads(line))
+                         for line in trace_file if line.strip()]
+        elif args.save_trace:
+            trace = make_trace(sample_values(args.database, 500, args.seed),
+                               args.sessions, args.seed)
+            with open(args.save_trace, "w", encoding="utf-8") as trace_file:
+                trace_file.writelines(json.dumps(terms) + "\n" for terms in trace)
+        baseline = None
+        if args.compare:
+            with open(args.compare, encoding="utf-8") as baseline_file:
+                baseline = json.load(baseline_file)
+    except (OSError, ValueError) as err_message:
+        print(f"error: {err_message}", file=sys.stderr)
+        sys.exit(1)
+
+    default_scenarios = HTTP_SCENARIOS if args.url else SCENARIOS
+    report = run(args.database, tuple(args.scenario or default_scenarios),
+                 sessions=args.sessions,
+                 views=args.views, threads=args.threads, seed=args.seed, trace=trace,
+                 cache=not args.no_cache, url=args.url, engine=args.engine,
+                 startup_budget={"import_ms": args.import_budget,
+                                 "ready_ms": args.ready_budget})
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
+    if baseline is not None:
+        compare(report, baseline)
+
+    over_budget = report["scenarios"].get("startup", {}).get("over_budget")
+    if over_budget:
+        print(f"error: startup over budget: {', '.join(over_budget)}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,415 @@
+"""Module for the in-process caches of search results and object details."""
+
+import json
+import os
+import threading
+import time
+
+from collections import OrderedDict, deque
+from contextlib import closing
+from itertools import islice
+from sqlite3 import connect, OperationalError
+
+# defaults for every cache created by get_cache, see configure()
+CACHE_SETTINGS = {
+    "max_entries": 2048,
+    "max_bytes": 64 * 1024 * 1024,
+    "ttl": 600.0,
+    # number of recent complete searches remembered for refinement
+    "refinements": 64,
+    # path of an on-disk cache shared by all worker processes, None to disable
+    "shared_path": os.environ.get("LUX_SHARED_CACHE"),
+}
+
+# layout of the values in the shared cache; bump it whenever the cached rows change
+# shape, so workers running different code never read each other's entries
+SHARED_FORMAT = 2
+
+# caches by (kind, database file)
+_caches = {}
+_caches_lock = threading.Lock()
+
+# LIKE only folds ASCII letters, so only those may be folded in cache keys
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+
+def normalize_term(term):
+    """Normalizes a search term the same way SQLite's LIKE compares it.
+
+    Args:
+        term (str): search term, may be None
+    Return:
+        str: term with ASCII letters lowercased, "" for None
+    """
+
+    return (term or "").translate(_ASCII_LOWER)
+
+
+def estimate_size(rows):
+    """Estimates the memory held by a cached result, for the max_bytes bound.
+
+    Args:
+        rows (tuple): result rows
+    Return:
+        int: approximate size in bytes
+    """
+
+    size = 0
+    for row in rows:
+        size += 64 + 8 * len(row)
+        for value in row:
+            if isinstance(value, str):
+                size += 49 + len(value)
+    return size
+
+
+def estimate_json_size(value):
+    """Estimates the memory held by a cached dictionary from its JSON size.
+
+    Args:
+        value: JSON-serializable value
+    Return:
+        int: approximate size in bytes
+    """
+
+    return 2 * len(json.dumps(value))
+
+
+def estimate_page_size(page):
+    """Estimates the memory held by a cached page of results.
+
+    Args:
+        page (tuple): (rows, token of the next page or None)
+    Return:
+        int: approximate size in bytes
+    """
+
+    rows, next_token = page
+    return estimate_size(rows) + 49 + len(next_token or "")
+
+
+# how each kind of cache sizes its values and whether it may use the shared level
+CACHE_KINDS = {
+    "search": {"sizer": estimate_size, "shared": True},
+    "pages": {"sizer": estimate_page_size, "shared": False},
+    "details": {"sizer": estimate_json_size, "shared": False},
+    "facets": {"sizer": estimate_json_size, "shared": False},
+}
+
+
+class SharedCacheBackend():
+    """On-disk cache in an SQLite file, shared by every worker process using the same path.
+
+    Used as a second level behind the in-process cache: a miss in one worker can be
+    served from entries another worker has stored.
+    """
+
+    def __init__(self, path, max_entries):
+        self._path = path
+        self._max_entries = max_entries
+        self._local = threading.local()
+        with closing(self._connect()) as connection:
+            connection.execute("PRAGMA journal_mode = WAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY,"
+                " version TEXT, expires REAL, value TEXT)")
+
+    def _connect(self):
+        return connect(self._path, isolation_level=None, timeout=1.0,
+                       check_same_thread=False)
+
+    def _connection(self):
+        """Returns this thread's connection, opening it (again after a fork) if needed."""
+
+        pid = os.getpid()
+        if getattr(self._local, "pid", None) != pid:
+            self._local.connection = self._connect()
+            self._local.pid = pid
+        return self._local.connection
+
+    def get(self, key, version):
+        """Returns the cached value or None."""
+
+        try:
+            row = self._connection().execute(
+                "SELECT value FROM cache WHERE key = ? AND version = ? AND expires > ?",
+                [key, version, time.time()]).fetchone()
+        except OperationalError:
+            return None
+        return row[0] if row else None
+
+    def put(self, key, version, value, ttl):
+        """Stores a value, pruning the oldest entries past max_entries."""
+
+        try:
+            connection = self._connection()
+            connection.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                               [key, version, time.time() + ttl, value])
+            connection.execute(
+                "DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache"
+                " ORDER BY expires DESC LIMIT -1 OFFSET ?)", [self._max_entries])
+        except OperationalError:
+            # a busy shared cache only costs a miss, never a failed request
+            pass
+
+    def clear(self):
+        """Drops every entry."""
+
+        try:
+            self._connection().execute("DELETE FROM cache")
+        except OperationalError:
+            pass
+
+
+class ResultCache():
+    """Thread-safe LRU cache with a TTL and entry/byte bounds.
+
+    Every entry is stored together with the version of the database it was computed
+    from; a lookup with a different version drops the whole cache, so results never
+    outlive a change of the database file.
+    """
+
+    def __init__(self, max_entries, max_bytes, ttl, refinements=64, shared_path=None,
+                 sizer=estimate_size):
+        """Initializes an empty cache.
+
+        Args:
+            max_entries (int): maximum number of entries
+            max_bytes (int): maximum total size of the cached values
+            ttl (float): seconds an entry stays valid
+            refinements (int): number of complete id sets kept for find_candidates
+            shared_path (str): optional path of an on-disk cache shared across processes
+            sizer (function): returns the approximate size of a value in bytes
+        """
+
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._sizer = sizer
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = None
+        self._shared = SharedCacheBackend(shared_path, max_entries) if shared_path else None
+        self._complete = deque(maxlen=refinements)
+        self._stats = {"hits": 0, "misses": 0, "shared_hits": 0, "evictions": 0,
+                       "expirations": 0, "invalidations": 0, "refinements": 0}
+
+    def _check_version(self, version):
+        """Drops every entry if the database version changed. Caller must hold the lock."""
+
+        if version != self._version:
+            if self._entries:
+                self._stats["invalidations"] += 1
+            self._entries.clear()
+            self._complete.clear()
+            self._bytes = 0
+            self._version = version
+
+    def get(self, key, version):
+        """Returns the cached value for key, or None on a miss.
+
+        Args:
+            key (tuple): cache key
+            version: version of the database the caller is reading
+        """
+
+        with self._lock:
+            self._check_version(version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self._stats["hits"] += 1
+                    return value
+                del self._entries[key]
+                self._bytes -= size
+                self._stats["expirations"] += 1
+
+        if self._shared is not None:
+            shared = self._shared.get(json.dumps(key), json.dumps([SHARED_FORMAT, version]))
+            if shared is not None:
+                value = tuple(tuple(row) for row in json.loads(shared))
+                with self._lock:
+                    self._stats["shared_hits"] += 1
+                self._store(key, version, value)
+                return value
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def put(self, key, version, value):
+        """Stores a result for key.
+
+        Args:
+            key (tuple): cache key
+            version: version of the database the value was computed from
+            value: result rows (tuples of JSON-serializable values), or any
+                JSON-serializable value for caches without a shared level;
+                callers must not modify it once it is cached
+        """
+
+        self._store(key, version, value)
+        if self._shared is not None:
+            self._shared.put(json.dumps(key), json.dumps([SHARED_FORMAT, version]),
+                             json.dumps(value), self._ttl)
+
+    def _store(self, key, version, value):
+        """Stores a value in the in-process cache, evicting the least recently used."""
+
+        size = self._sizer(value)
+        if size > self._max_bytes:
+            return
+
+        with self._lock:
+            self._check_version(version)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (value, time.monotonic() + self._ttl, size)
+            self._bytes += size
+
+            while len(self._entries) > self._max_entries or self._bytes > self._max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self._stats["evictions"] += 1
+
+    def remember_ids(self, terms, version, ids):
+        """Remembers the complete set of object ids matching a search.
+
+        Args:
+            terms (tuple): normalized search terms
+            version: version of the database the ids were computed from
+            ids (list): every matching object id, not just a capped prefix
+        """
+
+        with self._lock:
+            self._check_version(version)
+            self._complete.append((terms, frozenset(ids)))
+
+    def find_candidates(self, terms, version):
+        """Returns the ids of a remembered search that the given search can only narrow.
+
+        A LIKE '%term%' match of a longer term always contains the shorter term, so
+        when every remembered term is a substring of the corresponding new term, the
+        new matches are a subset of the remembered ids.
+
+        Args:
+            terms (tuple): normalized search terms
+            version: version of the database the caller is reading
+        Return:
+            frozenset: the smallest such id set, None if there is none
+        """
+
+        best = None
+        with self._lock:
+            self._check_version(version)
+            for old_terms, ids in self._complete:
+                if best is not None and len(ids) >= len(best):
+                    continue
+                if all(old in new for old, new in zip(old_terms, terms)):
+                    best = ids
+            if best is not None:
+                self._stats["refinements"] += 1
+        return best
+
+    def recent_keys(self, count):
+        """Returns the keys of the most recently used entries, most recent first.
+
+        Args:
+            count (int): maximum number of keys
+        """
+
+        with self._lock:
+            return list(islice(reversed(self._entries), count))
+
+    def clear(self):
+        """Drops every entry, including the shared ones."""
+
+        with self._lock:
+            self._entries.clear()
+            self._complete.clear()
+            self._bytes = 0
+            self._stats["invalidations"] += 1
+        if self._shared is not None:
+            self._shared.clear()
+
+    def stats(self):
+        """Returns a snapshot of the cache's counters.
+
+        Return:
+            dict: hits, misses, evictions, expirations, invalidations, entries, bytes
+        """
+
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update({
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_entries": self._max_entries,
+                "max_bytes": self._max_bytes,
+                "ttl": self._ttl,
+                "shared": self._shared is not None,
+            })
+        return stats
+
+
+def configure(**settings):
+    """Changes the settings used for caches created from now on.
+
+    Args:
+        settings: any of max_entries, max_bytes, ttl, shared_path
+    """
+
+    unknown = set(settings) - set(CACHE_SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown cache settings: {', '.join(sorted(unknown))}")
+    CACHE_SETTINGS.update(settings)
+
+
+def get_cache(db_file, kind="search"):
+    """Returns the process-wide cache of the given kind for the given database file.
+
+    Args:
+        db_file (str): database file
+        kind (str): "search" for LuxQuery results, "pages" for LuxQuery.fetch_page
+            pages, "details" for LuxDetailsQuery results, "facets" for LuxQuery facet
+            counts
+    Return:
+        ResultCache: the cache
+    """
+
+    cache = _caches.get((kind, db_file))
+    if cache is None:
+        with _caches_lock:
+            cache = _caches.get((kind, db_file))
+            if cache is None:
+                settings = dict(CACHE_SETTINGS, sizer=CACHE_KINDS[kind]["sizer"])
+                if not CACHE_KINDS[kind]["shared"]:
+                    settings["shared_path"] = None
+                cache = _caches[(kind, db_file)] = ResultCache(**settings)
+    return cache
+
+
+def drop_caches(db_file):
+    """Forgets the in-process caches of a database file no longer read, such as an
+    old snapshot; the shared cache keeps its entries until they expire.
+
+    Args:
+        db_file (str): database file
+    """
+
+    with _caches_lock:
+        for kind in CACHE_KINDS:
+            _caches.pop((kind, db_file), None)
+
+
+def cache_stats():
+    """Returns the stats of every cache in this process, keyed by kind and database file."""
+
+    stats = {kind: {} for kind in CACHE_KINDS}
+    for (kind, db_file), cache in list(_caches.items()):
+        stats[kind][db_file] = cache.stats()
+    return stats
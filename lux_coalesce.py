@@ -0,0 +1,143 @@
+"""Module for coalescing identical concurrent searches (single flight): the first search
+runs, the identical ones arriving while it runs wait for it and share its result.
+"""
+
+import threading
+
+# seconds between checks of a waiting search's cancel token
+POLL_INTERVAL = 0.05
+
+# flights by database file
+_flights = {}
+_flights_lock = threading.Lock()
+
+
+class Call():
+    """One running search and the searches waiting for its result."""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._ok = False
+        self.waiters = 0
+
+    def publish(self, value):
+        """Hands the result to the waiting searches."""
+
+        self._value = value
+        self._ok = True
+        self._done.set()
+
+    def abandon(self):
+        """Tells the waiting searches that no result is coming (the search failed or
+        was cancelled), so they run it themselves.
+        """
+
+        self._done.set()
+
+    def wait(self, cancel=None):
+        """Waits for the result.
+
+        Args:
+            cancel (CancelToken): the waiting search's token; the wait ends when it is
+                cancelled
+        Return:
+            tuple: (True, result), or (False, None) if the search was abandoned or the
+            waiting search was cancelled
+        """
+
+        while not self._done.wait(POLL_INTERVAL):
+            if cancel is not None and cancel.cancelled:
+                return False, None
+        return self._ok, self._value
+
+
+class SingleFlight():
+    """Tracks the running searches by key, so identical ones can wait for each other."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._stats = {"leaders": 0, "coalesced": 0, "abandoned": 0}
+
+    def join(self, key):
+        """Joins the search running for key, or starts one.
+
+        Args:
+            key (tuple): normalized search arguments, including the database version
+        Return:
+            tuple: (call, True if the caller must run the search and publish or abandon
+            the call, False if it should wait for the call)
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self._stats["coalesced"] += 1
+                return call, False
+            call = self._calls[key] = Call()
+            self._stats["leaders"] += 1
+            return call, True
+
+    def leave(self, key, call, value=None, ok=True):
+        """Ends the search started for key, publishing its result (or abandoning it)."""
+
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+            if not ok:
+                self._stats["abandoned"] += 1
+        if ok:
+            call.publish(value)
+        else:
+            call.abandon()
+
+    def run(self, key, function, cancel=None):
+        """Returns function(), sharing one execution between concurrent calls with the
+        same key. A waiting call whose leader fails runs function itself.
+
+        Args:
+            key (tuple): normalized search arguments, including the database version
+            function: computes the result
+            cancel (CancelToken): the caller's token, ends its wait when cancelled
+        Return:
+            the result of function
+        """
+
+        call, leader = self.join(key)
+        if not leader:
+            ok, value = call.wait(cancel)
+            if ok:
+                return value
+            return function()
+
+        try:
+            value = function()
+        except BaseException:
+            self.leave(key, call, ok=False)
+            raise
+        self.leave(key, call, value)
+        return value
+
+    def stats(self):
+        """Returns a snapshot of the counters and the number of searches running."""
+
+        with self._lock:
+            return dict(self._stats, running=len(self._calls))
+
+
+def get_single_flight(db_file):
+    """Returns the process-wide single flight of the given database file."""
+
+    flight = _flights.get(db_file)
+    if flight is None:
+        with _flights_lock:
+            flight = _flights.setdefault(db_file, SingleFlight())
+    return flight
+
+
+def single_flight_stats():
+    """Returns the stats of every single flight in this process, keyed by database file."""
+
+    return {db_file: flight.stats() for db_file, flight in list(_flights.items())}
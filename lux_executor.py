@@ -0,0 +1,255 @@
+"""Module for running searches on a bounded pool of threads, cancelling the ones
+nobody is waiting for anymore.
+
+A search started with a session token supersedes the previous search of the same
+session: as the user types, each keystroke's search interrupts the one before it
+(sqlite3.Connection.interrupt) or, if it has not started yet, keeps it from starting.
+A search is also interrupted when its client disconnects.
+"""
+
+import contextvars
+import os
+import select
+import socket
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from query import SearchCancelledError
+
+EXECUTOR_SETTINGS = {
+    # threads running searches in each process
+    "workers": int(os.environ.get("LUX_SEARCH_WORKERS", "4")),
+    # searches that may wait for a thread before new ones are rejected
+    "queue_size": int(os.environ.get("LUX_SEARCH_QUEUE", "32")),
+    # number of sessions whose latest search is remembered
+    "sessions": 10000,
+    # seconds a session's search waits before it starts; a newer search of the session
+    # arriving in the meantime drops it without running (0 to start at once)
+    "debounce": float(os.environ.get("LUX_SEARCH_DEBOUNCE_MS", "0")) / 1000,
+}
+
+# seconds between checks of the client's connection while waiting for a search
+POLL_INTERVAL = 0.05
+
+
+class ExecutorBusyError(Exception):
+    """Exception class to handle a search rejected because the queue is full."""
+
+
+class CancelToken():
+    """Cancellation handle of one search.
+
+    The search attaches the connection it runs on; cancel() interrupts the statement
+    running on it, or makes attach() fail if the search has not started yet.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connection = None
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        """True once the search is cancelled."""
+
+        return self._cancelled.is_set()
+
+    def wait(self, timeout):
+        """Waits up to timeout seconds for the search to be cancelled.
+
+        Return:
+            bool: True if it was cancelled
+        """
+
+        return self._cancelled.wait(timeout)
+
+    def attach(self, connection):
+        """Registers the connection the search runs on.
+
+        Raises:
+            SearchCancelledError: if the search was cancelled before it started
+        """
+
+        with self._lock:
+            if self.cancelled:
+                raise SearchCancelledError
+            self._connection = connection
+
+    def detach(self):
+        """Unregisters the connection once the search is done with it."""
+
+        with self._lock:
+            self._connection = None
+
+    def cancel(self):
+        """Cancels the search, interrupting its statement if it is running."""
+
+        with self._lock:
+            self._cancelled.set()
+            if self._connection is not None:
+                self._connection.interrupt()
+
+
+class SearchExecutor():
+    """Thread pool with a bounded queue, tracking the latest search of each session."""
+
+    def __init__(self, workers, queue_size, sessions, debounce=0.0):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="search")
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._sessions = OrderedDict()
+        self._max_sessions = sessions
+        self._debounce = debounce
+        self._workers = workers
+        self._queue_size = queue_size
+        self._stats = {"submitted": 0, "rejected": 0, "superseded": 0, "disconnected": 0,
+                       "cancelled": 0, "debounced": 0}
+
+    def start(self, session=None):
+        """Returns the token of a new search, cancelling the previous search of the session.
+
+        Args:
+            session (str): session token sent by the client, None for no session
+        Return:
+            CancelToken: the new search's token
+        """
+
+        token = CancelToken()
+        if session:
+            with self._lock:
+                previous = self._sessions.pop(session, None)
+                self._sessions[session] = token
+                while len(self._sessions) > self._max_sessions:
+                    self._sessions.popitem(last=False)
+            if previous is not None and not previous.cancelled:
+                previous.cancel()
+                self._count("superseded")
+        return token
+
+    def debounce(self, session, token):
+        """Waits for the debounce window before a session's search starts.
+
+        Args:
+            session (str): session token sent by the client, None for no session
+            token (CancelToken): the search's token, see start
+        Raises:
+            SearchCancelledError: if a newer search of the session arrived meanwhile
+        """
+
+        if session and self._debounce > 0 and token.wait(self._debounce):
+            self._count("debounced")
+            raise SearchCancelledError
+
+    def finish(self, session, token):
+        """Forgets the session's search if it is still its latest one."""
+
+        if session:
+            with self._lock:
+                if self._sessions.get(session) is token:
+                    del self._sessions[session]
+
+    def submit(self, function, *args, **kwargs):
+        """Runs function(*args, **kwargs) on the pool.
+
+        Return:
+            Future: the result of the call
+        Raises:
+            ExecutorBusyError: if every thread is busy and the queue is full
+        """
+
+        if not self._slots.acquire(blocking=False):
+            self._count("rejected")
+            raise ExecutorBusyError
+        try:
+            # run in the caller's context, so the search's timing spans count for its request
+            future = self._pool.submit(contextvars.copy_context().run, function,
+                                       *args, **kwargs)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._count("submitted")
+        return future
+
+    def wait(self, future, token, client_socket=None):
+        """Waits for a search, cancelling it if its client disconnects.
+
+        Args:
+            future (Future): the search, see submit
+            token (CancelToken): the search's token
+            client_socket (socket): connection of the client, None if unknown
+        Return:
+            the result of the search
+        Raises:
+            SearchCancelledError: if the search was superseded or its client disconnected
+        """
+
+        while True:
+            # a search still waiting for a thread is dropped without running
+            if token.cancelled and future.cancel():
+                self._count("cancelled")
+                raise SearchCancelledError
+            try:
+                return future.result(timeout=POLL_INTERVAL)
+            except FutureTimeoutError:
+                pass
+            except SearchCancelledError:
+                self._count("cancelled")
+                raise
+            if client_socket is not None and not token.cancelled and peer_closed(client_socket):
+                token.cancel()
+                self._count("disconnected")
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def stats(self):
+        """Returns a snapshot of the executor's counters."""
+
+        with self._lock:
+            stats = dict(self._stats, sessions=len(self._sessions))
+        stats.update({"workers": self._workers, "queue_size": self._queue_size,
+                      "debounce": self._debounce})
+        return stats
+
+
+def peer_closed(client_socket):
+    """Returns True if the client closed its side of the connection.
+
+    Data waiting on the socket (a pipelined request) is only peeked at, not read.
+    """
+
+    try:
+        readable, _, _ = select.select([client_socket], [], [], 0)
+        if not readable:
+            return False
+        return client_socket.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+
+_executor = {"pid": None, "executor": None}
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """Returns this process's search executor, creating it (again after a fork) if needed."""
+
+    pid = os.getpid()
+    if _executor["pid"] != pid:
+        with _executor_lock:
+            if _executor["pid"] != pid:
+                _executor["executor"] = SearchExecutor(**EXECUTOR_SETTINGS)
+                _executor["pid"] = pid
+    return _executor["executor"]
+
+
+def executor_stats():
+    """Returns the stats of this process's search executor, None if it has not started."""
+
+    if _executor["pid"] != os.getpid():
+        return None
+    return _executor["executor"].stats()
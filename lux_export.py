@@ -0,0 +1,260 @@
+"""Module for exporting the full results of a search as CSV, NDJSON or Parquet.
+
+Rows are streamed from the database cursor (LuxQuery.export_rows) and serialized
+EXPORT_BATCH at a time, so memory use stays the same whatever the number of results.
+Parquet needs pyarrow, which is only imported by the first Parquet export since it
+takes longer to import than the rest of the application; each batch is written as
+one row group.
+
+Usage: python lux_export.py [database] [-l label] [-c classifier] [-a agent]
+       [-d department] [--format csv|ndjson|parquet] [--gzip] [-o file]
+"""
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+import zlib
+
+from importlib.util import find_spec
+from itertools import islice
+from sqlite3 import OperationalError
+
+from query import LuxQuery
+from lux_query_sql import QUERY_LUX_ROW
+
+# whether pyarrow is installed, found without importing it
+PARQUET_AVAILABLE = find_spec("pyarrow") is not None
+
+# number of rows serialized (and, for Parquet, written as one row group) at a time
+EXPORT_BATCH = 1000
+
+GZIP_LEVEL = 6
+
+# format -> (content type, file extension)
+EXPORT_FORMATS = {
+    "csv": ("text/csv; charset=utf-8", ".csv"),
+    "ndjson": ("application/x-ndjson", ".ndjson"),
+    "parquet": ("application/vnd.apache.parquet", ".parquet"),
+}
+
+
+class ExportFormatError(Exception):
+    """Exception class to handle an unknown or unavailable export format."""
+
+
+def available_formats():
+    """Returns the export formats that can be written in this environment."""
+
+    return [fmt for fmt in EXPORT_FORMATS if fmt != "parquet" or PARQUET_AVAILABLE]
+
+
+def check_format(fmt):
+    """Raises ExportFormatError if the format can not be written.
+
+    Args:
+        fmt (str): export format, see EXPORT_FORMATS
+    """
+
+    if fmt not in EXPORT_FORMATS:
+        raise ExportFormatError(
+            f"unknown format {fmt}, use one of {', '.join(available_formats())}")
+    if fmt not in available_formats():
+        raise ExportFormatError(f"the {fmt} format needs pyarrow installed")
+
+
+def content_type(fmt, compress=False):
+    """Returns the content type of an export."""
+
+    if compress and fmt != "parquet":
+        return "application/gzip"
+    return EXPORT_FORMATS[fmt][0]
+
+
+def file_name(fmt, compress=False):
+    """Returns the name under which an export is downloaded."""
+
+    name = "lux-export" + EXPORT_FORMATS[fmt][1]
+    if compress and fmt != "parquet":
+        name += ".gz"
+    return name
+
+
+def batches(rows):
+    """Generator yielding the rows in lists of EXPORT_BATCH."""
+
+    rows = iter(rows)
+    batch = list(islice(rows, EXPORT_BATCH))
+    while batch:
+        yield batch
+        batch = list(islice(rows, EXPORT_BATCH))
+
+
+def csv_chunks(rows):
+    """Generator yielding the rows as CSV, with a header line, in encoded chunks."""
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(QUERY_LUX_ROW)
+    for batch in batches(rows):
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    # the header of an export without rows
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def ndjson_chunks(rows):
+    """Generator yielding the rows as one JSON object per line, in encoded chunks."""
+
+    for batch in batches(rows):
+        yield "".join(json.dumps(dict(zip(QUERY_LUX_ROW, row))) + "\n"
+                      for row in batch).encode()
+
+
+class ChunkSink(io.RawIOBase):
+    """Write-only file collecting what the Parquet writer writes, so it can be sent
+    as it is produced instead of once the file is complete.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        """Returns the bytes written since the last call."""
+
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def parquet_chunks(rows, compression="snappy"):
+    """Generator yielding the rows as a Parquet file, one row group per batch.
+
+    Args:
+        rows (iterable): (id, label, date, artist, classification) rows
+        compression (str): Parquet compression codec of the columns
+    """
+
+    # pylint: disable=import-outside-toplevel
+    import pyarrow
+    import pyarrow.parquet
+
+    schema = pyarrow.schema([(name, pyarrow.int64() if name == "id" else pyarrow.string())
+                             for name in QUERY_LUX_ROW])
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema, compression=compression)
+    try:
+        for batch in batches(rows):
+            columns = zip(*batch)
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type)
+                 for column, field in zip(columns, schema)], schema=schema))
+            yield sink.take()
+    finally:
+        writer.close()
+    yield sink.take()
+
+
+def gzip_chunks(chunks):
+    """Generator compressing the chunks into one gzip stream."""
+
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_chunks(rows, fmt, compress=False):
+    """Generator yielding the rows serialized in the given format.
+
+    Args:
+        rows (iterable): (id, label, date, artist, classification) rows
+        fmt (str): export format, see EXPORT_FORMATS
+        compress (bool): gzip the output; Parquet compresses its columns with gzip
+            instead, so the file stays readable as Parquet
+    Yields:
+        bytes: consecutive pieces of the export
+    Raises:
+        ExportFormatError: if the format can not be written
+    """
+
+    check_format(fmt)
+    if fmt == "parquet":
+        yield from parquet_chunks(rows, "gzip" if compress else "snappy")
+        return
+    chunks = csv_chunks(rows) if fmt == "csv" else ndjson_chunks(rows)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    yield from chunks
+
+
+def main():
+    """Command line entry point: writes the results of a search to a file or stdout."""
+
+    parser = argparse.ArgumentParser(
+        prog='lux_export.py', allow_abbrev=False,
+        description='Export every YUAG object matching a search')
+    parser.add_argument(
+        "database", nargs="?", default="./lux.sqlite",
+        help="the collection database (default: ./lux.sqlite)")
+    parser.add_argument("-l", metavar="label", default="",
+                        help="show only objects whose label contains label")
+    parser.add_argument("-c", metavar="classifier", default="",
+                        help="show only objects classified as classifier")
+    parser.add_argument("-a", metavar="agent", default="",
+                        help="show only objects produced by agent")
+    parser.add_argument("-d", metavar="department", default="",
+                        help="show only objects belonging to department")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="csv",
+                        help="output format (default: csv)")
+    parser.add_argument("--gzip", action="store_true", help="compress the output")
+    parser.add_argument("-o", "--output", metavar="file",
+                        help="file to write (default: stdout)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print(f"error: database {args.database} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        check_format(args.format)
+    except ExportFormatError as err_message:
+        print(f"error: {err_message}", file=sys.stderr)
+        sys.exit(1)
+
+    rows = LuxQuery(args.database).export_rows(dep=args.d, agt=args.a,
+                                               classifier=args.c, label=args.l)
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in export_chunks(rows, args.format, args.gzip):
+            output.write(chunk)
+    except OperationalError as err_message:
+        print(f"error: unable to query database: {err_message}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        if args.output:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
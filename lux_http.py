@@ -0,0 +1,143 @@
+"""Module for serializing API responses: JSON encoding, ETags and compression."""
+
+import gzip
+import hashlib
+import json
+
+from flask import request, make_response
+
+from lux_metrics import span
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover - optional dependency
+    brotli = None
+
+# bodies smaller than this are sent uncompressed
+MIN_COMPRESS_SIZE = 1024
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def dumps(obj):
+    """Serializes obj to JSON bytes, with orjson when it is installed.
+
+    Args:
+        obj: JSON-serializable object
+    Return:
+        bytes: UTF-8 encoded JSON
+    """
+
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
+
+
+def make_etag(*parts):
+    """Returns an ETag for a response determined entirely by the given parts,
+    e.g. the database version and the request arguments.
+    """
+
+    digest = hashlib.blake2b(repr(parts).encode(), digest_size=16)
+    return digest.hexdigest()
+
+
+def not_modified(etag, weak=False):
+    """Returns True if the client already holds the representation with this ETag,
+    in any content encoding.
+
+    Args:
+        etag (str): ETag of the current representation
+        weak (bool): use weak comparison, for representations that are only
+            semantically equivalent (e.g. pages showing the current time)
+    """
+
+    if weak:
+        return request.if_none_match.contains_weak(etag)
+    return any(request.if_none_match.contains(f"{etag}{suffix}")
+               for suffix in ("", "-gzip", "-br"))
+
+
+def accepted_encodings():
+    """Returns the content codings the client accepts, with their q-values."""
+
+    encodings = {}
+    for item in request.headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if coding:
+            encodings[coding.strip().lower()] = quality
+    return encodings
+
+
+def compress(body):
+    """Compresses body with the best coding the client accepts.
+
+    Args:
+        body (bytes): response body
+    Return:
+        tuple: (body, coding or None if it is sent uncompressed)
+    """
+
+    if len(body) < MIN_COMPRESS_SIZE:
+        return body, None
+
+    encodings = accepted_encodings()
+    if brotli is not None and encodings.get("br", 0) > 0:
+        return brotli.compress(body, quality=BROTLI_QUALITY), "br"
+    if encodings.get("gzip", 0) > 0:
+        return gzip.compress(body, compresslevel=GZIP_LEVEL), "gzip"
+    return body, None
+
+
+def json_response(obj, status=200, etag=None):
+    """Builds a compressed JSON response for obj.
+
+    Args:
+        obj: JSON-serializable object
+        status (int): HTTP status
+        etag (str): ETag of the representation, see make_etag
+    Return:
+        Response: the flask response
+    """
+
+    with span("serialize"):
+        body, coding = compress(dumps(obj))
+    response = make_response(body, status)
+    response.mimetype = "application/json"
+    response.vary.add("Accept-Encoding")
+    if coding:
+        response.headers["Content-Encoding"] = coding
+    if etag:
+        response.set_etag(f"{etag}-{coding}" if coding else etag)
+    return response
+
+
+def not_modified_response(etag, weak=False, max_age=None):
+    """Builds the 304 response for a representation the client already holds."""
+
+    response = make_response("", 304)
+    response.set_etag(etag, weak=weak)
+    response.vary.add("Accept-Encoding")
+    if max_age is not None:
+        set_max_age(response, max_age)
+    return response
+
+
+def set_max_age(response, max_age):
+    """Lets browsers and shared caches reuse the response for max_age seconds."""
+
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
@@ -0,0 +1,270 @@
+"""Module for building the search index used by LuxQuery.
+
+The index is a separate database file next to the collection. It holds the rows
+QUERY_SEARCH_ROWS produces, precomputed into the flat search_rows table with the
+rank of every object in both sort orders of the results, a trigram full-text
+index over them and the facet values of every object. A checksum of the collection
+database is stored with the index so a changed collection triggers a rebuild, in a
+background thread while searches use the original query.
+"""
+
+import argparse
+import hashlib
+import logging
+import os
+import sys
+import threading
+
+from contextlib import closing
+from sqlite3 import connect, OperationalError
+
+from lux_query_sql import (CREATE_SEARCH_ROWS, BUILD_SEARCH_ROWS, RANK_SEARCH_ROWS,
+                           INDEX_SEARCH_ROWS, CREATE_SEARCH_INDEX, BUILD_SEARCH_INDEX,
+                           CREATE_SEARCH_FACETS, BUILD_SEARCH_FACETS,
+                           CREATE_SEARCH_META)
+
+# bump whenever the layout of the index database changes
+INDEX_VERSION = 4
+
+# database file -> (size, mtime) of the collection last verified against its index
+_verified = {}
+
+# database file -> (size, mtime) of the collection whose index could not be built;
+# it is searched without the index until it changes
+_failed = {}
+
+# database files whose index a background thread is checking or building
+_building = set()
+_building_lock = threading.Lock()
+_rebuild_lock = threading.Lock()
+
+index_log = logging.getLogger("lux.index")
+
+
+def index_path(db_file):
+    """Returns the path of the search index belonging to the given database file.
+
+    Args:
+        db_file (str): database file
+    Return:
+        str: path of the index database, e.g. ./lux.index.sqlite for ./lux.sqlite
+    """
+
+    root, ext = os.path.splitext(db_file)
+    return f"{root}.index{ext or '.sqlite'}"
+
+
+def source_signature(db_file):
+    """Returns the (size, mtime) pair used to cheaply detect a changed database."""
+
+    stat = os.stat(db_file)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def source_checksum(db_file):
+    """Returns the sha256 checksum of the database file."""
+
+    digest = hashlib.sha256()
+    with open(db_file, "rb") as db:
+        for chunk in iter(lambda: db.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_meta(index_file):
+    """Returns the metadata stored in an index database, empty if it can not be read."""
+
+    if not os.path.isfile(index_file):
+        return {}
+    try:
+        with closing(connect(f"file:{index_file}?mode=ro", uri=True)) as connection:
+            return dict(connection.execute("SELECT key, value FROM search_meta"))
+    except OperationalError:
+        return {}
+
+
+def build_index(db_file):
+    """Builds (or rebuilds) the search index for the given database file.
+
+    The index is written to a temporary file first and then moved into place,
+    so readers never see a partially built index.
+
+    Args:
+        db_file (str): database file
+    Return:
+        str: path of the index database
+    """
+
+    target = index_path(db_file)
+    tmp_file = f"{target}.{os.getpid()}.tmp"
+    if os.path.exists(tmp_file):
+        os.remove(tmp_file)
+
+    size, mtime = source_signature(db_file)
+    checksum = source_checksum(db_file)
+
+    try:
+        with closing(connect(tmp_file, isolation_level=None, uri=True)) as connection:
+            with closing(connection.cursor()) as cursor:
+                cursor.execute("ATTACH DATABASE ? AS lux", [f"file:{db_file}?mode=ro"])
+                cursor.execute("BEGIN")
+                cursor.execute(CREATE_SEARCH_ROWS)
+                cursor.execute(BUILD_SEARCH_ROWS)
+                cursor.execute(RANK_SEARCH_ROWS)
+                for smt_str in INDEX_SEARCH_ROWS:
+                    cursor.execute(smt_str)
+                cursor.execute(CREATE_SEARCH_INDEX)
+                cursor.execute(BUILD_SEARCH_INDEX)
+                for smt_str in CREATE_SEARCH_FACETS + BUILD_SEARCH_FACETS:
+                    cursor.execute(smt_str)
+                cursor.execute(CREATE_SEARCH_META)
+                cursor.executemany("INSERT INTO search_meta VALUES (?, ?)", [
+                    ("version", INDEX_VERSION),
+                    ("source_size", size),
+                    ("source_mtime", mtime),
+                    ("source_checksum", checksum),
+                ])
+                cursor.execute("INSERT INTO search_meta"
+                               " SELECT 'objects', COUNT(DISTINCT id) FROM search_rows")
+                cursor.execute("COMMIT")
+                cursor.execute("DETACH DATABASE lux")
+                cursor.execute("INSERT INTO search_fts (search_fts) VALUES ('optimize')")
+                cursor.execute("ANALYZE")
+        os.replace(tmp_file, target)
+    finally:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+
+    _verified[db_file] = (size, mtime)
+    return target
+
+
+def ensure_index(db_file, wait=False):
+    """Returns the path of an up-to-date search index for the given database file.
+
+    Only the database's size and mtime are checked on the fast path. When those
+    change, the index is checked against the database's checksum, so touching the
+    file does not force a rebuild, and rebuilt if the database changed. Unless wait
+    is True, that happens in a background thread and searches use the original query
+    meanwhile. A database whose index can not be built is not tried again until it
+    changes.
+
+    Args:
+        db_file (str): database file
+        wait (bool): True to check and build the index in this thread
+    Return:
+        str: path of the index database, or None if no usable index is available
+        (the database does not exist, the index can not be written, or it is still
+        being checked or built)
+    """
+
+    target = index_path(db_file)
+    try:
+        signature = source_signature(db_file)
+    except OSError:
+        return None
+
+    if _verified.get(db_file) == signature and os.path.isfile(target):
+        return target
+    if _failed.get(db_file) == signature:
+        return None
+    if wait:
+        return refresh_index(db_file, signature)
+
+    with _building_lock:
+        if db_file in _building:
+            return None
+        _building.add(db_file)
+    threading.Thread(target=_refresh_in_background, args=(db_file, signature),
+                     name="lux-index", daemon=True).start()
+    return None
+
+
+def refresh_index(db_file, signature):
+    """Checks the index of a database against its checksum and rebuilds it if needed;
+    one database at a time.
+
+    Args:
+        db_file (str): database file
+        signature (tuple): (size, mtime) of the database, see source_signature
+    Return:
+        str: path of the index database, None if it could not be built
+    """
+
+    target = index_path(db_file)
+    with _rebuild_lock:
+        if _verified.get(db_file) == signature and os.path.isfile(target):
+            return target
+        try:
+            meta = read_meta(target)
+            if meta.get("version") == INDEX_VERSION:
+                current = (meta.get("source_size"), meta.get("source_mtime")) == signature
+                if current or meta.get("source_checksum") == source_checksum(db_file):
+                    _verified[db_file] = signature
+                    return target
+            return build_index(db_file)
+        except (OperationalError, OSError) as err_message:
+            index_log.warning("searching %s without its index: %s", db_file, err_message)
+            _failed[db_file] = signature
+            return None
+
+
+def _refresh_in_background(db_file, signature):
+    """Body of the thread started by ensure_index."""
+
+    try:
+        refresh_index(db_file, signature)
+    finally:
+        with _building_lock:
+            _building.discard(db_file)
+
+
+def _reset_after_fork():
+    """Forgets the background threads of the parent, which do not exist in a child."""
+
+    global _building_lock, _rebuild_lock  # pylint: disable=global-statement
+    _building_lock = threading.Lock()
+    _rebuild_lock = threading.Lock()
+    _building.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def main():
+    """Command line entry point: builds or refreshes the search index."""
+
+    parser = argparse.ArgumentParser(
+        prog='lux_index.py', allow_abbrev=False,
+        description='Build or refresh the YUAG search index')
+    parser.add_argument(
+        "database", nargs="?", default="./lux.sqlite",
+        help="the collection database to index (default: ./lux.sqlite)")
+    parser.add_argument(
+        "--force", action="store_true",
+        help="rebuild even if the index is up to date")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print(f"error: database {args.database} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        if args.force:
+            target = build_index(args.database)
+        else:
+            target = ensure_index(args.database, wait=True)
+    except OperationalError as err_message:
+        print(f"error: unable to build index: {err_message}", file=sys.stderr)
+        sys.exit(1)
+
+    if target is None:
+        print("error: unable to build index", file=sys.stderr)
+        sys.exit(1)
+
+    print(f"Search index written to {target}")
+
+
+if __name__ == '__main__':
+    main()
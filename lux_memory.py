@@ -0,0 +1,902 @@
+"""Module for the in-memory search engine used by LuxQuery when ENGINE_SETTINGS["engine"]
+is "memory".
+
+The rows QUERY_SEARCH_ROWS produces are loaded once into compact columns: every field is
+dictionary encoded (each distinct value is stored once, objects refer to it by an
+array index) and the four searchable fields get a trigram index over their distinct
+values. A search then runs without SQLite: the trigram index narrows the values each
+term can match, the candidates are checked with the same rules as LIKE, and the
+matching objects are ordered by ranks precomputed for both sort orders. The engine
+answers exactly what the SQL query answers, row for row and value for value.
+
+The engine also keeps the departments, classifiers and agent names of every object,
+so the facet counts of a search are counted over all the objects it matches (found
+by intersecting posting lists), not only the rows returned.
+"""
+
+import argparse
+import heapq
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+
+from array import array
+from bisect import bisect_right
+from collections import Counter, defaultdict
+from contextlib import closing
+from itertools import islice
+from sqlite3 import connect, OperationalError
+
+from lux_index import ensure_index, source_signature
+from lux_query_sql import QUERY_FACET_VALUES, QUERY_SEARCH_ROWS
+
+ENGINE_SETTINGS = {
+    # "sql" runs every search against SQLite, "memory" uses this module
+    "engine": os.environ.get("LUX_ENGINE", "sql"),
+    # bytes the engine of one database may take; a larger catalog is searched with SQL
+    "budget": int(os.environ.get("LUX_MEMORY_BUDGET_MB", "1024")) * 1024 * 1024,
+}
+
+ENGINES = ("sql", "memory")
+
+# bytes an engine takes per object at least (580 to 750 on the synthetic catalogs of
+# lux_synth.py), to refuse a catalog that can not fit before loading it
+MIN_OBJECT_BYTES = 500
+
+# fields of the search rows that are filtered with LIKE, see LuxQuery.fetch_rows
+SEARCH_FIELDS = ("label", "artist", "dep_name", "classification")
+
+# facets counted over the results, see LuxQuery.facet_counts
+FACETS = ("department", "classifier", "agent")
+
+# orders the results can be sorted in after label and date, see LuxQuery.sort_order
+# (equal agent and classifier terms collapse into the classification column)
+SORT_ORDERS = (("artist", "classification"), ("classification", "artist"),
+               ("classification",))
+
+# LIKE only folds ASCII letters
+_ASCII_LOWER = str.maketrans("ABCDEFGHIJKLMNOPQRSTUVWXYZ", "abcdefghijklmnopqrstuvwxyz")
+
+# reads the rows of QUERY_SEARCH_ROWS from the search index or from the collection itself
+_LOAD_INDEXED = "SELECT id, label, artist, date, dep_name, classification FROM search_rows"
+_LOAD_UNINDEXED = "SELECT * FROM (" + QUERY_SEARCH_ROWS + ")"
+
+engine_log = logging.getLogger("lux.memory")
+
+# engines by database file
+_engines = {}
+_engines_lock = threading.Lock()
+_load_lock = threading.Lock()
+
+# database files whose engine a background thread is loading
+_loading = set()
+
+
+class MemoryBudgetError(Exception):
+    """Exception class to handle a catalog that does not fit in the memory budget."""
+
+
+def fold(value):
+    """Returns the text LIKE compares for a value, with ASCII letters lowercased.
+
+    Args:
+        value: column value, not None
+    Return:
+        str: folded text
+    """
+
+    text = value if isinstance(value, str) else str(value)
+    folded = text.translate(_ASCII_LOWER)
+    # share the string when folding changed nothing
+    return text if folded == text else folded
+
+
+def like_pattern(term):
+    """Returns the regular expression matching what LIKE '%term%' matches.
+
+    Args:
+        term (str): folded search term, may contain the wildcards % and _
+    Return:
+        re.Pattern: pattern to search folded values with
+    """
+
+    parts = []
+    for char in term:
+        if char == "%":
+            parts.append(".*")
+        elif char == "_":
+            parts.append(".")
+        else:
+            parts.append(re.escape(char))
+    return re.compile("".join(parts), re.DOTALL)
+
+
+def sort_key(value):
+    """Returns the key ordering values the way SQLite's ORDER BY does:
+    NULL first, then numbers, then text (by code point), then blobs.
+    """
+
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+
+def value_ranks(values):
+    """Returns the rank of each value in ORDER BY order, equal values sharing a rank.
+
+    Args:
+        values (list): distinct values
+    Return:
+        array: rank by index of the value
+    """
+
+    keys = [sort_key(value) for value in values]
+    ranks = array("I", bytes(4 * len(values)))
+    rank = 0
+    previous = None
+    for index in sorted(range(len(values)), key=keys.__getitem__):
+        if previous is not None and keys[index] != previous:
+            rank += 1
+        ranks[index] = rank
+        previous = keys[index]
+    return ranks
+
+
+def deep_size(value, seen=None):
+    """Returns the bytes taken by a value and the containers and strings it holds,
+    counting objects shared between containers once.
+    """
+
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(key, seen) + deep_size(item, seen)
+                    for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in value)
+    return size
+
+
+class Column():
+    """One dictionary encoded field: the distinct values, the value code of every
+    object and, for searchable fields, a trigram index over the values.
+    """
+
+    __slots__ = ("values", "codes", "extra", "folded", "trigrams", "offsets", "postings")
+
+    def __init__(self):
+        self.values = []
+        self.codes = array("I")
+        # codes of the objects with more than one value, by position (departments)
+        self.extra = {}
+        self.folded = None
+        self.trigrams = None
+        self.offsets = None
+        self.postings = None
+
+    def build_index(self):
+        """Builds the folded values, the trigram index of the values and the posting
+        lists of the objects having each value.
+        """
+
+        self.folded = [None if value is None else fold(value) for value in self.values]
+
+        trigrams = defaultdict(list)
+        for code, text in enumerate(self.folded):
+            if text is not None:
+                for trigram in {text[start:start + 3] for start in range(len(text) - 2)}:
+                    trigrams[trigram].append(code)
+        trigrams = {trigram: array("I", codes) for trigram, codes in trigrams.items()}
+        self.trigrams = trigrams
+
+        # posting lists stored back to back, those of code c are
+        # postings[offsets[c]:offsets[c + 1]]
+        counts = [0] * (len(self.values) + 1)
+        for code, position in self.pairs():
+            counts[code + 1] += 1
+        for code in range(len(self.values)):
+            counts[code + 1] += counts[code]
+        self.offsets = array("I", counts)
+        filled = list(counts[:-1])
+        postings = array("I", bytes(4 * counts[-1]))
+        for code, position in self.pairs():
+            postings[filled[code]] = position
+            filled[code] += 1
+        self.postings = postings
+
+    def pairs(self):
+        """Yields a (code, position) pair for every value of every object."""
+
+        extra = self.extra
+        for position, code in enumerate(self.codes):
+            if position in extra:
+                for other in extra[position]:
+                    yield other, position
+            else:
+                yield code, position
+
+    def matcher(self, term):
+        """Returns how to tell the values LIKE '%term%' matches.
+
+        Terms of three or more characters without wildcards are looked up in the
+        trigram index, which gives the matching values and how many objects have
+        them; other terms are tested against the values one by one when needed.
+
+        Args:
+            term (str): search term
+        Return:
+            tuple: (function telling whether the value with a code matches, set of
+            the matching codes or None if not looked up, number of objects having
+            a matching value or None if not known)
+        """
+
+        term = term.translate(_ASCII_LOWER)
+        folded = self.folded
+        if "%" in term or "_" in term or len(term) < 3:
+            # a term without wildcards is a plain substring
+            search = like_pattern(term).search if "%" in term or "_" in term else None
+
+            def matches(code):
+                text = folded[code]
+                if text is None:
+                    return False
+                if search is None:
+                    return term in text
+                return search(text) is not None
+            return matches, None, None
+
+        # every trigram of the term must occur in a matching value
+        lists = []
+        for start in range(len(term) - 2):
+            codes = self.trigrams.get(term[start:start + 3])
+            if codes is None:
+                return set().__contains__, set(), 0
+            lists.append(codes)
+        lists.sort(key=len)
+        candidates = set(lists[0]).intersection(*lists[1:])
+        codes = {code for code in candidates if term in folded[code]}
+        offsets = self.offsets
+        count = sum(offsets[code + 1] - offsets[code] for code in codes)
+        return codes.__contains__, codes, count
+
+    def positions(self, codes):
+        """Returns the positions of the objects having one of the values with the codes."""
+
+        offsets = self.offsets
+        postings = self.postings
+        positions = set()
+        for code in codes:
+            positions.update(postings[offsets[code]:offsets[code + 1]])
+        return positions
+
+    def position_test(self, matches):
+        """Returns the function telling whether an object has a matching value.
+
+        Args:
+            matches: function telling whether the value with a code matches
+        """
+
+        codes = self.codes
+        extra = self.extra
+        if not extra:
+            return lambda position: matches(codes[position])
+
+        def test(position):
+            if position in extra:
+                return any(map(matches, extra[position]))
+            return matches(codes[position])
+        return test
+
+    def value(self, position):
+        """Returns the value of an object."""
+
+        return self.values[self.codes[position]]
+
+
+class Facet():
+    """The values one facet (departments, classifiers or agent names) has for every
+    object, for counting them over the objects a search matches.
+
+    The first value of every object is in an array (len(values) if it has none), the
+    second ones in a dict by position, and so on, so counting stays in C: one pass
+    over the matching objects plus one over those having more than one value.
+    """
+
+    __slots__ = ("values", "ranks", "layers", "totals")
+
+    def __init__(self, values, codes_by_position, objects):
+        """Builds the facet.
+
+        Args:
+            values (list): distinct values
+            codes_by_position (dict): codes of the distinct values of each object
+                having any, by position
+            objects (int): number of objects
+        """
+
+        self.values = values
+        self.ranks = value_ranks(values)
+        none = len(values)
+        layers = [array("I", [none]) * objects]
+        for position, codes in codes_by_position.items():
+            layers[0][position] = codes[0]
+            for depth, code in enumerate(codes[1:], 1):
+                if depth == len(layers):
+                    layers.append({})
+                layers[depth][position] = code
+        self.layers = layers
+        self.totals = self.count(set(range(objects)))
+
+    def count(self, positions):
+        """Returns the number of objects having each value among the given ones.
+
+        Args:
+            positions (set): objects' positions
+        Return:
+            Counter: number of objects by value code
+        """
+
+        counts = Counter(map(self.layers[0].__getitem__, positions))
+        for layer in self.layers[1:]:
+            # iterates the smaller of the two and looks up the other
+            counts.update(map(layer.__getitem__, positions.intersection(layer)))
+        counts.pop(len(self.values), None)
+        return counts
+
+    def top(self, counts, size):
+        """Returns the most frequent values.
+
+        Args:
+            counts (Counter): number of objects by value code, see count
+            size (int): number of values
+        Return:
+            list: [value, number of objects] pairs, most objects first, then by value
+        """
+
+        # only the values counted at least as often as the size-th one are ordered
+        threshold = 1
+        if len(counts) > size:
+            threshold = max(threshold, sorted(counts.values(), reverse=True)[size - 1])
+        ranks = self.ranks
+        best = sorted(((code, hits) for code, hits in counts.items() if hits >= threshold),
+                      key=lambda item: (-item[1], ranks[item[0]]))
+        return [[self.values[code], hits] for code, hits in best[:size]]
+
+
+class MemoryEngine():
+    """The search rows of one database version, searchable without SQLite."""
+
+    def __init__(self, rows, version, facet_rows=None):
+        """Loads the rows and builds the indexes.
+
+        Args:
+            rows (iterable): (id, label, artist, date, dep_name, classification) rows,
+                one per object and department
+            version (tuple): (size, mtime) of the database the rows were read from
+            facet_rows (dict): (obj_id, value) rows of each facet, see FACETS
+        """
+
+        start = time.perf_counter()
+        self.version = version
+        self.ids = []
+        self.columns = {name: Column() for name in
+                        ("label", "artist", "date", "dep_name", "classification")}
+
+        dictionaries = {name: {} for name in self.columns}
+        positions = {}
+        for row in rows:
+            obj_id = row[0]
+            position = positions.get(obj_id)
+            if position is not None:
+                # another department of an object already loaded
+                dep_column = self.columns["dep_name"]
+                code = self._encode(dictionaries["dep_name"], dep_column.values, row[4])
+                codes = dep_column.extra.setdefault(position, [dep_column.codes[position]])
+                if code not in codes:
+                    codes.append(code)
+                continue
+            positions[obj_id] = len(self.ids)
+            self.ids.append(obj_id)
+            for name, value in zip(("label", "artist", "date", "dep_name", "classification"),
+                                   row[1:]):
+                column = self.columns[name]
+                column.codes.append(self._encode(dictionaries[name], column.values, value))
+        for column in self.columns.values():
+            column.extra = {position: tuple(codes) for position, codes in column.extra.items()}
+        for name in SEARCH_FIELDS:
+            self.columns[name].build_index()
+
+        # position of every object in each sort order, and the objects in that order
+        self.orders = {}
+        id_ranks = value_ranks(self.ids)
+        for order in SORT_ORDERS:
+            names = ("label", "date") + order
+            # the ranks of the values stand in for the values, so the keys are int tuples
+            columns = [self.columns[name] for name in names]
+            rank_columns = [map(value_ranks(column.values).__getitem__, column.codes)
+                            for column in columns]
+            sort_keys = list(zip(*rank_columns, id_ranks))
+            ranked = sorted(range(len(self.ids)), key=sort_keys.__getitem__)
+            del sort_keys
+            keys = self._sort_keys(names)
+            ranks = array("I", bytes(4 * len(ranked)))
+            for rank, position in enumerate(ranked):
+                ranks[position] = rank
+            self.orders[order] = (array("I", ranked), ranks, keys)
+
+        self.facets = {}
+        for name, facet in (facet_rows or {}).items():
+            values = []
+            dictionary = {}
+            codes_by_position = defaultdict(list)
+            for obj_id, value in facet:
+                position = positions.get(obj_id)
+                if position is None:
+                    continue
+                code = self._encode(dictionary, values, value)
+                codes = codes_by_position[position]
+                if code not in codes:
+                    codes.append(code)
+            self.facets[name] = Facet(values, codes_by_position, len(self.ids))
+
+        self.load_seconds = time.perf_counter() - start
+        self._report = None
+
+    @staticmethod
+    def _encode(dictionary, values, value):
+        """Returns the code of a value in a list of distinct values, adding it if it is new."""
+
+        code = dictionary.get((type(value), value))
+        if code is None:
+            code = dictionary[(type(value), value)] = len(values)
+            values.append(value)
+        return code
+
+    def _sort_keys(self, names):
+        """Returns the function computing the ORDER BY key of an object."""
+
+        columns = [self.columns[name] for name in names]
+        ids = self.ids
+
+        def key(position):
+            return tuple(sort_key(column.values[column.codes[position]])
+                         for column in columns) + (sort_key(ids[position]),)
+        return key
+
+    def search(self, dep=None, agt=None, classifier=None, label=None, order=SORT_ORDERS[0],
+               after=None, limit=1000):
+        """Returns the rows the SQL search returns for the same arguments.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            order (tuple): sort order after label and date, see LuxQuery.sort_order
+            after (list): if given, only rows sorting after these sort key values
+            limit (int): maximum number of rows, None for all of them
+        Return:
+            list: (id, label, date, artist, classification) rows, see QUERY_LUX_ROW
+        """
+
+        ranked, ranks, keys = self.orders[order]
+
+        # rank of the first row sorting after the previous page's last row
+        first = 0
+        if after is not None:
+            after_key = tuple(sort_key(value) for value in after)
+            first = bisect_right(ranked, after_key, key=keys)
+
+        tests = []
+        smallest = None
+        for name, term in (("dep_name", dep), ("label", label), ("artist", agt),
+                           ("classification", classifier)):
+            if not term:
+                continue
+            column = self.columns[name]
+            matches, codes, count = column.matcher(term)
+            if count == 0:
+                return []
+            test = column.position_test(matches)
+            if count is not None and (smallest is None or count < smallest[0]):
+                if smallest is not None:
+                    tests.append(smallest[3])
+                smallest = (count, column, codes, test)
+            else:
+                tests.append(test)
+
+        # a term matching few objects gives the candidates, which are then sorted;
+        # otherwise the objects are checked in sort order until the page is full
+        # (about limit / fraction matching checks, less than sorting when the
+        # candidates are more than sqrt(limit * objects)); all the rows are sorted
+        if smallest is not None and (limit is None or smallest[0] ** 2 <= limit * len(ranked)):
+            candidates = smallest[1].positions(smallest[2])
+            matching = (position for position in candidates
+                        if ranks[position] >= first and all(test(position) for test in tests))
+            if limit is None:
+                selected = sorted(matching, key=ranks.__getitem__)
+            else:
+                selected = heapq.nsmallest(limit, matching, key=ranks.__getitem__)
+        else:
+            if smallest is not None:
+                tests.insert(0, smallest[3])
+            selected = []
+            for position in islice(ranked, first, None):
+                for test in tests:
+                    if not test(position):
+                        break
+                else:
+                    selected.append(position)
+                    if len(selected) == limit:
+                        break
+
+        return [self.row(position) for position in selected]
+
+    def matching(self, dep=None, agt=None, classifier=None, label=None):
+        """Returns every object the search matches, not only the first rows.
+
+        The posting lists of the terms looked up in the trigram index are intersected.
+        The other terms are tested on the objects left, or on the distinct values
+        when there are fewer of those, whose posting lists are then intersected too.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+        Return:
+            set: positions of the matching objects, None if there is no term (all of them)
+        """
+
+        found = []
+        untested = []
+        for name, term in (("dep_name", dep), ("label", label), ("artist", agt),
+                           ("classification", classifier)):
+            if not term:
+                continue
+            column = self.columns[name]
+            matches, codes, count = column.matcher(term)
+            if count == 0:
+                return set()
+            if codes is not None:
+                found.append(column.positions(codes))
+            else:
+                untested.append((column, matches))
+        if not found and not untested:
+            return None
+
+        tests = []
+        for column, matches in untested:
+            if found and min(map(len, found)) < len(column.values):
+                tests.append(column.position_test(matches))
+            else:
+                found.append(column.positions(filter(matches, range(len(column.values)))))
+        found.sort(key=len)
+        matched = found[0].intersection(*found[1:])
+        if tests:
+            matched = {position for position in matched
+                       if all(test(position) for test in tests)}
+        return matched
+
+    def facet_counts(self, dep=None, agt=None, classifier=None, label=None, size=10):
+        """Returns the most frequent departments, classifiers and agent names among all
+        the objects the search matches, and the number of those objects.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            size (int): number of values per facet
+        Return:
+            dict: "total" objects and [value, number of objects] pairs of each facet
+        """
+
+        matched = self.matching(dep, agt, classifier, label)
+        objects = len(self.ids)
+        if matched is None:
+            counts = {"total": objects}
+            for name in FACETS:
+                counts[name] = self.facets[name].top(self.facets[name].totals, size)
+            return counts
+
+        # when most objects match, count the others and subtract them from the totals
+        rest = None
+        if 2 * len(matched) > objects:
+            rest = set(range(objects)).difference(matched)
+        counts = {"total": len(matched)}
+        for name in FACETS:
+            facet = self.facets[name]
+            if rest is None:
+                facet_counts = facet.count(matched)
+            else:
+                facet_counts = facet.totals.copy()
+                facet_counts.subtract(facet.count(rest))
+            counts[name] = facet.top(facet_counts, size)
+        return counts
+
+    def row(self, position):
+        """Returns the search row of an object.
+
+        Args:
+            position (int): the object's position
+        Return:
+            tuple: (id, label, date, artist, classification)
+        """
+
+        columns = self.columns
+        return (self.ids[position],
+                columns["label"].value(position),
+                columns["date"].value(position),
+                columns["artist"].value(position),
+                columns["classification"].value(position))
+
+    def memory_report(self):
+        """Returns the bytes taken by each part of the engine, measured once.
+
+        Return:
+            dict: bytes by part, their total and the number of objects and values
+        """
+
+        if self._report is not None:
+            return self._report
+
+        seen = set()
+        parts = {"ids": deep_size(self.ids, seen)}
+        for name, column in self.columns.items():
+            parts[f"{name}.values"] = deep_size(column.values, seen)
+            parts[f"{name}.codes"] = (deep_size(column.codes, seen)
+                                      + deep_size(column.extra, seen))
+            if column.trigrams is not None:
+                parts[f"{name}.folded"] = deep_size(column.folded, seen)
+                parts[f"{name}.trigrams"] = deep_size(column.trigrams, seen)
+                parts[f"{name}.postings"] = (sys.getsizeof(column.offsets)
+                                             + sys.getsizeof(column.postings))
+        for name, facet in self.facets.items():
+            parts[f"facets.{name}"] = (deep_size(facet.values, seen)
+                                       + sum(deep_size(layer, seen) for layer in facet.layers)
+                                       + deep_size(facet.totals, seen))
+        parts["orders"] = sum(sys.getsizeof(ranked) + sys.getsizeof(ranks)
+                              for ranked, ranks, _ in self.orders.values())
+        self._report = {
+            "objects": len(self.ids),
+            "values": {name: len(column.values) for name, column in self.columns.items()},
+            "bytes": parts,
+            "total_bytes": sum(parts.values()),
+            "load_seconds": round(self.load_seconds, 3),
+        }
+        return self._report
+
+
+def load_rows(db_file):
+    """Generator yielding the search rows of a database, read from its search index
+    when it has one.
+
+    Raises:
+        OperationalError: if the database can not be read
+    """
+
+    index_file = ensure_index(db_file, wait=True)
+    if index_file is not None:
+        source, smt_str = index_file, _LOAD_INDEXED
+    else:
+        source, smt_str = db_file, _LOAD_UNINDEXED
+    with closing(connect(f"file:{source}?mode=ro", uri=True)) as connection:
+        yield from connection.execute(smt_str)
+
+
+def load_facet_rows(db_file, facet):
+    """Generator yielding the (obj_id, value) rows of a facet of a database.
+
+    Raises:
+        OperationalError: if the database can not be read
+    """
+
+    with closing(connect(f"file:{db_file}?mode=ro", uri=True)) as connection:
+        yield from connection.execute(QUERY_FACET_VALUES[facet])
+
+
+def estimate_bytes(db_file):
+    """Returns the fewest bytes the engine of a database can take, from its number of
+    objects.
+
+    Raises:
+        OperationalError: if the database can not be read
+    """
+
+    with closing(connect(f"file:{db_file}?mode=ro", uri=True)) as connection:
+        objects = connection.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+    return objects * MIN_OBJECT_BYTES
+
+
+def load_engine(db_file, budget=None):
+    """Loads the engine of a database.
+
+    Args:
+        db_file (str): database file
+        budget (int): bytes the engine may take, ENGINE_SETTINGS["budget"] by default
+    Return:
+        MemoryEngine: the engine
+    Raises:
+        OperationalError: if the database can not be read
+        MemoryBudgetError: if the engine takes more than the budget, before loading it
+            when its estimated size already does
+    """
+
+    if budget is None:
+        budget = ENGINE_SETTINGS["budget"]
+    estimate = estimate_bytes(db_file)
+    if estimate > budget:
+        raise MemoryBudgetError(
+            f"search engine of {db_file} takes at least {estimate} bytes, over the budget"
+            f" of {budget}")
+    version = source_signature(db_file)
+    engine = MemoryEngine(load_rows(db_file), version,
+                          {facet: load_facet_rows(db_file, facet) for facet in FACETS})
+    total = engine.memory_report()["total_bytes"]
+    if total > budget:
+        raise MemoryBudgetError(
+            f"search engine of {db_file} takes {total} bytes, over the budget of {budget}")
+    return engine
+
+
+def get_engine(db_file, wait=False):
+    """Returns the engine of the current version of a database, loading it if needed.
+
+    Unless wait is True, a missing engine is loaded by a background thread and None
+    is returned meanwhile, so the search runs with SQL instead of waiting. Only one
+    engine is loaded at a time. A database whose engine does not fit in the budget is
+    searched with SQL until it changes.
+
+    Args:
+        db_file (str): database file
+        wait (bool): True to wait for the engine to be loaded
+    Return:
+        MemoryEngine: the engine, None if it is not available
+    """
+
+    try:
+        version = source_signature(db_file)
+    except OSError:
+        return None
+
+    entry = _engines.get(db_file)
+    if entry is not None and entry["version"] == version:
+        return entry["engine"]
+    if wait:
+        return _load(db_file, version)
+
+    with _engines_lock:
+        if db_file in _loading:
+            return None
+        _loading.add(db_file)
+    threading.Thread(target=_load_in_background, args=(db_file, version),
+                     name="lux-memory", daemon=True).start()
+    return None
+
+
+def _load(db_file, version):
+    """Loads the engine of a database version unless it is already loaded.
+
+    Return:
+        MemoryEngine: the engine, None if it could not be loaded
+    """
+
+    with _load_lock:
+        entry = _engines.get(db_file)
+        if entry is not None and entry["version"] == version:
+            return entry["engine"]
+        try:
+            engine = load_engine(db_file)
+            error = None
+        except (MemoryBudgetError, OperationalError) as err_message:
+            engine_log.warning("searching %s with SQL: %s", db_file, err_message)
+            engine, error = None, str(err_message)
+        with _engines_lock:
+            _engines[db_file] = {"version": version, "engine": engine, "error": error}
+        return engine
+
+
+def _load_in_background(db_file, version):
+    """Body of the thread started by get_engine."""
+
+    try:
+        _load(db_file, version)
+    finally:
+        with _engines_lock:
+            _loading.discard(db_file)
+
+
+def _reset_after_fork():
+    """Forgets the background threads of the parent, which do not exist in a child."""
+
+    global _engines_lock, _load_lock  # pylint: disable=global-statement
+    _engines_lock = threading.Lock()
+    _load_lock = threading.Lock()
+    _loading.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def unload_engine(db_file):
+    """Forgets the engine of a database file no longer read, such as an old snapshot.
+
+    Args:
+        db_file (str): database file
+    """
+
+    with _engines_lock:
+        _engines.pop(db_file, None)
+
+
+def configure(**settings):
+    """Changes the engine settings.
+
+    Args:
+        settings: any of engine, budget
+    """
+
+    unknown = set(settings) - set(ENGINE_SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown engine settings: {', '.join(sorted(unknown))}")
+    if settings.get("engine", ENGINES[0]) not in ENGINES:
+        raise ValueError(f"unknown engine: {settings['engine']}")
+    ENGINE_SETTINGS.update(settings)
+
+
+def engine_stats():
+    """Returns the engine in use and the memory report of every loaded engine."""
+
+    engines = {}
+    for db_file, entry in list(_engines.items()):
+        if entry["engine"] is not None:
+            engines[db_file] = entry["engine"].memory_report()
+        else:
+            engines[db_file] = {"error": entry["error"]}
+    return {"engine": ENGINE_SETTINGS["engine"], "budget_bytes": ENGINE_SETTINGS["budget"],
+            "databases": engines}
+
+
+def main():
+    """Command line entry point: loads a database's engine and prints its memory report."""
+
+    parser = argparse.ArgumentParser(
+        prog='lux_memory.py', allow_abbrev=False,
+        description='Report the memory taken by the in-memory search engine')
+    parser.add_argument(
+        "database", nargs="?", default="./lux.sqlite",
+        help="the collection database to load (default: ./lux.sqlite)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print(f"error: database {args.database} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        engine = load_engine(args.database, budget=float("inf"))
+    except OperationalError as err_message:
+        print(f"error: unable to load database: {err_message}", file=sys.stderr)
+        sys.exit(1)
+
+    report = engine.memory_report()
+    report["budget_bytes"] = ENGINE_SETTINGS["budget"]
+    report["fits_budget"] = report["total_bytes"] <= ENGINE_SETTINGS["budget"]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,191 @@
+"""Module for timing the stages of a request: Server-Timing spans, Prometheus
+histograms and the slow query log.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlite3 import OperationalError
+
+# upper bounds (seconds) of the histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# statements running at least this long are logged with their query plan
+SLOW_QUERY_SECONDS = float(os.environ.get("LUX_SLOW_QUERY_MS", "250")) / 1000
+
+slow_query_log = logging.getLogger("lux.slow_query")
+
+# span durations of the request being handled, None outside a request
+_timings = ContextVar("lux_timings", default=None)
+
+
+class Histogram():
+    """Thread-safe histogram with one series per label value, in Prometheus's layout."""
+
+    def __init__(self, name, description, label, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.label = label
+        self._buckets = buckets
+        self._lock = threading.Lock()
+        # label value -> [bucket counts, sum, count]
+        self._series = {}
+
+    def observe(self, label_value, seconds):
+        """Records one observation."""
+
+        index = bisect_left(self._buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self._buckets), 0.0, 0]
+            if index < len(self._buckets):
+                series[0][index] += 1
+            series[1] += seconds
+            series[2] += 1
+
+    def render(self):
+        """Returns the histogram in the Prometheus text exposition format."""
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {value: (list(counts), total, count)
+                      for value, (counts, total, count) in self._series.items()}
+        for value, (counts, total, count) in sorted(series.items()):
+            label = f'{self.label}="{escape_label(value)}"'
+            cumulative = 0
+            for bound, bucket_count in zip(self._buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{{{label}}} {total}")
+            lines.append(f"{self.name}_count{{{label}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+SPANS = Histogram("lux_span_seconds", "Time spent in each stage of a request.", "span")
+REQUESTS = Histogram("lux_request_seconds", "Time spent handling a request, by route.",
+                     "endpoint")
+
+_slow_queries = [0]
+_slow_queries_lock = threading.Lock()
+
+
+def escape_label(value):
+    """Escapes a label value for the Prometheus text format."""
+
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def start_request():
+    """Starts collecting the span durations of a new request.
+
+    Return:
+        dict: the durations (seconds) by span name, filled in as the request runs
+    """
+
+    timings = {}
+    _timings.set(timings)
+    return timings
+
+
+def add_time(name, seconds):
+    """Adds to the duration of a span of the current request, without observing it
+    in the histogram (see observe), for spans measured in several pieces.
+    """
+
+    timings = _timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+def observe(name, seconds):
+    """Records the total duration of one span in the histogram."""
+
+    SPANS.observe(name, seconds)
+
+
+@contextmanager
+def span(name):
+    """Context manager timing the code inside it as a span of the current request."""
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        add_time(name, seconds)
+        observe(name, seconds)
+
+
+def observe_request(endpoint, seconds):
+    """Records the duration of a whole request."""
+
+    REQUESTS.observe(endpoint or "none", seconds)
+
+
+def server_timing(timings, total=None):
+    """Returns the value of a Server-Timing header.
+
+    Args:
+        timings (dict): durations in seconds by span name
+        total (float): duration of the whole request so far, in seconds
+    Return:
+        str: e.g. "sql;dur=1.204, render;dur=0.310, total;dur=1.730"
+    """
+
+    parts = [f"{name};dur={seconds * 1000:.3f}" for name, seconds in timings.items()]
+    if total is not None:
+        parts.append(f"total;dur={total * 1000:.3f}")
+    return ", ".join(parts)
+
+
+def log_slow_query(cursor, smt_str, smt_params, seconds):
+    """Logs a statement that took SLOW_QUERY_SECONDS or longer, with its parameters and
+    query plan.
+
+    Args:
+        cursor: cursor of the connection the statement ran on; it is reused to
+            explain the statement, so the statement's rows must have been read
+        smt_str (str): the SQL statement
+        smt_params (list): its parameters
+        seconds (float): time spent executing it and reading its rows
+    """
+
+    if seconds < SLOW_QUERY_SECONDS:
+        return
+
+    with _slow_queries_lock:
+        _slow_queries[0] += 1
+
+    try:
+        cursor.execute(f"EXPLAIN QUERY PLAN {smt_str}", smt_params)
+        plan_rows = cursor.fetchall()
+    except OperationalError as err_message:
+        plan = f"  (no plan: {err_message})"
+    else:
+        depth = {0: 0}
+        lines = []
+        for node_id, parent, _, detail in plan_rows:
+            depth[node_id] = depth.get(parent, 0) + 1
+            lines.append(f"{'  ' * depth[node_id]}{detail}")
+        plan = "\n".join(lines)
+
+    slow_query_log.warning("slow query (%.1f ms): %s\nparams: %r\nplan:\n%s",
+                           seconds * 1000, " ".join(smt_str.split()), smt_params, plan)
+
+
+def render_prometheus():
+    """Returns every metric of this process in the Prometheus text exposition format."""
+
+    with _slow_queries_lock:
+        slow_queries = _slow_queries[0]
+    return (SPANS.render() + REQUESTS.render()
+            + "# HELP lux_slow_queries_total Statements logged as slow queries.\n"
+            + "# TYPE lux_slow_queries_total counter\n"
+            + f"lux_slow_queries_total {slow_queries}\n")
@@ -0,0 +1,261 @@
+"""Module for the pool of read-only SQLite connections shared across requests."""
+
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+from sqlite3 import connect
+
+# default number of connections kept open per database file
+POOL_SIZE = 8
+
+# exports hold their connection for a whole download (see LuxQuery.export_rows), so
+# they get a small pool of their own: at most EXPORT_POOL_SIZE run at once per database
+# file, and another export waits up to EXPORT_TIMEOUT seconds for a connection
+EXPORT_POOL_SIZE = 2
+EXPORT_TIMEOUT = 5.0
+
+# (maximum number of connections, seconds to wait for one) of each kind of pool
+POOL_KINDS = {"search": (POOL_SIZE, None), "export": (EXPORT_POOL_SIZE, EXPORT_TIMEOUT)}
+
+# PRAGMAs applied to every pooled connection
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE_KIB = 64 * 1024
+
+# number of prepared statements each connection keeps for reuse
+CACHED_STATEMENTS = 256
+
+# pools by kind and database file, reset in forked children (see _reset_after_fork)
+_pools = {kind: {} for kind in POOL_KINDS}
+_pools_lock = threading.Lock()
+
+# connections inherited from a parent process; they must never be used or
+# closed in the child, so they are kept referenced here instead
+_orphaned = []
+
+
+class PoolTimeoutError(Exception):
+    """Exception class raised when no pooled connection became free in time."""
+
+
+class ConnectionPool():
+    """Thread-safe pool of long-lived, read-only connections to one database file.
+
+    Connections are opened with mode=ro and immutable=1, so SQLite skips locking and
+    change detection. The pool instead watches the file itself: when it is replaced
+    or modified, idle connections are closed and new ones are opened on the next
+    checkout, while connections checked out at that moment finish on the old file.
+    """
+
+    def __init__(self, db_file, max_size=POOL_SIZE, timeout=None):
+        """Initializes an empty pool; connections are opened on demand.
+
+        Args:
+            db_file (str): database file
+            max_size (int): maximum number of open connections
+            timeout (float): seconds to wait for a free connection, None waits forever
+        """
+
+        self._db_file = db_file
+        self._max_size = max_size
+        self._timeout = timeout
+        self._reset()
+
+    def _reset(self):
+        """(Re)initializes the pool state, dropping all connections."""
+
+        self._pid = os.getpid()
+        self._cond = threading.Condition(threading.Lock())
+        self._idle = []
+        self._open = 0
+        self._generation = 0
+        self._signature = None
+        self._stats = {"checkouts": 0, "waits": 0, "opened": 0,
+                       "closed": 0, "reopens": 0, "wait_seconds": 0.0}
+
+    def _file_signature(self):
+        """Returns the (inode, size, mtime) triple identifying the file's contents."""
+
+        try:
+            stat = os.stat(self._db_file)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _open_connection(self):
+        """Opens and tunes a new read-only connection."""
+
+        connection = connect(f"file:{self._db_file}?mode=ro&immutable=1",
+                             isolation_level=None, uri=True, check_same_thread=False,
+                             cached_statements=CACHED_STATEMENTS)
+        connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        connection.execute(f"PRAGMA cache_size = -{CACHE_SIZE_KIB}")
+        connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    def _checkout(self):
+        """Takes a connection out of the pool, opening one if allowed.
+
+        Return:
+            tuple: (connection, generation it belongs to)
+        """
+
+        if self._pid != os.getpid():
+            _orphaned.extend(self._idle)
+            self._reset()
+
+        signature = self._file_signature()
+        with self._cond:
+            self._stats["checkouts"] += 1
+
+            # the file changed under us: retire every connection opened on it
+            if signature != self._signature:
+                if self._signature is not None:
+                    self._stats["reopens"] += 1
+                self._signature = signature
+                self._generation += 1
+                self._discard(self._idle)
+                self._idle = []
+
+            if not self._idle and self._open >= self._max_size:
+                self._stats["waits"] += 1
+                waited = time.monotonic()
+                if not self._cond.wait_for(
+                        lambda: self._idle or self._open < self._max_size, self._timeout):
+                    raise PoolTimeoutError(
+                        f"no connection to {self._db_file} became free in time")
+                self._stats["wait_seconds"] += time.monotonic() - waited
+
+            generation = self._generation
+            if self._idle:
+                return self._idle.pop(), generation
+            self._open += 1
+
+        try:
+            connection = self._open_connection()
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+
+        with self._cond:
+            self._stats["opened"] += 1
+        return connection, generation
+
+    def _checkin(self, connection, generation):
+        """Returns a connection to the pool, closing it if its file has been replaced."""
+
+        if self._pid != os.getpid():
+            _orphaned.append(connection)
+            return
+
+        # never hand out a connection with a transaction left open
+        if connection.in_transaction:
+            connection.rollback()
+
+        with self._cond:
+            if generation == self._generation:
+                self._idle.append(connection)
+            else:
+                self._discard([connection])
+            self._cond.notify()
+
+    def _discard(self, connections):
+        """Closes connections that belong to the pool. Caller must hold the lock."""
+
+        for connection in connections:
+            connection.close()
+            self._open -= 1
+            self._stats["closed"] += 1
+
+    @contextmanager
+    def connection(self):
+        """Context manager lending out a pooled connection for the duration of the block."""
+
+        connection, generation = self._checkout()
+        try:
+            yield connection
+        finally:
+            self._checkin(connection, generation)
+
+    def stats(self):
+        """Returns a snapshot of the pool's counters.
+
+        Return:
+            dict: checkouts, waits, open/idle/in-use connections and more
+        """
+
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update({
+                "db_file": self._db_file,
+                "max_size": self._max_size,
+                "open": self._open,
+                "idle": len(self._idle),
+                "in_use": self._open - len(self._idle),
+            })
+        return stats
+
+    def close(self):
+        """Closes all idle connections; checked-out ones are closed on return."""
+
+        with self._cond:
+            self._generation += 1
+            self._discard(self._idle)
+            self._idle = []
+
+
+def get_pool(db_file, kind="search"):
+    """Returns the process-wide pool for the given database file, creating it if needed.
+
+    Args:
+        db_file (str): database file
+        kind (str): "search" for searches and object details, "export" for exports
+    Return:
+        ConnectionPool: the pool
+    """
+
+    pool = _pools[kind].get(db_file)
+    if pool is None:
+        max_size, timeout = POOL_KINDS[kind]
+        with _pools_lock:
+            pool = _pools[kind].setdefault(db_file, ConnectionPool(db_file, max_size, timeout))
+    return pool
+
+
+def close_pool(db_file):
+    """Closes and forgets the pools of a database file no longer read, such as an old
+    snapshot; connections still checked out are closed when they are returned.
+
+    Args:
+        db_file (str): database file
+    """
+
+    with _pools_lock:
+        pools = [pools.pop(db_file, None) for pools in _pools.values()]
+    for pool in pools:
+        if pool is not None:
+            pool.close()
+
+
+def pool_stats(kind="search"):
+    """Returns the stats of every pool of a kind in this process, keyed by database file."""
+
+    return {db_file: pool.stats() for db_file, pool in list(_pools[kind].items())}
+
+
+def _reset_after_fork():
+    """Gives a forked child fresh pools; inherited connections are never touched."""
+
+    global _pools_lock  # pylint: disable=global-statement
+    _pools_lock = threading.Lock()
+    for pools in _pools.values():
+        for pool in pools.values():
+            _orphaned.extend(pool._idle)  # pylint: disable=protected-access
+            pool._reset()  # pylint: disable=protected-access
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
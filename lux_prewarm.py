@@ -0,0 +1,73 @@
+"""Module for prewarming the object detail cache with the most viewed objects."""
+
+import re
+import sys
+
+from collections import Counter
+from sqlite3 import OperationalError
+
+from query import LuxDetailsQuery, NoSearchResultsError
+
+# object id of a request for a detail page (html or api) in an access log line
+OBJ_REQUEST = re.compile(r'"GET /(?:api/)?obj/([^/?\s"]+)')
+
+
+def read_access_log(log_file, top=100):
+    """Returns the ids of the most requested detail pages in an access log.
+
+    Args:
+        log_file (str): access log in common/combined log format (as written by werkzeug)
+        top (int): number of ids to return
+    Return:
+        list: object ids, most requested first
+    """
+
+    counts = Counter()
+    with open(log_file, encoding="utf-8", errors="replace") as log:
+        for line in log:
+            match = OBJ_REQUEST.search(line)
+            if match:
+                counts[match.group(1)] += 1
+    return [obj_id for obj_id, _ in counts.most_common(top)]
+
+
+def read_id_list(list_file, top=None):
+    """Returns the object ids listed in a file, one per line; blank lines and lines
+    starting with # are skipped.
+
+    Args:
+        list_file (str): file with one object id per line
+        top (int): number of ids to return, None for all
+    Return:
+        list: object ids in the order they are listed
+    """
+
+    with open(list_file, encoding="utf-8") as ids:
+        object_ids = [line.strip() for line in ids
+                      if line.strip() and not line.startswith("#")]
+    return object_ids[:top] if top is not None else object_ids
+
+
+def prewarm(db_file, object_ids):
+    """Loads the details of the given objects into the detail cache.
+
+    Args:
+        db_file (str): database file
+        object_ids (list): object ids to load
+    Return:
+        int: number of objects loaded; ids of missing objects are skipped
+    """
+
+    loaded = 0
+    query = LuxDetailsQuery(db_file)
+    for obj_id in object_ids:
+        try:
+            query.search_results(obj_id)
+        except NoSearchResultsError:
+            continue
+        except OperationalError as err_message:
+            print(f"Prewarming stopped, database {db_file} unable to open: {err_message}",
+                  file=sys.stderr)
+            break
+        loaded += 1
+    return loaded
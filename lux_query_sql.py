@@ -1,6 +1,10 @@
 """Module for main query in LuxQuery class in query.py."""
 
-QUERY_LUX = """WITH classifier AS (
+from itertools import product
+
+# the tables QUERY_LUX and QUERY_SEARCH_ROWS select from: every object with its
+# classifiers and agents concatenated, once per department
+QUERY_LUX_FROM = """WITH classifier AS (
     SELECT id, group_concat(cls_name, ', ') as classification FROM (
         SELECT objects.id, LOWER(classifiers.name) AS cls_name
         FROM objects
@@ -24,10 +28,308 @@ department as (
         LEFT OUTER JOIN departments ON departments.id = objects_departments.dep_id
 )
 
-SELECT objects.id, objects.label, agent.artist, 
-objects.date,  department.dep_name, classifier.classification
-FROM objects
+"""
+
+QUERY_LUX_JOINS = """FROM objects
 LEFT OUTER JOIN classifier ON classifier.id = objects.id
 LEFT OUTER JOIN agent ON agent.id = objects.id
 LEFT OUTER JOIN department ON department.id = objects.id
 """
+
+# the search selects the columns in the order they are shown (QUERY_LUX_ROW), so
+# its rows are returned and rendered as they come out of the database
+QUERY_LUX = QUERY_LUX_FROM + """SELECT objects.id, objects.label, objects.date, agent.artist,
+classifier.classification
+""" + QUERY_LUX_JOINS
+
+# every column of the rows, including the department searched on
+QUERY_SEARCH_ROWS = QUERY_LUX_FROM + """SELECT objects.id, objects.label, agent.artist,
+objects.date, department.dep_name, classifier.classification
+""" + QUERY_LUX_JOINS
+
+# denormalized copy of the rows produced by QUERY_SEARCH_ROWS plus a full-text index over
+# it, stored in a separate database file next to the collection (see lux_index.py).
+# The columns are left untyped so every value keeps the type (and therefore the
+# sort order) it has in the collection database.
+CREATE_SEARCH_ROWS = """CREATE TABLE search_rows (
+    id, label, artist, date, dep_name, classification,
+    sort_artist INTEGER, sort_classification INTEGER, sort_classification_only INTEGER
+)"""
+
+BUILD_SEARCH_ROWS = """INSERT INTO search_rows (id, label, artist, date, dep_name, classification)
+SELECT * FROM (""" + QUERY_SEARCH_ROWS + """)"""
+
+# numbers the objects in both sort orders of the results (see QUERY_LUX_INDEXED_RANKS).
+# The ranks are computed by sorting search_rows itself, so they follow the same
+# type order and collation as an ORDER BY on its columns; the rows an object has
+# for each of its departments share its rank.
+RANK_SEARCH_ROWS = """UPDATE search_rows
+SET sort_artist = ranks.sort_artist, sort_classification = ranks.sort_classification,
+sort_classification_only = ranks.sort_classification_only
+FROM (
+    SELECT rowid AS row_id,
+    DENSE_RANK() OVER (ORDER BY label, date, artist, classification, id) AS sort_artist,
+    DENSE_RANK() OVER (ORDER BY label, date, classification, artist, id) AS sort_classification,
+    DENSE_RANK() OVER (ORDER BY label, date, classification, id) AS sort_classification_only
+    FROM search_rows
+) AS ranks
+WHERE search_rows.rowid = ranks.row_id"""
+
+INDEX_SEARCH_ROWS = [
+    "CREATE INDEX search_rows_id ON search_rows (id)",
+    "CREATE INDEX search_rows_label_date ON search_rows (label, date)",
+    "CREATE INDEX search_rows_sort_artist ON search_rows (sort_artist)",
+    "CREATE INDEX search_rows_sort_classification ON search_rows (sort_classification)",
+    ("CREATE INDEX search_rows_sort_classification_only "
+     "ON search_rows (sort_classification_only)"),
+]
+
+CREATE_SEARCH_INDEX = """CREATE VIRTUAL TABLE search_fts USING fts5(
+    label, artist, dep_name, classification,
+    content = 'search_rows', tokenize = 'trigram'
+)"""
+
+BUILD_SEARCH_INDEX = "INSERT INTO search_fts (search_fts) VALUES ('rebuild')"
+
+CREATE_SEARCH_META = "CREATE TABLE search_meta (key TEXT PRIMARY KEY, value)"
+
+QUERY_LUX_INDEXED = """SELECT id, label, date, artist, classification
+FROM search_rows
+"""
+
+QUERY_LUX_INDEXED_MATCH = "rowid IN (SELECT rowid FROM search_fts WHERE search_fts MATCH ?)"
+
+# whether a MATCH expression matches at least a number of rows
+QUERY_LUX_INDEXED_MATCH_COUNT = """SELECT COUNT(*) FROM (
+    SELECT rowid FROM search_fts WHERE search_fts MATCH ? LIMIT ?)"""
+
+# columns of the rows returned by QUERY_LUX and QUERY_LUX_INDEXED, in order
+QUERY_LUX_ROW = ("id", "label", "date", "artist", "classification")
+
+# column names used by LuxQuery when filtering and sorting either query
+QUERY_LUX_COLUMNS = {
+    "id": "objects.id",
+    "label": "objects.label",
+    "date": "objects.date",
+    "artist": "agent.artist",
+    "classification": "classifier.classification",
+    "dep_name": "department.dep_name",
+}
+
+QUERY_LUX_INDEXED_COLUMNS = {
+    "id": "id",
+    "label": "label",
+    "date": "date",
+    "artist": "artist",
+    "classification": "classification",
+    "dep_name": "dep_name",
+}
+
+# the rank column of search_rows numbering the rows in each sort order (see
+# LuxQuery.sort_order), after label and date and before the object id; equal
+# agent and classifier terms collapse into the classification column
+QUERY_LUX_INDEXED_RANKS = {
+    ("artist", "classification"): "sort_artist",
+    ("classification", "artist"): "sort_classification",
+    ("classification",): "sort_classification_only",
+}
+
+# the search terms, in the order of their LIKE predicates and parameters
+QUERY_LUX_FILTERS = ("dep_name", "label", "artist", "classification")
+
+# the WHERE clause of every combination of search terms, built once at import instead
+# of on every search; keyed by (indexed, whether each of QUERY_LUX_FILTERS is given)
+QUERY_LUX_WHERE = {
+    (indexed, given): (" WHERE " if any(given) else "") + " AND ".join(
+        f"{columns[name]} LIKE ?" for name, present in zip(QUERY_LUX_FILTERS, given)
+        if present)
+    for indexed, columns in ((False, QUERY_LUX_COLUMNS), (True, QUERY_LUX_INDEXED_COLUMNS))
+    for given in product((False, True), repeat=len(QUERY_LUX_FILTERS))
+}
+
+# the values of each facet of the search results, as (obj_id, value) pairs; the
+# classifiers are lowercased as in the classification column
+QUERY_FACET_VALUES = {
+    "department": """SELECT objects_departments.obj_id AS obj_id, departments.name AS value
+FROM objects_departments
+JOIN departments ON departments.id = objects_departments.dep_id
+WHERE departments.name IS NOT NULL""",
+    "classifier": """SELECT objects_classifiers.obj_id AS obj_id, LOWER(classifiers.name) AS value
+FROM objects_classifiers
+JOIN classifiers ON classifiers.id = objects_classifiers.cls_id
+WHERE classifiers.name IS NOT NULL""",
+    "agent": """SELECT productions.obj_id AS obj_id, agents.name AS value
+FROM productions
+JOIN agents ON agents.id = productions.agt_id
+WHERE agents.name IS NOT NULL""",
+}
+
+# the facet values of every object, copied into the search index so the facets of a
+# search are counted without the collection database: each value once in
+# facet_values, numbered in (facet, value) order and with its number of objects, and
+# the distinct (value, object) pairs in search_facets
+CREATE_SEARCH_FACETS = [
+    "CREATE TABLE facet_values (code INTEGER PRIMARY KEY, facet TEXT, value, objects INTEGER)",
+    "CREATE TABLE search_facets (code INTEGER, obj_id)",
+]
+
+# (facet, obj_id, value) rows of every facet of the collection
+QUERY_FACET_ROWS = "\nUNION ALL\n".join(
+    f"SELECT '{facet}' AS facet, obj_id, value FROM ({values})"
+    for facet, values in QUERY_FACET_VALUES.items())
+
+BUILD_SEARCH_FACETS = [
+    "CREATE TEMP TABLE facet_rows AS " + QUERY_FACET_ROWS,
+    """INSERT INTO facet_values (facet, value)
+SELECT DISTINCT facet, value FROM temp.facet_rows ORDER BY facet, value""",
+    """INSERT INTO search_facets (code, obj_id)
+SELECT DISTINCT facet_values.code, facet_rows.obj_id
+FROM temp.facet_rows JOIN facet_values USING (facet, value)""",
+    "DROP TABLE temp.facet_rows",
+    """UPDATE facet_values SET objects = counts.objects
+FROM (SELECT code, COUNT(*) AS objects FROM search_facets GROUP BY code) AS counts
+WHERE facet_values.code = counts.code""",
+    "CREATE INDEX search_facets_obj_id ON search_facets (obj_id, code)",
+]
+
+# the number of objects a search matches and of objects in the index, followed by
+# the WHERE clause of QUERY_LUX_WHERE (and QUERY_LUX_INDEXED_MATCH) and ")"
+QUERY_FACET_TOTAL = """SELECT (SELECT value FROM search_meta WHERE key = 'objects'),
+(SELECT COUNT(DISTINCT id) FROM search_rows"""
+
+# the number of matching objects with each facet value, as the CTE "counts": from
+# the values of the matches when they are few, otherwise from the totals of the
+# values minus their counts among the objects not matching; followed by the WHERE
+# clause of QUERY_LUX_WHERE (and QUERY_LUX_INDEXED_MATCH) and ")"
+QUERY_FACET_MATCHES_INDEXED = {
+    False: """WITH counts AS (
+    SELECT code, COUNT(*) AS hits FROM search_facets
+    WHERE obj_id IN (SELECT id FROM search_rows""",
+    True: """WITH others AS (
+    SELECT id FROM search_rows EXCEPT SELECT id FROM search_rows""",
+}
+
+QUERY_FACET_COUNTS_INDEXED = {
+    False: """) GROUP BY code)""",
+    True: """),
+counts AS (
+    SELECT facet_values.code, facet_values.objects - COALESCE(others.hits, 0) AS hits
+    FROM facet_values
+    LEFT JOIN (
+        SELECT code, COUNT(*) AS hits FROM search_facets
+        WHERE obj_id IN (SELECT id FROM others) GROUP BY code
+    ) AS others USING (code)
+)""",
+}
+
+# follows the CTE "counts": the most frequent values of each facet among the
+# matches, most objects first and then by value, as (facet, value, objects) rows
+QUERY_FACET_TOP_INDEXED = """
+SELECT facet, value, hits FROM (
+    SELECT facet_values.facet, facet_values.value, counts.hits,
+    ROW_NUMBER() OVER (PARTITION BY facet_values.facet
+                       ORDER BY counts.hits DESC, facet_values.value) AS position
+    FROM counts JOIN facet_values USING (code)
+    WHERE counts.hits > 0
+) WHERE position <= ?
+ORDER BY facet, position"""
+
+# the ids of the objects a search matches in the collection, as the CTE "matches":
+# the WHERE clause of QUERY_LUX_WHERE is appended, followed by ")"
+QUERY_FACET_MATCHES = QUERY_LUX_FROM + """, matches AS (SELECT DISTINCT objects.id AS id
+""" + QUERY_LUX_JOINS
+
+# follows the CTE "matches": the most frequent values of each facet among the
+# matches, as in QUERY_FACET_TOP_INDEXED, preceded by a (NULL, NULL, number of
+# matches) row
+QUERY_FACET_COUNTS = """,
+facet_rows AS (""" + QUERY_FACET_ROWS + """),
+counts AS (
+    SELECT facet_rows.facet, facet_rows.value, COUNT(DISTINCT facet_rows.obj_id) AS hits
+    FROM matches JOIN facet_rows ON facet_rows.obj_id = matches.id
+    GROUP BY facet_rows.facet, facet_rows.value
+)
+SELECT NULL, NULL, COUNT(*) FROM matches
+UNION ALL
+SELECT facet, value, hits FROM (
+    SELECT facet, value, hits,
+    ROW_NUMBER() OVER (PARTITION BY facet ORDER BY hits DESC, value) AS position
+    FROM counts
+) WHERE position <= ?
+ORDER BY 1, 3 DESC, 2"""
+
+# queries for LuxDetailsQuery, one per relation of the object, so the row count
+# grows with the sum rather than the product of the relations' sizes
+QUERY_DETAILS_OBJECT = """SELECT objects.label, objects.accession_no, objects.date
+FROM objects WHERE objects.id = ?"""
+
+QUERY_DETAILS_AGENTS = """SELECT productions.part, agents.name, agents.begin_date,
+agents.end_date, agents.id
+FROM productions
+LEFT OUTER JOIN agents ON productions.agt_id = agents.id
+WHERE productions.obj_id = ?"""
+
+QUERY_DETAILS_NATIONALITIES = """SELECT agents.id, nationalities.descriptor
+FROM productions
+JOIN agents ON productions.agt_id = agents.id
+JOIN agents_nationalities ON agents_nationalities.agt_id = agents.id
+LEFT OUTER JOIN nationalities ON nationalities.id = agents_nationalities.nat_id
+WHERE productions.obj_id = ?"""
+
+QUERY_DETAILS_CLASSIFIERS = """SELECT classifiers.name
+FROM objects_classifiers
+LEFT OUTER JOIN classifiers ON classifiers.id = objects_classifiers.cls_id
+WHERE objects_classifiers.obj_id = ?"""
+
+QUERY_DETAILS_REFERENCES = """SELECT "references".type, "references".content
+FROM "references" WHERE "references".obj_id = ?"""
+
+QUERY_DETAILS_PLACES = """SELECT places.label
+FROM objects_places
+LEFT OUTER JOIN places ON objects_places.pl_id = places.id
+WHERE objects_places.obj_id = ?
+ORDER BY objects_places.pl_id
+LIMIT 1"""
+
+# the same queries for many objects at once (LuxDetailsQuery.search_many): the ids
+# are passed as a JSON array and every row starts with the id it belongs to. The
+# rows of each object come in the order the single object queries read them.
+QUERY_DETAILS_MANY_OBJECTS = """SELECT ids.value, objects.label, objects.accession_no,
+objects.date
+FROM json_each(?) AS ids
+JOIN objects ON objects.id = ids.value"""
+
+QUERY_DETAILS_MANY_AGENTS = """SELECT ids.value, productions.part, agents.name,
+agents.begin_date, agents.end_date, agents.id
+FROM json_each(?) AS ids
+JOIN productions ON productions.obj_id = ids.value
+LEFT OUTER JOIN agents ON productions.agt_id = agents.id
+ORDER BY ids.key, productions.rowid"""
+
+QUERY_DETAILS_MANY_NATIONALITIES = """SELECT ids.value, agents.id, nationalities.descriptor
+FROM json_each(?) AS ids
+JOIN productions ON productions.obj_id = ids.value
+JOIN agents ON productions.agt_id = agents.id
+JOIN agents_nationalities ON agents_nationalities.agt_id = agents.id
+LEFT OUTER JOIN nationalities ON nationalities.id = agents_nationalities.nat_id
+ORDER BY ids.key, productions.rowid, agents_nationalities.rowid"""
+
+QUERY_DETAILS_MANY_CLASSIFIERS = """SELECT ids.value, classifiers.name
+FROM json_each(?) AS ids
+JOIN objects_classifiers ON objects_classifiers.obj_id = ids.value
+LEFT OUTER JOIN classifiers ON classifiers.id = objects_classifiers.cls_id
+ORDER BY ids.key, objects_classifiers.rowid"""
+
+QUERY_DETAILS_MANY_REFERENCES = """SELECT ids.value, "references".type, "references".content
+FROM json_each(?) AS ids
+JOIN "references" ON "references".obj_id = ids.value
+ORDER BY ids.key, "references".rowid"""
+
+QUERY_DETAILS_MANY_PLACES = """SELECT ids.value, (
+    SELECT places.label
+    FROM objects_places
+    LEFT OUTER JOIN places ON objects_places.pl_id = places.id
+    WHERE objects_places.obj_id = ids.value
+    ORDER BY objects_places.pl_id
+    LIMIT 1)
+FROM json_each(?) AS ids"""
@@ -0,0 +1,396 @@
+"""Module for the production server: pre-forked worker processes sharing one listening
+socket, each serving requests from a bounded queue with a pool of threads.
+
+The master process never imports the application. Every worker builds it (and with it
+its connection pools and caches) after the fork, so a SIGHUP can replace the workers
+with ones running the current code and database.
+"""
+
+import os
+import queue
+import signal
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from werkzeug.exceptions import InternalServerError
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+# defaults of the production server, see runserver.py
+WORKERS = os.cpu_count() or 1
+THREADS = 8
+QUEUE_SIZE = 64
+KEEPALIVE = 5.0
+GRACEFUL_TIMEOUT = 30.0
+BACKLOG = 1024
+
+# a worker that exits sooner than this after starting is restarted only after a delay,
+# so a worker failing at startup does not fork in a tight loop
+MIN_WORKER_LIFETIME = 1.0
+
+# sent on connections arriving while a worker's request queue is full
+OVERLOADED_RESPONSE = (b"HTTP/1.1 503 Service Unavailable\r\n"
+                       b"Content-Length: 0\r\nRetry-After: 1\r\nConnection: close\r\n\r\n")
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """Request handler keeping HTTP/1.1 connections open between requests; a connection
+    idle for longer than timeout seconds is closed.
+
+    Werkzeug's handler closes every connection, because it can not tell where a request
+    body it did not read ends: its run_wsgi always sends "Connection: close", then reads
+    whatever the client sent next. Requests without a body (every route of the
+    application is a GET) are served here instead and leave the connection open.
+
+    This replaces WSGIRequestHandler.run_wsgi for those requests, relying only on the
+    handler's make_environ, send_response, send_header, end_headers and
+    connection_dropped; it follows werkzeug 3.1 (pinned in requirements.txt), and is
+    covered by tests/test_server.py.
+    """
+
+    protocol_version = "HTTP/1.1"
+    timeout = KEEPALIVE
+
+    def has_body(self):
+        """Returns True if the request has a body."""
+
+        length = self.headers.get("Content-Length", "").strip()
+        return "Transfer-Encoding" in self.headers or length not in ("", "0")
+
+    def run_wsgi(self):
+        if self.close_connection or self.server.draining or self.has_body():
+            super().run_wsgi()
+            return
+
+        environ = self.make_environ()
+        response = {"status": None, "headers": None, "sent": False, "chunked": False}
+
+        def write(data):
+            if not response["sent"]:
+                response["sent"] = True
+                code, _, message = response["status"].partition(" ")
+                self.send_response(int(code), message)
+                header_keys = set()
+                for key, value in response["headers"]:
+                    self.send_header(key, value)
+                    header_keys.add(key.lower())
+                # same rule as werkzeug for when a response needs chunked encoding
+                if not ("content-length" in header_keys
+                        or environ["REQUEST_METHOD"] == "HEAD"
+                        or 100 <= int(code) < 200 or int(code) in (204, 304)):
+                    response["chunked"] = True
+                    self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+            if data:
+                if response["chunked"]:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                else:
+                    self.wfile.write(data)
+            self.wfile.flush()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["status"] = status
+            response["headers"] = headers
+            return write
+
+        def execute(app):
+            application_iter = app(environ, start_response)
+            try:
+                for data in application_iter:
+                    write(data)
+                if not response["sent"]:
+                    write(b"")
+                if response["chunked"]:
+                    self.wfile.write(b"0\r\n\r\n")
+            finally:
+                if hasattr(application_iter, "close"):
+                    application_iter.close()
+
+        try:
+            execute(self.server.app)
+        except (ConnectionError, socket.timeout) as err_message:
+            self.close_connection = True
+            self.connection_dropped(err_message, environ)
+        except Exception:  # pylint: disable=broad-exception-caught
+            # a response cut off halfway can not be followed by another one
+            self.close_connection = True
+            self.server.log("error", f"Error on request:\n{traceback.format_exc()}")
+            if not response["sent"]:
+                try:
+                    execute(InternalServerError())
+                except Exception:  # pylint: disable=broad-exception-caught
+                    pass
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """WSGI server handing accepted connections to a fixed pool of threads through a
+    bounded queue. Connections arriving while the queue is full get a 503.
+    """
+
+    multithread = True
+
+    def __init__(self, listener, app, threads=THREADS, queue_size=QUEUE_SIZE,
+                 keepalive=KEEPALIVE, multiprocess=True):
+        """Starts the threads of a server accepting connections on listener.
+
+        Args:
+            listener (socket): bound, listening, non-blocking socket
+            app: WSGI application
+            threads (int): number of threads handling connections
+            queue_size (int): maximum number of accepted connections waiting for a thread
+            keepalive (float): seconds an idle keep-alive connection is kept open
+            multiprocess (bool): whether other processes serve the same socket
+        """
+
+        self.multiprocess = multiprocess
+        # set once the worker is stopping, to close connections after their request
+        self.draining = False
+        handler = type("RequestHandler", (KeepAliveRequestHandler,), {"timeout": keepalive})
+        host, port = listener.getsockname()[:2]
+        super().__init__(host, port, app, handler=handler, fd=listener.fileno())
+
+        self._connections = queue.Queue(maxsize=queue_size)
+        self._threads = [threading.Thread(target=self._handle_connections, daemon=True)
+                         for _ in range(threads)]
+        for thread in self._threads:
+            thread.start()
+
+    def get_request(self):
+        # connections are served blocking even though the listener is not
+        connection, client_address = super().get_request()
+        connection.setblocking(True)
+        # headers and body are written separately; without this the body of a
+        # keep-alive response waits for the client's delayed ACK of the headers
+        if connection.family in (socket.AF_INET, socket.AF_INET6):
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection, client_address
+
+    def process_request(self, request, client_address):
+        try:
+            self._connections.put_nowait((request, client_address))
+        except queue.Full:
+            try:
+                request.sendall(OVERLOADED_RESPONSE)
+            except OSError:
+                pass
+            self.shutdown_request(request)
+
+    def _handle_connections(self):
+        """Thread serving queued connections until it gets None."""
+
+        while True:
+            item = self._connections.get()
+            if item is None:
+                return
+            request, client_address = item
+            try:
+                self.finish_request(request, client_address)
+            except Exception:  # pylint: disable=broad-exception-caught
+                self.handle_error(request, client_address)
+            finally:
+                self.shutdown_request(request)
+
+    def drain(self):
+        """Waits until the queued connections have been served and stops the threads."""
+
+        for _ in self._threads:
+            self._connections.put(None)
+        for thread in self._threads:
+            thread.join()
+
+
+def run_worker(listener, app_factory, settings, master_pid):
+    """Body of a worker process: builds the application and serves it until SIGTERM
+    or until the master exits, then finishes the requests it has accepted.
+
+    Args:
+        listener (socket): the listening socket inherited from the master
+        app_factory (function): returns the WSGI application
+        settings (dict): threads, queue_size, keepalive and workers
+        master_pid (int): process id of the master
+    """
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *_: stopping.set())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+
+    server = PooledWSGIServer(listener, app_factory(), threads=settings["threads"],
+                              queue_size=settings["queue_size"],
+                              keepalive=settings["keepalive"],
+                              multiprocess=settings["workers"] > 1)
+
+    def watch():
+        while not stopping.wait(1.0):
+            if os.getppid() != master_pid:
+                break
+        server.draining = True
+        server.shutdown()
+
+    threading.Thread(target=watch, daemon=True).start()
+    server.serve_forever()
+    server.drain()
+
+
+class PreforkServer():
+    """Master process: binds the socket, forks the workers, restarts the ones that die,
+    replaces all of them on SIGHUP and stops them gracefully on SIGTERM or SIGINT.
+    """
+
+    def __init__(self, app_factory, host, port, workers=WORKERS, threads=THREADS,
+                 queue_size=QUEUE_SIZE, keepalive=KEEPALIVE,
+                 graceful_timeout=GRACEFUL_TIMEOUT, backlog=BACKLOG):
+        """Initializes the master.
+
+        Args:
+            app_factory (function): called in each worker, returns the WSGI application
+            host (str): address to listen on
+            port (int): port to listen on
+            workers (int): number of worker processes
+            threads (int): threads per worker
+            queue_size (int): accepted connections each worker queues before answering 503
+            keepalive (float): seconds an idle keep-alive connection is kept open
+            graceful_timeout (float): seconds a stopping worker may take to finish its
+                requests before it is killed
+            backlog (int): connections the kernel queues before they are accepted
+        """
+
+        self._app_factory = app_factory
+        self._address = (host, port)
+        self._backlog = backlog
+        self._graceful_timeout = graceful_timeout
+        self._settings = {"workers": workers, "threads": threads,
+                          "queue_size": queue_size, "keepalive": keepalive}
+        self._listener = None
+        self._generation = 0
+        # pid -> (generation, start time)
+        self._workers = {}
+        # pid -> time after which a stopping worker is killed
+        self._deadlines = {}
+        self._next_spawn = 0.0
+        self._reload = False
+        self._stopping = False
+
+    def run(self):
+        """Serves until SIGTERM or SIGINT."""
+
+        self._listener = socket.create_server(self._address, backlog=self._backlog)
+        # every worker polls the same socket, so an accept must not block when
+        # another worker got the connection first
+        self._listener.setblocking(False)
+
+        signal.signal(signal.SIGHUP, self._handle_reload)
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+
+        host, port = self._listener.getsockname()[:2]
+        print(f"Serving on http://{host}:{port} with {self._settings['workers']} workers"
+              f" of {self._settings['threads']} threads (master {os.getpid()})",
+              file=sys.stderr)
+
+        try:
+            while not self._stopping:
+                self._reap()
+                if self._reload:
+                    self._reload = False
+                    self._replace_workers()
+                self._spawn_workers()
+                self._kill_overdue()
+                time.sleep(0.2)
+        finally:
+            self._stop_workers()
+            self._listener.close()
+
+    def _handle_reload(self, *_):
+        self._reload = True
+
+    def _handle_stop(self, *_):
+        self._stopping = True
+
+    def _spawn_workers(self):
+        """Forks workers until the current generation is complete."""
+
+        current = [pid for pid, (generation, _) in self._workers.items()
+                   if generation == self._generation]
+        for _ in range(self._settings["workers"] - len(current)):
+            if time.monotonic() < self._next_spawn:
+                return
+            master_pid = os.getpid()
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    run_worker(self._listener, self._app_factory, self._settings,
+                               master_pid)
+                except BaseException:  # pylint: disable=broad-exception-caught
+                    traceback.print_exc()
+                    status = 1
+                finally:
+                    os._exit(status)
+            self._workers[pid] = (self._generation, time.monotonic())
+
+    def _reap(self):
+        """Collects exited workers."""
+
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation, started = self._workers.pop(pid, (None, None))
+            self._deadlines.pop(pid, None)
+            if generation == self._generation and not self._stopping:
+                print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)},"
+                      " restarting it", file=sys.stderr)
+                if time.monotonic() - started < MIN_WORKER_LIFETIME:
+                    self._next_spawn = time.monotonic() + MIN_WORKER_LIFETIME
+
+    def _replace_workers(self):
+        """Starts a new generation of workers and gracefully stops the old one."""
+
+        old = list(self._workers)
+        self._generation += 1
+        self._next_spawn = 0.0
+        print(f"Reloading: starting {self._settings['workers']} new workers",
+              file=sys.stderr)
+        self._spawn_workers()
+        self._terminate(old)
+
+    def _terminate(self, pids):
+        """Asks workers to finish their requests and exit."""
+
+        deadline = time.monotonic() + self._graceful_timeout
+        for pid in pids:
+            self._deadlines.setdefault(pid, deadline)
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _kill_overdue(self):
+        """Kills stopping workers that did not finish within the graceful timeout."""
+
+        now = time.monotonic()
+        for pid, deadline in list(self._deadlines.items()):
+            if now > deadline:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+                del self._deadlines[pid]
+
+    def _stop_workers(self):
+        """Stops every worker, waiting for them to finish their requests."""
+
+        self._terminate(list(self._workers))
+        while self._workers:
+            self._reap()
+            self._kill_overdue()
+            time.sleep(0.05)
@@ -0,0 +1,398 @@
+"""Module for serving a snapshot of the database and switching to a new one without
+a restart.
+
+The application reads the collection through SNAPSHOT_SETTINGS["path"] (./lux.sqlite
+unless LUX_DATABASE says otherwise), a file or a symlink to one. A new snapshot is
+published by writing it to a new file and pointing the symlink at it. Every process
+notices the change within check_interval seconds and prepares the new snapshot in a
+background thread: it opens it, builds its search index (and the in-memory engine
+when it is in use) and reruns the most recently used searches, facet counts and
+object details of the current snapshot on it. Only then does it become current.
+
+Requests take the current snapshot once, when they start (current_database), so the
+ones in flight finish on the old file while new ones read the new file with warm
+caches. The connections, caches and engine of the old snapshot are dropped
+retire_after seconds later; its file must be kept until then.
+
+Usage: python lux_snapshot.py [database] (prepares a snapshot before it is published)
+"""
+
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+
+from contextlib import closing, contextmanager
+from sqlite3 import connect, DatabaseError, OperationalError
+
+from lux_cache import drop_caches, get_cache
+from lux_index import ensure_index, index_path, source_signature
+from lux_memory import ENGINE_SETTINGS, get_engine, unload_engine
+from lux_pool import close_pool
+from query import LuxDetailsQuery, LuxQuery
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - not available on Windows
+    fcntl = None
+
+SNAPSHOT_SETTINGS = {
+    # the database the application serves, a file or a symlink to the current snapshot
+    "path": os.environ.get("LUX_DATABASE", "./lux.sqlite"),
+    # seconds between two checks of the path for a new snapshot
+    "check_interval": float(os.environ.get("LUX_RELOAD_INTERVAL", "2")),
+    # most recently used entries of each cache rerun on a new snapshot before it is used
+    "warm_entries": int(os.environ.get("LUX_RELOAD_WARM", "256")),
+    # seconds an old snapshot stays open for the requests still reading it
+    "retire_after": 60.0,
+    # attempts at an operation failing with a transient error, and the first delay
+    # between them (doubled after every attempt)
+    "retries": 3,
+    "retry_delay": 0.05,
+    # scheduling priority of the thread preparing a snapshot, so serving goes first
+    "niceness": 10,
+}
+
+# messages of the OperationalErrors that can go away when the operation is retried:
+# a snapshot being moved into place, a file system hiccup, a lock held for a moment
+TRANSIENT_ERRORS = ("unable to open database file", "database is locked", "disk i/o error")
+
+# object ids warmed per query, see LuxDetailsQuery.search_many
+WARM_BATCH = 100
+
+snapshot_log = logging.getLogger("lux.snapshot")
+
+# the snapshot served by this process; reset in forked children (see _state_of_process)
+_state = {"pid": None}
+_state_lock = threading.Lock()
+
+
+def retry(function, *args, **kwargs):
+    """Calls a function, calling it again after a short delay when it fails with a
+    transient database error (see TRANSIENT_ERRORS).
+
+    Args:
+        function: the function to call
+        args, kwargs: its arguments
+    Return:
+        the result of function
+    Raises:
+        OperationalError: if the error is not transient or persists
+    """
+
+    delay = SNAPSHOT_SETTINGS["retry_delay"]
+    for attempt in range(SNAPSHOT_SETTINGS["retries"]):
+        try:
+            return function(*args, **kwargs)
+        except OperationalError as err_message:
+            if (attempt + 1 >= SNAPSHOT_SETTINGS["retries"]
+                    or not str(err_message).lower().startswith(TRANSIENT_ERRORS)):
+                raise
+            snapshot_log.warning("retrying after a database error: %s", err_message)
+        time.sleep(delay)
+        delay *= 2
+    return function(*args, **kwargs)
+
+
+def resolve(path):
+    """Returns the (file, version) of the snapshot a path leads to, None if there is
+    no file there.
+
+    Args:
+        path (str): database file or symlink to one
+    """
+
+    db_file = os.path.realpath(path)
+    try:
+        return db_file, source_signature(db_file)
+    except OSError:
+        return None
+
+
+def _state_of_process():
+    """Returns this process's snapshot state, starting over in a forked child (where
+    the preparing thread of the parent does not exist). Caller must hold the lock.
+    """
+
+    if _state["pid"] != os.getpid():
+        path = SNAPSHOT_SETTINGS["path"]
+        snapshot = resolve(path)
+        _state.clear()
+        _state.update({
+            "pid": os.getpid(),
+            # the configured path is used as it is until a file exists there
+            "current": snapshot or (path, None),
+            "since": time.time(),
+            "next_check": time.monotonic() + SNAPSHOT_SETTINGS["check_interval"],
+            "preparing": None,
+            "failed": None,
+            "retiring": [],
+            "stats": {"switches": 0, "failures": 0, "retired": 0,
+                      "last_prepare_seconds": None, "last_warmed": None},
+        })
+    return _state
+
+
+def current_database():
+    """Returns the database file requests read: the file of the current snapshot.
+
+    At most every check_interval seconds, it also checks whether the path leads to a
+    new snapshot, which starts being prepared in the background, and retires the old
+    snapshots whose requests are over.
+    """
+
+    state = _state
+    if state["pid"] != os.getpid() or time.monotonic() >= state["next_check"]:
+        with _state_lock:
+            state = _state_of_process()
+            if time.monotonic() >= state["next_check"]:
+                _check(state)
+    return state["current"][0]
+
+
+def _check(state):
+    """Looks for a new snapshot and retires the old ones. Caller must hold the lock."""
+
+    now = time.monotonic()
+    state["next_check"] = now + SNAPSHOT_SETTINGS["check_interval"]
+
+    retiring = []
+    for db_file, deadline in state["retiring"]:
+        if deadline > now:
+            retiring.append((db_file, deadline))
+        # a file replaced in place is still the one served
+        elif db_file != state["current"][0]:
+            retire(db_file)
+            state["stats"]["retired"] += 1
+    state["retiring"] = retiring
+
+    snapshot = resolve(SNAPSHOT_SETTINGS["path"])
+    if snapshot is None or snapshot in (state["current"], state["preparing"], state["failed"]):
+        return
+    state["preparing"] = snapshot
+    threading.Thread(target=_prepare_and_switch, args=(snapshot, state["current"][0]),
+                     name="lux-snapshot", daemon=True).start()
+
+
+def _prepare_and_switch(snapshot, old_file):
+    """Prepares a snapshot in the background and makes it current once it is ready.
+
+    Args:
+        snapshot (tuple): (file, version) of the new snapshot
+        old_file (str): file of the current snapshot, whose caches are replayed
+    """
+
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(),
+                       SNAPSHOT_SETTINGS["niceness"])
+    except (AttributeError, OSError):  # pragma: no cover - only Linux has thread priorities
+        pass
+
+    db_file = snapshot[0]
+    start = time.perf_counter()
+    try:
+        warmed = prepare(db_file, old_file)
+    except Exception as err_message:  # pylint: disable=broad-exception-caught
+        # whatever the error, the snapshot must stop preparing, or it would never be
+        # checked again; an unreadable file is expected, anything else is a bug
+        snapshot_log.warning("not switching to snapshot %s: %s", db_file, err_message,
+                             exc_info=not isinstance(err_message, (DatabaseError, OSError)))
+        with _state_lock:
+            if _state.get("preparing") == snapshot:
+                _state["preparing"] = None
+                _state["failed"] = snapshot
+                _state["stats"]["failures"] += 1
+        return
+    seconds = time.perf_counter() - start
+
+    with _state_lock:
+        if _state.get("preparing") != snapshot:
+            return
+        old = _state["current"]
+        _state.update({"current": snapshot, "since": time.time(), "preparing": None,
+                       "failed": None})
+        _state["retiring"].append(
+            (old[0], time.monotonic() + SNAPSHOT_SETTINGS["retire_after"]))
+        _state["stats"]["switches"] += 1
+        _state["stats"]["last_prepare_seconds"] = round(seconds, 3)
+        _state["stats"]["last_warmed"] = warmed
+    snapshot_log.info("switched to snapshot %s, prepared in %.1f s with %d cache entries",
+                      db_file, seconds, warmed)
+
+
+@contextmanager
+def build_lock(db_file):
+    """Context manager holding a lock shared by every process, so the worker processes
+    build the index of a snapshot once instead of each building its own.
+
+    Args:
+        db_file (str): database file
+    """
+
+    if fcntl is None:  # pragma: no cover - not available on Windows
+        yield
+        return
+    with open(f"{index_path(db_file)}.lock", "a", encoding="utf-8") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def check_database(db_file):
+    """Raises DatabaseError unless the file is a collection database that can be read.
+
+    Args:
+        db_file (str): database file
+    """
+
+    with closing(connect(f"file:{db_file}?mode=ro", uri=True)) as connection:
+        connection.execute("SELECT id FROM objects LIMIT 1").fetchall()
+
+
+def prepare(db_file, old_file=None):
+    """Builds everything a snapshot needs before it serves requests: its search index,
+    the in-memory engine if it is in use and the entries of its caches.
+
+    Args:
+        db_file (str): database file of the new snapshot
+        old_file (str): database file of the current snapshot, None not to warm caches
+    Return:
+        int: number of cache entries warmed
+    Raises:
+        DatabaseError, OSError: if the snapshot can not be read
+    """
+
+    retry(check_database, db_file)
+    with build_lock(db_file):
+        if ensure_index(db_file, wait=True) is None:
+            snapshot_log.warning("snapshot %s has no search index", db_file)
+    if ENGINE_SETTINGS["engine"] == "memory":
+        get_engine(db_file, wait=True)
+    if old_file is None:
+        return 0
+    return warm(db_file, old_file)
+
+
+def warm(db_file, old_file):
+    """Reruns the most recently used searches, pages, facet counts and object details of one
+    database on another, so its caches start with them.
+
+    Warming is best effort: an entry failing on the new database is logged and
+    skipped, and does not keep the snapshot from being switched to.
+
+    Args:
+        db_file (str): database file whose caches are filled
+        old_file (str): database file whose caches are replayed
+    Return:
+        int: number of cache entries warmed
+    """
+
+    count = SNAPSHOT_SETTINGS["warm_entries"]
+    searches = get_cache(old_file).recent_keys(count)
+    pages = get_cache(old_file, "pages").recent_keys(count)
+    facets = get_cache(old_file, "facets").recent_keys(count)
+    obj_ids = get_cache(old_file, "details").recent_keys(count)
+
+    query = LuxQuery(db_file)
+    details = LuxDetailsQuery(db_file)
+    calls = [(query.search_results, (dep, agt, classifier, label), 1)
+             for label, classifier, agt, dep, _ in searches]
+    calls += [(query.fetch_page, (dep, agt, classifier, label, page_size, after), 1)
+              for label, classifier, agt, dep, _, page_size, after in pages]
+    calls += [(query.facet_counts, (dep, agt, classifier, label, size), 1)
+              for label, classifier, agt, dep, size in facets]
+    calls += [(details.search_many, (obj_ids[start:start + WARM_BATCH],),
+               len(obj_ids[start:start + WARM_BATCH]))
+              for start in range(0, len(obj_ids), WARM_BATCH)]
+
+    warmed = 0
+    for function, args, entries in calls:
+        try:
+            retry(function, *args)
+        except Exception as err_message:  # pylint: disable=broad-exception-caught
+            snapshot_log.warning("not warming %s%r on snapshot %s: %s", function.__name__,
+                                 args, db_file, err_message)
+            continue
+        warmed += entries
+    return warmed
+
+
+def retire(db_file):
+    """Closes the connections and drops the caches and engines of an old snapshot.
+
+    Args:
+        db_file (str): database file of the snapshot
+    """
+
+    close_pool(db_file)
+    close_pool(index_path(db_file))
+    drop_caches(db_file)
+    unload_engine(db_file)
+    snapshot_log.info("retired snapshot %s", db_file)
+
+
+def configure(**settings):
+    """Changes the snapshot settings; a new path is served from the next request on,
+    without being prepared first.
+
+    Args:
+        settings: any of path, check_interval, warm_entries, retire_after, retries,
+            retry_delay, niceness
+    """
+
+    unknown = set(settings) - set(SNAPSHOT_SETTINGS)
+    if unknown:
+        raise ValueError(f"unknown snapshot settings: {', '.join(sorted(unknown))}")
+    with _state_lock:
+        SNAPSHOT_SETTINGS.update(settings)
+        _state["pid"] = None
+
+
+def snapshot_stats():
+    """Returns the snapshot served by this process and the reload counters."""
+
+    with _state_lock:
+        state = _state_of_process()
+        return {
+            "path": SNAPSHOT_SETTINGS["path"],
+            "current": state["current"][0],
+            "version": state["current"][1],
+            "since": state["since"],
+            "preparing": state["preparing"] and state["preparing"][0],
+            "retiring": [db_file for db_file, _ in state["retiring"]],
+            **state["stats"],
+        }
+
+
+def main():
+    """Command line entry point: prepares a snapshot (its search index) before it is
+    published, so the servers only warm caches.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog='lux_snapshot.py', allow_abbrev=False,
+        description='Prepare a YUAG database snapshot before it is published')
+    parser.add_argument(
+        "database", nargs="?", default="./lux.sqlite",
+        help="the snapshot to prepare (default: ./lux.sqlite)")
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.database):
+        print(f"error: database {args.database} does not exist", file=sys.stderr)
+        sys.exit(1)
+
+    start = time.perf_counter()
+    try:
+        prepare(args.database)
+    except (DatabaseError, OSError) as err_message:
+        print(f"error: unable to prepare snapshot: {err_message}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Snapshot {args.database} prepared in {time.perf_counter() - start:.1f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+"""Module for generating synthetic collection databases with the LUX schema, for benchmarks.
+
+The generated database has every table the queries in query.py and lux_query_sql.py
+read, filled with random but plausible data. Popularity of words, agents, classifiers,
+departments, nationalities and places follows a Zipf distribution, so a few values
+are very common and most are rare, as in a real collection.
+"""
+
+import argparse
+import itertools
+import os
+import random
+import sys
+import time
+
+from contextlib import closing
+from sqlite3 import connect
+
+SCHEMA = """
+CREATE TABLE objects (id INTEGER PRIMARY KEY, label TEXT, date TEXT, accession_no TEXT);
+CREATE TABLE agents (id INTEGER PRIMARY KEY, name TEXT, begin_date TEXT, end_date TEXT);
+CREATE TABLE productions (obj_id INTEGER, agt_id INTEGER, part TEXT);
+CREATE TABLE nationalities (id INTEGER PRIMARY KEY, descriptor TEXT);
+CREATE TABLE agents_nationalities (agt_id INTEGER, nat_id INTEGER);
+CREATE TABLE classifiers (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE objects_classifiers (obj_id INTEGER, cls_id INTEGER);
+CREATE TABLE departments (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE objects_departments (obj_id INTEGER, dep_id INTEGER);
+CREATE TABLE places (id INTEGER PRIMARY KEY, label TEXT);
+CREATE TABLE objects_places (obj_id INTEGER, pl_id INTEGER);
+CREATE TABLE "references" (obj_id INTEGER, type TEXT, content TEXT);
+"""
+
+INDEXES = """
+CREATE INDEX productions_obj_id ON productions (obj_id);
+CREATE INDEX agents_nationalities_agt_id ON agents_nationalities (agt_id);
+CREATE INDEX objects_classifiers_obj_id ON objects_classifiers (obj_id);
+CREATE INDEX objects_departments_obj_id ON objects_departments (obj_id);
+CREATE INDEX objects_places_obj_id ON objects_places (obj_id);
+CREATE INDEX references_obj_id ON "references" (obj_id);
+"""
+
+SYLLABLES = ["ar", "ba", "co", "da", "el", "fa", "gi", "ho", "in", "ja", "ka", "lo", "ma",
+             "ne", "or", "pa", "qu", "ri", "sa", "to", "ur", "ve", "wi", "xe", "ya", "zo",
+             "tra", "por", "lan", "sca", "ves", "sel", "mon", "ste", "gra", "vin"]
+
+LABEL_WORDS = ["Portrait", "Landscape", "Study", "Vase", "Bowl", "Figure", "Head", "Woman",
+               "Man", "River", "Mountain", "Still Life", "Sketch", "Coin", "Plate", "Cup",
+               "of", "the", "with", "and", "Tetradrachm", "Jar", "View", "Seated", "Standing"]
+
+PARTS = ["artist", "maker", "publisher", "printer", "designer", "engraver", "after"]
+
+REFERENCE_TYPES = ["Provenance", "Inscription", "Exhibition", "Bibliography", "Marks",
+                   "Credit Line", "Dimensions", "Medium"]
+
+CLASSIFIERS = ["Paintings", "Prints", "Drawings", "Coins", "Ceramics", "Sculpture",
+               "Photographs", "Textiles", "Furniture", "Glass", "Metalwork", "Jewelry",
+               "Manuscripts", "Books", "Tools", "Seals", "Vessels", "Arms", "Ivories"]
+
+DEPARTMENTS = ["American Decorative Arts", "American Paintings and Sculpture",
+               "Ancient Art", "Art of Africa", "Art of the Ancient Americas", "Asian Art",
+               "European Art", "Indo-Pacific Art", "Modern and Contemporary Art",
+               "Numismatics", "Photography", "Prints and Drawings"]
+
+NATIONALITIES = ["American", "British", "French", "Dutch", "Italian", "German", "Spanish",
+                 "Flemish", "Japanese", "Chinese", "Greek", "Roman", "Mexican", "Canadian"]
+
+# rows per executemany batch
+BATCH = 10000
+
+
+class ZipfChoice():
+    """Draws items with probability proportional to 1 / rank ** skew."""
+
+    def __init__(self, items, skew, rng):
+        self._items = list(items)
+        self._rng = rng
+        weights = [1 / (rank ** skew) for rank in range(1, len(self._items) + 1)]
+        self._cum_weights = list(itertools.accumulate(weights))
+
+    def __call__(self, count=1):
+        return self._rng.choices(self._items, cum_weights=self._cum_weights, k=count)
+
+
+def make_words(count, rng):
+    """Returns count distinct pronounceable pseudo-words."""
+
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+
+def iso_date(year, rng):
+    """Returns a random '%Y-%m-%d' date in the given year."""
+
+    return f"{year:04d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"
+
+
+def object_date(rng):
+    """Returns an object date in one of the free-text styles of the collection."""
+
+    year = rng.randint(-500, 2020)
+    style = rng.random()
+    if year < 1:
+        return f"{-year + 1} B.C."
+    if style < 0.6:
+        return str(year)
+    if style < 0.8:
+        return f"ca. {year}"
+    if style < 0.95:
+        return f"{year}–{year + rng.randint(1, 30)}"
+    return None
+
+
+def generate(db_file, objects, skew=1.1, seed=0, agents_per_object=1.5,
+             vocabulary=5000):
+    """Writes a synthetic collection database.
+
+    Args:
+        db_file (str): database file to create; it must not exist
+        objects (int): number of objects
+        skew (float): Zipf exponent of value popularity (0 is uniform)
+        seed (int): random seed, the same arguments always give the same database
+        agents_per_object (float): average number of productions per object
+        vocabulary (int): number of distinct pseudo-words used in labels and names
+    Return:
+        dict: number of rows written per table
+    """
+
+    if os.path.exists(db_file):
+        raise FileExistsError(f"{db_file} already exists")
+
+    rng = random.Random(seed)
+    words = make_words(vocabulary, rng)
+    label_word = ZipfChoice(LABEL_WORDS + words, skew, rng)
+    n_agents = max(10, int(objects / 4))
+    agent = ZipfChoice(range(1, n_agents + 1), skew, rng)
+    classifier = ZipfChoice(range(1, len(CLASSIFIERS) + 1), skew, rng)
+    department = ZipfChoice(range(1, len(DEPARTMENTS) + 1), skew, rng)
+    nationality = ZipfChoice(range(1, len(NATIONALITIES) + 1), skew, rng)
+    n_places = max(20, int(objects / 50))
+    place = ZipfChoice(range(1, n_places + 1), skew, rng)
+    name_word = ZipfChoice(words, skew, rng)
+
+    counts = {}
+
+    def insert(cursor, table, rows):
+        smt_str = None
+        written = 0
+        for batch in iter(lambda: list(itertools.islice(rows, BATCH)), []):
+            if smt_str is None:
+                marks = ", ".join("?" * len(batch[0]))
+                smt_str = f'INSERT INTO "{table}" VALUES ({marks})'
+            cursor.executemany(smt_str, batch)
+            written += len(batch)
+        counts[table] = counts.get(table, 0) + written
+
+    def agent_rows():
+        for agt_id in range(1, n_agents + 1):
+            first, last = name_word(2)
+            begin = rng.randint(1400, 1990)
+            begin_date = iso_date(begin, rng) if rng.random() < 0.9 else None
+            end_date = iso_date(begin + rng.randint(20, 90), rng) if rng.random() < 0.8 else None
+            yield (agt_id, f"{first.title()} {last.title()}", begin_date, end_date)
+
+    def agent_nationality_rows():
+        for agt_id in range(1, n_agents + 1):
+            for nat_id in set(nationality(rng.choice((0, 1, 1, 1, 2)))):
+                yield (agt_id, nat_id)
+
+    def object_rows():
+        for obj_id in range(1, objects + 1):
+            label = " ".join(label_word(rng.randint(1, 6)))
+            yield (obj_id, label, object_date(rng), f"{rng.randint(1900, 2020)}.{obj_id}")
+
+    def production_rows():
+        for obj_id in range(1, objects + 1):
+            count = max(1, int(rng.expovariate(1 / agents_per_object)))
+            for agt_id in set(agent(count)):
+                yield (obj_id, agt_id, rng.choice(PARTS))
+
+    def link_rows(choose, most):
+        for obj_id in range(1, objects + 1):
+            for value in set(choose(rng.randint(1, most))):
+                yield (obj_id, value)
+
+    def reference_rows():
+        for obj_id in range(1, objects + 1):
+            for number in range(rng.randint(1, 6)):
+                ref_type = rng.choice(REFERENCE_TYPES)
+                content = " ".join(label_word(rng.randint(3, 12)))
+                yield (obj_id, ref_type, f"{content} ({obj_id}.{number})")
+
+    with closing(connect(db_file, isolation_level=None)) as connection:
+        with closing(connection.cursor()) as cursor:
+            cursor.execute("PRAGMA journal_mode = OFF")
+            cursor.execute("PRAGMA synchronous = OFF")
+            cursor.executescript(SCHEMA)
+            cursor.execute("BEGIN")
+            insert(cursor, "classifiers", enumerate(CLASSIFIERS, 1))
+            insert(cursor, "departments", enumerate(DEPARTMENTS, 1))
+            insert(cursor, "nationalities", enumerate(NATIONALITIES, 1))
+            insert(cursor, "places", ((pl_id, f"{rng.choice(words).title()}, "
+                                       f"{rng.choice(words).title()}")
+                                      for pl_id in range(1, n_places + 1)))
+            insert(cursor, "agents", agent_rows())
+            insert(cursor, "agents_nationalities", agent_nationality_rows())
+            insert(cursor, "objects", object_rows())
+            insert(cursor, "productions", production_rows())
+            insert(cursor, "objects_classifiers", link_rows(classifier, 3))
+            insert(cursor, "objects_departments",
+                   ((obj_id, dep_id) for obj_id, dep_id in link_rows(department, 1)))
+            insert(cursor, "objects_places", link_rows(place, 1))
+            insert(cursor, "references", reference_rows())
+            cursor.execute("COMMIT")
+            cursor.executescript(INDEXES)
+            cursor.execute("ANALYZE")
+
+    return counts
+
+
+def main():
+    """Command line entry point: writes a synthetic database."""
+
+    parser = argparse.ArgumentParser(
+        prog='lux_synth.py', allow_abbrev=False,
+        description='Generate a synthetic YUAG collection database for benchmarks')
+    parser.add_argument("database", help="the database file to create")
+    parser.add_argument("--objects", type=int, default=10000,
+                        help="number of objects, e.g. 10000 to 10000000 (default: 10000)")
+    parser.add_argument("--skew", type=float, default=1.1,
+                        help="Zipf exponent of value popularity, 0 for uniform (default: 1.1)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    parser.add_argument("--force", action="store_true",
+                        help="overwrite the database if it exists")
+    args = parser.parse_args()
+
+    if args.force and os.path.exists(args.database):
+        os.remove(args.database)
+
+    start = time.perf_counter()
+    try:
+        counts = generate(args.database, args.objects, skew=args.skew, seed=args.seed)
+    except FileExistsError as err_message:
+        print(f"error: {err_message}, use --force to overwrite", file=sys.stderr)
+        sys.exit(1)
+
+    rows = ", ".join(f"{table}: {count}" for table, count in counts.items())
+    print(f"Wrote {args.database} in {time.perf_counter() - start:.1f}s ({rows})")
+
+
+if __name__ == '__main__':
+    main()
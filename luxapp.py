@@ -1,18 +1,88 @@
 """Code for flask application."""
 
-import json
 import os
+import sys
 
-from time import localtime, asctime
+from itertools import chain, islice
+from time import localtime, asctime, perf_counter
 from sqlite3 import OperationalError
-from flask import Flask, request, make_response, render_template, abort
-from query import LuxQuery, LuxDetailsQuery, NoSearchResultsError
+from flask import (Flask, Response, request, make_response, render_template, abort, jsonify,
+                   g)
+from jinja2 import FileSystemBytecodeCache
+import lux_metrics
+from query import (LuxQuery, LuxDetailsQuery, NoSearchResultsError, InvalidPageTokenError,
+                   SearchCancelledError, database_version)
+from lux_executor import ExecutorBusyError, get_executor, executor_stats
+from lux_pool import PoolTimeoutError, pool_stats
+from lux_cache import cache_stats
+from lux_coalesce import single_flight_stats
+from lux_memory import engine_stats
+from lux_export import ExportFormatError, check_format, content_type, export_chunks, file_name
+from lux_snapshot import current_database, retry, snapshot_stats
+from lux_http import (json_response, make_etag, not_modified, not_modified_response,
+                      set_max_age)
 
 
-DB_NAME = "./lux.sqlite"
+# seconds browsers and proxies may reuse an object's detail page
+OBJ_MAX_AGE = 300
 
 app = Flask(__name__)
 
+# templates the routes render, see precompile_templates
+TEMPLATES = ("index.html", "luxdetails.html", "error.html")
+
+# directory the compiled templates are cached in for every process, by default a
+# directory only the user can write to in the temporary directory
+TEMPLATE_CACHE = os.environ.get("LUX_TEMPLATE_CACHE") or None
+
+
+def precompile_templates(cache_dir=TEMPLATE_CACHE):
+    """Compiles the templates now instead of on the first request rendering each.
+    The compiled code is cached on disk, keyed by the template source, so a process
+    started later (a new worker, a restart) loads it instead of compiling again.
+
+    Args:
+        cache_dir (str): directory of the compiled templates, see TEMPLATE_CACHE
+    Return:
+        int: number of templates compiled
+    """
+
+    try:
+        if cache_dir:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    except (OSError, RuntimeError) as err_message:
+        # without a usable directory the templates are only compiled in memory
+        print(f"Template cache unavailable: {err_message}", file=sys.stderr)
+    for name in TEMPLATES:
+        app.jinja_env.get_template(name)
+    return len(TEMPLATES)
+
+
+@app.before_request
+def start_timing():
+    """Starts collecting the timing spans of the request (see lux_metrics.py)."""
+
+    g.request_start = perf_counter()
+    g.timings = lux_metrics.start_request()
+
+
+@app.after_request
+def add_server_timing(response):
+    """Sends the spans timed so far in a Server-Timing header and records the
+    request's duration once the response has been sent.
+
+    A streamed response's header only covers the work done before streaming started.
+    """
+
+    start = g.request_start
+    response.headers["Server-Timing"] = lux_metrics.server_timing(
+        g.timings, perf_counter() - start)
+    endpoint = request.endpoint
+    response.call_on_close(
+        lambda: lux_metrics.observe_request(endpoint, perf_counter() - start))
+    return response
+
 
 @app.route('/', methods=['GET'])
 @app.route('/index', methods=['GET'])
@@ -32,6 +102,22 @@ def page_not_found(error_message):
     return render_template("error.html", message=message), 404
 
 
+@app.errorhandler(400)
+def bad_request(error_message):
+    """Function for 400 error handler."""
+
+    message = error_message.description
+    return render_template("error.html", message=message), 400
+
+
+@app.errorhandler(409)
+def conflict(error_message):
+    """Function for 409 error handler."""
+
+    message = error_message.description
+    return render_template("error.html", message=message), 409
+
+
 @app.route('/obj/', methods=["GET"])
 def missing_obj():
     """If object id not provided, abort with 404 and message."""
@@ -39,39 +125,8 @@ def missing_obj():
     abort(404, description="missing object id.")
 
 
-@app.route("/search", methods=["GET"])
-def search():
-    """Function for the '/search' route."""
-
-    # set each of the following four variables as user input or null
-    label_search = request.args.get('l', "")
-    classification_search = request.args.get('c', "")
-    agent_search = request.args.get('a', "")
-    department_search = request.args.get('d', "")
-
-    html = ""
-
-    if label_search or classification_search or agent_search or department_search:
-        # query the database and select data that we need
-        try:
-            # show search results from LuxQuery
-            results = LuxQuery(DB_NAME).search(agt=agent_search, dep=department_search,
-                                               classifier=classification_search,
-                                               label=label_search)
-            results = json.loads(results)
-            results_data = results["data"]
-        except OperationalError:
-            # if can not query database, then exits with 1
-            print(f"Database {DB_NAME} unable to open")
-            os._exit(1)
-
-        # parse multiple agents and multiple classifiers
-        for obj in results_data:
-            obj[3] = obj[3].replace(",", "<br/>")
-            obj[4] = obj[4].replace(",", "<br/>")
-
-        # html format for each row
-        pattern = '''
+# html format for each row
+ROW_PATTERN = '''
         <tr>
             <div class='row'>
                 <td><a href="obj/%d" target="_blank">%s</a></td>
@@ -82,13 +137,8 @@ def search():
         </tr>
         '''
 
-        # get label, date, agents, classifiers data html pattern
-        pattern_res = ""
-        for result in results_data:
-            pattern_res += pattern % tuple(result)
-
-        # html format for table
-        html = f'''
+# html format for table, the rows go between TABLE_HEAD and TABLE_TAIL
+TABLE_HEAD = '''
         <table class="data-table">
             <thead>
                 <tr>
@@ -99,34 +149,524 @@ def search():
                 </tr>
             </thead>
         <tbody>
-        {pattern_res}
+        '''
+
+TABLE_TAIL = '''
         </tbody>
         </table>
         '''
 
+# number of table rows sent per chunk of a streamed response
+ROWS_PER_CHUNK = 50
+
+# largest page_size accepted by '/search'
+MAX_PAGE_SIZE = 1000
+
+# response header carrying the token of the next page of a paginated search
+NEXT_PAGE_HEADER = "X-Next-Page"
+
+# request header carrying the client's search session, see run_search
+SESSION_HEADER = "X-Search-Session"
+
+# seconds a client should wait before retrying a search rejected because the server is busy
+RETRY_AFTER = 1
+
+# largest number of objects '/api/objs' returns in one request
+MAX_BATCH_IDS = 100
+
+# largest number of values per facet a search can ask for
+MAX_FACETS = 50
+
+# headings of the facets listed under a '/search' table, see LuxQuery.facet_counts
+FACET_TITLES = {"department": "Department", "classifier": "Classified As",
+                "agent": "Agents"}
+
+
+def format_rows(rows):
+    """Formats search rows as table rows, in a single pass over them.
+
+    Args:
+        rows (list): (id, label, date, artist, classification) rows
+    Return:
+        str: html of the table rows
+    """
+
+    # label, date, agents, classifiers; multiple agents and classifiers go on
+    # separate lines
+    return "".join([ROW_PATTERN % (obj_id, label, date, artist.replace(",", "<br/>"),
+                                   classification.replace(",", "<br/>"))
+                    for obj_id, label, date, artist, classification in rows])
+
+
+def format_facets(facets):
+    """Formats the facet counts of a search as html lists.
+
+    Args:
+        facets (dict): facet counts, see LuxQuery.facet_counts
+    Return:
+        str: html of the facets
+    """
+
+    html = [f'<div class="facets">\n<p>{facets["total"]} objects</p>\n']
+    for facet, title in FACET_TITLES.items():
+        html.append(f"<h4>{title}</h4>\n<ul>\n")
+        html.extend(f"<li>{value} ({hits})</li>\n" for value, hits in facets[facet])
+        html.append("</ul>\n")
+    html.append("</div>\n")
+    return "".join(html)
+
+
+def generate_table(rows):
+    """Generator yielding the html table for the given search rows in chunks.
+
+    Args:
+        rows (iterable): (id, label, date, artist, classification) rows
+    Yields:
+        str: consecutive pieces of the html table
+    """
+
+    yield TABLE_HEAD
+
+    # time only the formatting, reading the rows is timed as sql
+    render_seconds = 0.0
+    rows = iter(rows)
+    chunk = list(islice(rows, ROWS_PER_CHUNK))
+    while chunk:
+        start = perf_counter()
+        html = format_rows(chunk)
+        render_seconds += perf_counter() - start
+        yield html
+        chunk = list(islice(rows, ROWS_PER_CHUNK))
+
+    lux_metrics.add_time("render", render_seconds)
+    lux_metrics.observe("render", render_seconds)
+    yield TABLE_TAIL
+
+
+@app.route("/search", methods=["GET"])
+def search():
+    """Function for the '/search' route.
+
+    The rows are read on the search executor, like every search (see run_search), then
+    the table is streamed to the client in chunks as it is formatted.
+    With a page_size argument the results are paginated instead, see search_page.
+    """
+
+    # set each of the following four variables as user input or null
+    label_search = request.args.get('l', "")
+    classification_search = request.args.get('c', "")
+    agent_search = request.args.get('a', "")
+    department_search = request.args.get('d', "")
+
+    if not (label_search or classification_search or agent_search or department_search):
+        return make_response("")
+
+    facets = None
+    if 'facets' in request.args:
+        facets = parse_facets()
+        if facets is None:
+            abort(400, description=f"facets must be an integer 1-{MAX_FACETS}.")
+
+    if 'page_size' in request.args:
+        return search_page(label_search, classification_search, agent_search,
+                           department_search, facets)
+
+    # query the database and select data that we need
+    db_file = current_database()
+    query = LuxQuery(db_file)
+
+    def read_rows(cancel=None, **terms):
+        return list(query.iter_rows(cancel=cancel, **terms))
+
+    function = read_rows
+    if facets:
+        function = with_facets(function, facets, db_file)
+    try:
+        # the whole search runs before the response starts, so a database error or a
+        # newer search of the session is still answered with an error status
+        result = run_search(
+            function,
+            agt=agent_search, dep=department_search, classifier=classification_search,
+            label=label_search)
+    except SearchCancelledError:
+        abort(409, description="search superseded by a newer one.")
+    except ExecutorBusyError:
+        return busy_response("too many searches, try again.")
+    except OperationalError:
+        return unavailable_response(db_file)
+
+    if facets:
+        rows, facet_counts = result
+        html = chain(generate_table(rows), [format_facets(facet_counts)])
+    else:
+        html = generate_table(result)
+    return Response(html, mimetype="text/html")
+
+
+def with_facets(function, size, db_file):
+    """Returns a search function that also counts the facets of the search, so both
+    run as one search on the executor (see run_search).
+
+    Args:
+        function: LuxQuery method taking the search arguments and a cancel token
+        size (int): number of values per facet, see LuxQuery.facet_counts
+        db_file (str): database file searched
+    Return:
+        function returning a (result of function, facet counts) tuple
+    """
+
+    def search_with_facets(cancel=None, **kwargs):
+        result = function(cancel=cancel, **kwargs)
+        terms = {name: kwargs[name] for name in ("dep", "agt", "classifier", "label")}
+        facets = LuxQuery(db_file).facet_counts(size=size, cancel=cancel, **terms)
+        return result, facets
+    return search_with_facets
+
+
+@app.route("/export", methods=["GET"])
+def export():
+    """Function for the '/export' route: every object matching the l, c, a, d arguments
+    of '/search', not only the first 1000, streamed as a file download.
+
+    format is csv (default), ndjson or parquet; gzip=1 compresses the file.
+    """
+
+    fmt = request.args.get('format', "csv")
+    compress = request.args.get('gzip', "") not in ("", "0")
+    try:
+        check_format(fmt)
+    except ExportFormatError as err_message:
+        return json_response({"error": f"{err_message}."}, 400)
+
+    db_file = current_database()
+
+    def start_chunks():
+        rows = LuxQuery(db_file).export_rows(agt=request.args.get('a', ""),
+                                             dep=request.args.get('d', ""),
+                                             classifier=request.args.get('c', ""),
+                                             label=request.args.get('l', ""))
+        chunks = export_chunks(rows, fmt, compress)
+        return chunks, list(islice(chunks, 1))
+
+    try:
+        # run the query now, so a database error still happens before the response starts
+        chunks, first_chunks = retry(start_chunks)
+    except PoolTimeoutError:
+        return busy_response("too many exports, try again.")
+    except OperationalError:
+        return unavailable_response(db_file)
+
+    response = Response(chain(first_chunks, chunks), content_type=content_type(fmt, compress))
+    response.headers["Content-Disposition"] = \
+        f'attachment; filename="{file_name(fmt, compress)}"'
+    return response
+
+
+def run_search(function, **kwargs):
+    """Runs a search on the search executor (see lux_executor.py) and waits for it.
+
+    The search supersedes the previous search sent with the same X-Search-Session
+    header, and is interrupted if the client disconnects while it runs. With a
+    debounce window configured, it only starts if no newer search of the session
+    arrives within the window. A transient database error is retried (see
+    lux_snapshot.retry).
+
+    Args:
+        function: LuxQuery method taking the search arguments and a cancel token
+        kwargs: the search arguments
+    Return:
+        the result of function
+    Raises:
+        SearchCancelledError: if the search was superseded or its client disconnected
+        ExecutorBusyError: if too many searches are already running or waiting
+    """
+
+    session = request.headers.get(SESSION_HEADER)
+    executor = get_executor()
+    token = executor.start(session)
+    try:
+        executor.debounce(session, token)
+        future = executor.submit(retry, function, cancel=token, **kwargs)
+        return executor.wait(future, token, request.environ.get("werkzeug.socket"))
+    finally:
+        executor.finish(session, token)
+
+
+def busy_response(message, json=False):
+    """Returns the 503 response for a search rejected because the server is busy."""
+
+    if json:
+        response = json_response({"error": message}, 503)
+    else:
+        response = make_response(render_template("error.html", message=message), 503)
+    response.headers["Retry-After"] = str(RETRY_AFTER)
+    return response
+
+
+def unavailable_response(db_file, json=False):
+    """Returns the 503 response for a request the database could not answer, even
+    after retrying; the server keeps running and the next request tries again.
+    """
+
+    print(f"Database {db_file} unable to open", file=sys.stderr)
+    return busy_response("database unavailable, try again.", json)
+
+
+def parse_facets():
+    """Returns the facets argument of the request, None if it is not an integer
+    between 1 and MAX_FACETS.
+    """
+
+    try:
+        facets = int(request.args['facets'])
+    except ValueError:
+        return None
+    return facets if 1 <= facets <= MAX_FACETS else None
+
+
+def parse_page_size():
+    """Returns the page_size argument of the request, None if it is not an integer
+    between 1 and MAX_PAGE_SIZE.
+    """
+
+    try:
+        page_size = int(request.args['page_size'])
+    except ValueError:
+        return None
+    return page_size if 1 <= page_size <= MAX_PAGE_SIZE else None
+
+
+def search_page(label_search, classification_search, agent_search, department_search,
+                facets=None):
+    """Returns one page of a '/search' as html.
+
+    The first page is a whole table, followed by the facet counts if facets is given;
+    the following pages (requested with the 'after' token of the previous page) are
+    only the rows, to be appended to its body. The token for the next page is sent in
+    the X-Next-Page header, which is absent on the last page.
+    """
+
+    page_size = parse_page_size()
+    if page_size is None:
+        abort(400, description=f"page_size must be an integer 1-{MAX_PAGE_SIZE}.")
+    after = request.args.get('after') or None
+
+    db_file = current_database()
+    function = LuxQuery(db_file).fetch_page
+    if facets and not after:
+        function = with_facets(function, facets, db_file)
+    try:
+        result = run_search(
+            function,
+            agt=agent_search, dep=department_search, classifier=classification_search,
+            label=label_search, page_size=page_size, after=after)
+    except InvalidPageTokenError as err_message:
+        abort(400, description=f"{err_message}.")
+    except SearchCancelledError:
+        abort(409, description="search superseded by a newer one.")
+    except ExecutorBusyError:
+        return busy_response("too many searches, try again.")
+    except OperationalError:
+        return unavailable_response(db_file)
+
+    if facets and not after:
+        (rows, next_token), facet_counts = result
+    else:
+        rows, next_token = result
+        facet_counts = None
+
+    if after:
+        with lux_metrics.span("render"):
+            html = format_rows(rows)
+    else:
+        html = "".join(generate_table(rows))
+        if facet_counts is not None:
+            html += format_facets(facet_counts)
+
     response = make_response(html)
+    if next_token:
+        response.headers[NEXT_PAGE_HEADER] = next_token
     return response
 
 
 @app.route('/obj/<object_id>', methods=['GET'])
 def search_obj(object_id):
-    """Function for the '/obj/<object_id>' route."""
+    """Function for the '/obj/<object_id>' route.
+
+    Details only change with the database, so the page carries a weak ETag (the
+    footer's time differs between responses) and may be cached for OBJ_MAX_AGE.
+    """
+
+    db_file = current_database()
+    etag = make_etag(database_version(db_file), request.path)
+    if not_modified(etag, weak=True):
+        return not_modified_response(etag, weak=True, max_age=OBJ_MAX_AGE)
 
     try:
-        search_response = LuxDetailsQuery(DB_NAME).search(object_id)
+        search_response = retry(LuxDetailsQuery(db_file).search_results, object_id)
     except NoSearchResultsError:
         # if no search results, abort with 404 and message
         return abort(404, description=f"no object with id {object_id} exists.")
     except OperationalError:
-        # if can not query database, then exits with 1
-        print(f"Database {DB_NAME} unable to open")
-        os._exit(1)
+        return unavailable_response(db_file)
 
     # if no exception, then render_template with luxdetails
-    search_response = json.loads(search_response)
-    html = render_template(
-        'luxdetails.html', time=asctime(localtime()), object_id=object_id,
-        search_response=search_response)
+    with lux_metrics.span("render"):
+        html = render_template(
+            'luxdetails.html', time=asctime(localtime()), object_id=object_id,
+            search_response=search_response)
     response = make_response(html)
+    response.set_etag(etag, weak=True)
+    set_max_age(response, OBJ_MAX_AGE)
 
     return response
+
+
+@app.route('/api/search', methods=['GET'])
+def api_search():
+    """Function for the '/api/search' route: the LuxQuery results as JSON.
+
+    Takes the same l, c, a, d arguments as '/search'. With page_size (and after)
+    it returns one page with the token of the next one in "next". With facets it
+    also returns the facet counts of the search in "facets".
+    """
+
+    label_search = request.args.get('l', "")
+    classification_search = request.args.get('c', "")
+    agent_search = request.args.get('a', "")
+    department_search = request.args.get('d', "")
+
+    db_file = current_database()
+    etag = make_etag(database_version(db_file), request.path,
+                     sorted(request.args.items(multi=True)))
+    if not_modified(etag):
+        return not_modified_response(etag)
+
+    facets = None
+    if 'facets' in request.args:
+        facets = parse_facets()
+        if facets is None:
+            return json_response({"error": f"facets must be an integer 1-{MAX_FACETS}."}, 400)
+
+    query = LuxQuery(db_file)
+    facet_counts = None
+    try:
+        if 'page_size' in request.args:
+            page_size = parse_page_size()
+            if page_size is None:
+                return json_response(
+                    {"error": f"page_size must be an integer 1-{MAX_PAGE_SIZE}."}, 400)
+            function = query.fetch_page
+            if facets:
+                function = with_facets(function, facets, db_file)
+            result = run_search(
+                function,
+                agt=agent_search, dep=department_search, classifier=classification_search,
+                label=label_search, page_size=page_size,
+                after=request.args.get('after') or None)
+            if facets:
+                result, facet_counts = result
+            rows, next_token = result
+            results = query.convert_to_dict(len(rows), rows)
+            results["next"] = next_token
+        else:
+            function = query.search_results
+            if facets:
+                function = with_facets(function, facets, db_file)
+            results = run_search(function, agt=agent_search,
+                                 dep=department_search, classifier=classification_search,
+                                 label=label_search)
+            if facets:
+                results, facet_counts = results
+        if facet_counts is not None:
+            results["facets"] = facet_counts
+    except InvalidPageTokenError as err_message:
+        return json_response({"error": f"{err_message}."}, 400)
+    except SearchCancelledError:
+        return json_response({"error": "search superseded by a newer one."}, 409)
+    except ExecutorBusyError:
+        return busy_response("too many searches, try again.", json=True)
+    except OperationalError:
+        return unavailable_response(db_file, json=True)
+
+    return json_response(results, etag=etag)
+
+
+@app.route('/api/obj/<object_id>', methods=['GET'])
+def api_obj(object_id):
+    """Function for the '/api/obj/<object_id>' route: the LuxDetailsQuery results as JSON."""
+
+    db_file = current_database()
+    etag = make_etag(database_version(db_file), request.path)
+    if not_modified(etag):
+        return not_modified_response(etag, max_age=OBJ_MAX_AGE)
+
+    try:
+        results = retry(LuxDetailsQuery(db_file).search_results, object_id)
+    except NoSearchResultsError:
+        return json_response({"error": f"no object with id {object_id} exists."}, 404)
+    except OperationalError:
+        return unavailable_response(db_file, json=True)
+
+    response = json_response(results, etag=etag)
+    set_max_age(response, OBJ_MAX_AGE)
+    return response
+
+
+@app.route('/api/objs', methods=['GET'])
+def api_objs():
+    """Function for the '/api/objs' route: the LuxDetailsQuery results of up to
+    MAX_BATCH_IDS objects as JSON, for ids=<id>,<id>,... in one request.
+
+    The results are in "objects", keyed by id in the requested order; the ids without
+    an object are listed in "missing".
+    """
+
+    obj_ids = list(dict.fromkeys(
+        obj_id.strip() for obj_id in request.args.get('ids', "").split(",") if obj_id.strip()))
+    if not obj_ids:
+        return json_response({"error": "ids must list at least one object id."}, 400)
+    if len(obj_ids) > MAX_BATCH_IDS:
+        return json_response(
+            {"error": f"ids must list at most {MAX_BATCH_IDS} object ids."}, 400)
+
+    db_file = current_database()
+    etag = make_etag(database_version(db_file), request.path, obj_ids)
+    if not_modified(etag):
+        return not_modified_response(etag, max_age=OBJ_MAX_AGE)
+
+    try:
+        results = retry(LuxDetailsQuery(db_file).search_many, obj_ids)
+    except OperationalError:
+        return unavailable_response(db_file, json=True)
+
+    response = json_response(
+        {"objects": {obj_id: result for obj_id, result in results.items() if result is not None},
+         "missing": [obj_id for obj_id, result in results.items() if result is None]},
+        etag=etag)
+    set_max_age(response, OBJ_MAX_AGE)
+    return response
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """Function for the '/stats' route: connection pool, result cache, search executor
+    and coalescing counters, the search engine's memory report and the snapshot
+    served as JSON.
+    """
+
+    return jsonify({"pools": pool_stats(), "export_pools": pool_stats("export"),
+                    "caches": cache_stats(),
+                    "executor": executor_stats(), "coalescing": single_flight_stats(),
+                    "engine": engine_stats(),
+                    "snapshot": snapshot_stats()})
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Function for the '/metrics' route: the timing histograms of this process in the
+    Prometheus text format.
+    """
+
+    return Response(lux_metrics.render_prometheus(),
+                    mimetype="text/plain; version=0.0.4")
@@ -1,18 +1,134 @@
 """Module handling queries for the database."""
 
+import base64
 import json
+import re
+import time
+
+from contextlib import closing, contextmanager
+from functools import lru_cache
+from sqlite3 import OperationalError
+
+from lux_cache import get_cache, normalize_term
+from lux_coalesce import get_single_flight
+from lux_index import ensure_index, source_signature
+from lux_memory import ENGINE_SETTINGS, FACETS, get_engine
+from lux_metrics import add_time, observe, span, log_slow_query
+from lux_pool import get_pool
+from lux_query_sql import (QUERY_FACET_COUNTS, QUERY_FACET_COUNTS_INDEXED,
+                           QUERY_FACET_MATCHES, QUERY_FACET_MATCHES_INDEXED,
+                           QUERY_FACET_TOP_INDEXED, QUERY_FACET_TOTAL, QUERY_LUX,
+                           QUERY_LUX_COLUMNS,
+                           QUERY_LUX_FILTERS, QUERY_LUX_INDEXED,
+                           QUERY_LUX_INDEXED_COLUMNS, QUERY_LUX_INDEXED_MATCH,
+                           QUERY_LUX_WHERE,
+                           QUERY_LUX_INDEXED_MATCH_COUNT,
+                           QUERY_LUX_INDEXED_RANKS, QUERY_LUX_ROW,
+                           QUERY_DETAILS_OBJECT, QUERY_DETAILS_AGENTS,
+                           QUERY_DETAILS_NATIONALITIES, QUERY_DETAILS_CLASSIFIERS,
+                           QUERY_DETAILS_REFERENCES, QUERY_DETAILS_PLACES,
+                           QUERY_DETAILS_MANY_OBJECTS, QUERY_DETAILS_MANY_AGENTS,
+                           QUERY_DETAILS_MANY_NATIONALITIES, QUERY_DETAILS_MANY_CLASSIFIERS,
+                           QUERY_DETAILS_MANY_REFERENCES, QUERY_DETAILS_MANY_PLACES)
+
+
+# maximum number of rows returned by LuxQuery.search
+MAX_RESULTS = 1000
+
+# number of rows read from the cursor at a time when streaming results
+FETCH_BATCH = 100
+
+# a trigram MATCH with at least this many rows is not used: the rows are read in
+# rank order and tested with LIKE instead, which stops once the page is full
+RANK_SCAN_MATCHES = 4000
+
+# number of distinct agent dates whose parsed year is remembered
+DATE_CACHE_SIZE = 65536
+
+# the year of a date that is not a plain '%Y-%m-%d': partial ("1850-03", "1850"),
+# BCE ("-0500-01-01", "500 BCE", "44 B.C.") or with text around it ("c. 1850")
+_YEAR_PATTERN = re.compile(r"(-)?(\d{1,4})(?:-\d{1,2}){0,2}(\s*B\.?\s?C\.?(?:E\.?)?)?",
+                           re.IGNORECASE)
+
+
+def database_version(db_file):
+    """Returns the version of the database file that cached results are tagged with.
+
+    Args:
+        db_file (str): database file
+    Return:
+        tuple: (db_file, size, mtime), None if the file does not exist
+    """
+
+    try:
+        return (db_file,) + source_signature(db_file)
+    except OSError:
+        return None
+
+
+@lru_cache(maxsize=DATE_CACHE_SIZE)
+def parse_year(date):
+    """Returns the year of an agent's begin or end date, as shown in timespans.
+
+    Args:
+        date (str): date, usually '%Y-%m-%d', may be None
+    Return:
+        str: e.g. "1850", "500 BCE", or "" if the date is missing or has no year
+    """
+
+    if not date:
+        return ""
 
-from contextlib import closing
-from sqlite3 import connect
-from datetime import datetime
+    # plain '%Y-%m-%d' dates need no regular expression
+    if len(date) == 10 and date[4] == "-" and date[7] == "-" and date[:4].isdigit():
+        return str(int(date[:4]))
 
-from lux_query_sql import QUERY_LUX
+    match = _YEAR_PATTERN.search(date)
+    if match is None:
+        return ""
+    year = int(match.group(2))
+    if match.group(1) or match.group(3):
+        return f"{year} BCE"
+    return str(year)
 
 
 class NoSearchResultsError(Exception):
     """Exception class to handle no search results."""
 
 
+class InvalidPageTokenError(Exception):
+    """Exception class to handle a page token that can not be used for a search."""
+
+
+class SearchCancelledError(Exception):
+    """Exception class to handle a search cancelled before it finished."""
+
+
+@contextmanager
+def cancellable(connection, cancel):
+    """Context manager letting cancel (see lux_executor.CancelToken) interrupt the
+    statements run on connection inside it.
+
+    Raises:
+        SearchCancelledError: if the search was cancelled, before or while it ran
+    """
+
+    if cancel is None:
+        yield
+        return
+
+    cancel.attach(connection)
+    try:
+        yield
+    except OperationalError as err_message:
+        # an interrupted statement fails with "interrupted"
+        if cancel.cancelled:
+            raise SearchCancelledError from err_message
+        raise
+    finally:
+        cancel.detach()
+
+
 class Query():
     """Abstract Query Class for querying databases.
     Query should be instantiated as LuxQuery or LuxDetailsQuery.
@@ -36,6 +152,11 @@ class Query():
 
         raise NotImplementedError
 
+    def convert_to_dict(self, data1, data2):
+        """Function to convert data to the response dictionary"""
+
+        raise NotImplementedError
+
     def format_data(self, data):
         """Function used to format data."""
 
@@ -48,20 +169,23 @@ class LuxQuery(Query):
     Stores the columns for the output table.
     """
 
-    def __init__(self, db_file):
+    def __init__(self, db_file, engine=None):
         """Initalizes the class with the database file and
         the columns and format_str for the output table.
         Args:
             db_file (str): database file
+            engine (str): "sql" or "memory" (see lux_memory.py),
+                ENGINE_SETTINGS["engine"] by default
         """
 
         self._db_file = db_file
+        self._engine = engine or ENGINE_SETTINGS["engine"]
         self._columns = ["ID", "Label", "Date",
                          "Produced By", "Classified As"]
         self._format_str = ["w", "w", "w", "w", "w", "p"]
 
     def search(self, dep=None, agt=None, classifier=None, label=None):
-        """Opens a connection to the database and uses the given argument to create a
+        """Borrows a pooled connection to the database and uses the given argument to create a
         SQL statement that query the database satisfying the search criteria.
 
         Args:
@@ -74,76 +198,634 @@ class LuxQuery(Query):
 
         Arguments are by default None if not passed in.
         If no arguments are passed in output includes first 1000 objects in the database.
+        Results are cached per database file, keyed by the ASCII-lowercased terms
+        (LIKE is case-insensitive for ASCII only) and the resulting sort order.
 
         Sort Order:
             Sorted first by object label/date, then by agent name/part,
             then by classifier, then by department name.
         """
 
-        with connect(self._db_file, isolation_level=None, uri=True) as connection:
+        results = self.search_results(dep, agt, classifier, label)
+        with span("json"):
+            return json.dumps(results)
+
+    def search_results(self, dep=None, agt=None, classifier=None, label=None, cancel=None):
+        """Same as search, but returns the results as a dictionary instead of a json string.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            cancel (CancelToken): lets another thread interrupt the search
+        Return:
+            dict: search_count, columns, format_str and data of the results
+        Raises:
+            SearchCancelledError: if the search was cancelled
+        """
+
+        data = list(self.iter_rows(dep, agt, classifier, label, cancel))
+        with span("convert"):
+            return self.convert_to_dict(len(data), data)
+
+    def iter_rows(self, dep=None, agt=None, classifier=None, label=None, cancel=None):
+        """Generator yielding the rows of a search as they are read from the database,
+        so callers can start responding before the query has finished.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            cancel (CancelToken): lets another thread interrupt the search
+        Yields:
+            tuple: (id, label, date, artist, classification) rows, at most 1000
+
+        Results are cached per database file, keyed by the ASCII-lowercased terms
+        (LIKE is case-insensitive for ASCII only) and the resulting sort order. Rows are
+        only cached once the generator has been consumed completely. A search identical
+        to one already running waits for it instead of running again.
+        """
+
+        order = self.sort_order(agt, classifier)
+
+        # serve repeated searches from the result cache (see lux_cache.py)
+        cache = get_cache(self._db_file)
+        key = (normalize_term(label), normalize_term(classifier),
+               normalize_term(agt), normalize_term(dep), order)
+        version = database_version(self._db_file)
+
+        if version is not None:
+            with span("cache"):
+                cached = cache.get(key, version)
+            if cached is not None:
+                yield from cached
+                return
+
+        # a search that only narrows a recent complete search (typing "port" after
+        # "por") is answered from that search's ids instead of the whole collection;
+        # the in-memory engine has no use for them
+        terms = key[:4]
+        candidates = None
+        if version is not None and self._engine != "memory":
+            candidates = cache.find_candidates(terms, version)
+
+        # identical searches running at the same time share one execution
+        flight = get_single_flight(self._db_file)
+        flight_key = (version,) + key
+        call, leader = flight.join(flight_key)
+        if not leader:
+            shared, rows = call.wait(cancel)
+            if shared:
+                yield from rows
+                return
+
+        data = []
+        try:
+            for row in self.fetch_rows(dep, agt, classifier, label, candidates,
+                                       cancel=cancel):
+                data.append(row)
+                yield row
+        except BaseException:
+            # failed, cancelled or not read to the end: the waiting searches run themselves
+            if leader:
+                flight.leave(flight_key, call, ok=False)
+            raise
+
+        rows = tuple(data)
+        if leader:
+            flight.leave(flight_key, call, rows)
+        if version is not None:
+            if len(rows) < MAX_RESULTS:
+                cache.remember_ids(terms, version, [row[0] for row in rows])
+            cache.put(key, version, rows)
+
+    def facet_counts(self, dep=None, agt=None, classifier=None, label=None, size=10,
+                     cancel=None):
+        """Returns the most frequent departments, classifiers and agent names among all
+        the objects a search matches, with the number of objects having each of them.
+        The counts are exact even though search returns at most 1000 rows.
+
+        With the in-memory engine they are counted from its posting lists (see
+        lux_memory.py); otherwise by SQLite, see count_facets.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            size (int): number of values per facet
+            cancel (CancelToken): lets another thread interrupt the search
+        Return:
+            dict: "total" number of matching objects and, for each of "department",
+            "classifier" and "agent", [value, number of objects] pairs, most objects first
+            (shared with the facet cache, so it must not be modified)
+        Raises:
+            SearchCancelledError: if the search was cancelled
+        """
+
+        cache = get_cache(self._db_file, "facets")
+        key = (normalize_term(label), normalize_term(classifier),
+               normalize_term(agt), normalize_term(dep), size)
+        version = database_version(self._db_file)
+        if version is not None:
+            with span("cache"):
+                cached = cache.get(key, version)
+            if cached is not None:
+                return cached
+
+        engine = get_engine(self._db_file) if self._engine == "memory" else None
+        if engine is not None:
+            if cancel is not None and cancel.cancelled:
+                raise SearchCancelledError
+            with span("facets"):
+                counts = engine.facet_counts(dep, agt, classifier, label, size)
+        else:
+            with span("facets"):
+                counts = self.count_facets(dep, agt, classifier, label, size, cancel)
+
+        if version is not None:
+            cache.put(key, version, counts)
+        return counts
+
+    def count_facets(self, dep, agt, classifier, label, size, cancel=None):
+        """Counts the facets of a search with SQLite, grouping the facet values of the
+        matching objects without sorting the matches.
+
+        With the search index, the values are counted by their codes in search_facets,
+        and when more than half the objects match, the values of the objects not
+        matching are counted instead and subtracted from the totals of the values.
+        Without it, one statement joins the matches to the values in the collection.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            size (int): number of values per facet
+            cancel (CancelToken): lets another thread interrupt the statements
+        Return:
+            dict: the counts, see facet_counts
+        Raises:
+            SearchCancelledError: if the search was cancelled
+        """
+
+        index_file = ensure_index(self._db_file)
+        use_index = index_file is not None
+        terms = (dep, label, agt, classifier)
+        given = tuple(bool(term) for term in terms)
+        where_str = QUERY_LUX_WHERE[use_index, given]
+        where_params = [f"%{term}%" for term in terms if term]
+        # every match is counted, so the trigram index narrows the LIKE scan whenever
+        # a term can use it
+        if use_index:
+            match_str = self.match_expression(
+                [(column, term) for column, term in zip(QUERY_LUX_FILTERS, terms) if term])
+            if match_str:
+                where_str += f" AND {QUERY_LUX_INDEXED_MATCH}"
+                where_params.append(match_str)
+
+        counts = dict({"total": 0}, **{facet: [] for facet in FACETS})
+        with get_pool(index_file if use_index else self._db_file).connection() as connection, \
+                cancellable(connection, cancel):
             with closing(connection.cursor()) as cursor:
-                # making query backbone to be used in each of the 4 queries below
-                smt_str = QUERY_LUX
-                smt_count = 0
-                smt_params = []
-
-                # WHERE clause
-                if dep or label or agt or classifier:
-                    smt_str += " WHERE"
-                if dep:
-                    smt_str += " department.dep_name LIKE ?"
-                    smt_params.append(f"%{dep}%")
-                    smt_count += 1
-                if label:
-                    if smt_count >= 1:
-                        smt_str += " AND"
-                    smt_str += " objects.label LIKE ?"
-                    smt_params.append(f"%{label}%")
-                    smt_count += 1
-                if agt:
-                    if smt_count >= 1:
-                        smt_str += " AND"
-                    smt_str += " agent.artist LIKE ?"
-                    smt_count += 1
-                    smt_params.append(f"%{agt}%")
-                if classifier:
-                    if smt_count >= 1:
-                        smt_str += " AND"
-                    smt_str += " classifier.classification LIKE ?"
-                    smt_count += 1
-                    smt_params.append(f"%{classifier}%")
 
-                smt_str += " GROUP BY objects.id, objects.label"
+                def execute(smt_str, smt_params):
+                    start = time.perf_counter()
+                    cursor.execute(smt_str, smt_params)
+                    rows = cursor.fetchall()
+                    log_slow_query(cursor, smt_str, smt_params, time.perf_counter() - start)
+                    return rows
+
+                if use_index:
+                    objects, counts["total"] = execute(
+                        QUERY_FACET_TOTAL + where_str + ")", where_params)[0]
+                    broad = counts["total"] * 2 > objects
+                    rows = execute(QUERY_FACET_MATCHES_INDEXED[broad] + where_str
+                                   + QUERY_FACET_COUNTS_INDEXED[broad]
+                                   + QUERY_FACET_TOP_INDEXED, where_params + [size])
+                else:
+                    rows = execute(QUERY_FACET_MATCHES + where_str + ")" + QUERY_FACET_COUNTS,
+                                   where_params + [size])
+
+        for facet, value, hits in rows:
+            if facet is None:
+                counts["total"] = hits
+            else:
+                counts[facet].append([value, hits])
+        return counts
+
+    def export_rows(self, dep=None, agt=None, classifier=None, label=None, cancel=None):
+        """Generator yielding every row of a search, in the order of search but without
+        the 1000 rows cap, for exporting the full results (see lux_export.py).
+
+        Rows are streamed from SQLite in batches of FETCH_BATCH, bypassing the result
+        cache, so memory use does not depend on the number of results. The in-memory
+        engine is not used since it builds the whole result as a list. The connection
+        is held until the last row is read, so it comes from the small export pool
+        instead of the one searches share (see lux_pool.EXPORT_POOL_SIZE).
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            cancel (CancelToken): lets another thread interrupt the search
+        Yields:
+            tuple: (id, label, date, artist, classification) rows, see QUERY_LUX_ROW
+        Raises:
+            SearchCancelledError: if the search was cancelled
+            PoolTimeoutError: if every export connection stayed busy for EXPORT_TIMEOUT
+        """
+
+        query = LuxQuery(self._db_file, engine="sql")
+        yield from query.fetch_rows(dep, agt, classifier, label, limit=None, cancel=cancel,
+                                    pool="export")
+
+    def fetch_page(self, dep=None, agt=None, classifier=None, label=None,
+                   page_size=100, after=None, cancel=None):
+        """Returns one page of the search results, using keyset pagination: a page
+        continues after the sort key of the previous page's last row instead of
+        skipping an offset, so deep pages cost no more than the first one and the
+        results are not capped at 1000.
+
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            page_size (int): number of rows per page
+            after (str): opaque token returned with the previous page, None for the first
+            cancel (CancelToken): lets another thread interrupt the search
+        Return:
+            tuple: (rows, token of the next page or None if this is the last page)
+        Raises:
+            InvalidPageTokenError: if the token is malformed or belongs to another sort order
+            SearchCancelledError: if the search was cancelled
+        """
+
+        keys = self.sort_keys(agt, classifier)
+        after_values = self.decode_page_token(after, keys) if after else None
+        terms = (normalize_term(label), normalize_term(classifier), normalize_term(agt),
+                 normalize_term(dep))
+        order = self.sort_order(agt, classifier)
+        version = database_version(self._db_file)
+
+        # serve repeated pages from the page cache (see lux_cache.py)
+        cache = get_cache(self._db_file, "pages")
+        key = terms + (order, page_size, after)
+        if version is not None:
+            with span("cache"):
+                cached = cache.get(key, version)
+            if cached is not None:
+                rows, next_token = cached
+                return list(rows), next_token
+
+        candidates = None
+        if version is not None:
+            search_cache = get_cache(self._db_file)
+            # the first page is a prefix of the cached results of the same search, when
+            # they hold more rows than the page or all the matches
+            if after is None:
+                with span("cache"):
+                    results = search_cache.get(terms + (order,), version)
+                if results is not None and (len(results) > page_size
+                                            or len(results) < MAX_RESULTS):
+                    page = self.make_page(keys, results[:page_size + 1], page_size)
+                    cache.put(key, version, page)
+                    return list(page[0]), page[1]
+            # a search that only narrows a recent complete search reads only its ids
+            if self._engine != "memory":
+                candidates = search_cache.find_candidates(terms, version)
+
+        def fetch():
+            return self.make_page(keys, tuple(self.fetch_rows(
+                dep, agt, classifier, label, candidates, after=after_values,
+                limit=page_size + 1, cancel=cancel)), page_size)
+
+        # identical page requests running at the same time share one execution
+        flight_key = (version, "page") + key
+        page = get_single_flight(self._db_file).run(flight_key, fetch, cancel)
+        if version is not None:
+            # a first page that is also the last one holds every match, so later
+            # searches narrowing this one can be refined from its ids
+            if after is None and page[1] is None:
+                get_cache(self._db_file).remember_ids(terms, version,
+                                                      [row[0] for row in page[0]])
+            cache.put(key, version, page)
+        return list(page[0]), page[1]
+
+    def make_page(self, keys, rows, page_size):
+        """Returns a page out of the rows following the previous page.
 
-                # create the sort order for the query based on present args
-                sort_str = " ORDER BY objects.label, objects.date, "
-                sort_list = []
-                params_list = {
-                    agt: 'agent.artist',
-                    classifier:  'classifier.classification',
-                }
+        Args:
+            keys (tuple): the sort key columns, see sort_keys
+            rows (tuple): up to page_size + 1 rows, in sort order
+            page_size (int): number of rows per page
+        Return:
+            tuple: (rows, token of the next page or None if this is the last page)
+        """
 
-                for key, value in params_list.items():
-                    if key:
-                        sort_list.append(value)
+        if len(rows) > page_size:
+            rows = rows[:page_size]
+            return rows, self.encode_page_token(keys, rows[-1])
+        return rows, None
 
-                for key, value in params_list.items():
-                    if not key:
-                        sort_list.append(value)
+    def fetch_rows(self, dep=None, agt=None, classifier=None, label=None, candidates=None,
+                   after=None, limit=MAX_RESULTS, cancel=None, pool="search"):
+        """Generator running the search against the database, bypassing the result cache.
+        Rows are read from the cursor in batches and yielded one at a time.
 
-                param_sort_str = sort_str + ", ".join(sort_list)
-                smt_str += param_sort_str
-                smt_str += " LIMIT 1000"
+        Args:
+            dep (str): selected department
+            agt (str): selected agent
+            classifer: selected slassifer
+            label: selected label
+            candidates (set): if given, only objects with these ids are considered
+            after (list): if given, only rows sorting after these sort key values
+            limit (int): maximum number of rows, None for all of them
+            cancel (CancelToken): lets another thread interrupt the statement
+            pool (str): kind of connection pool read from, see lux_pool.get_pool
+        Yields:
+            tuple: (id, label, date, artist, classification) rows, see QUERY_LUX_ROW
+        Raises:
+            SearchCancelledError: if the search was cancelled
+        """
 
-                # execute the statement and fetch the results
+        # answer from the in-memory engine once it is loaded (see lux_memory.py);
+        # it finds the same rows as the query below, so candidates only matter to SQL
+        engine = get_engine(self._db_file) if self._engine == "memory" else None
+        if engine is not None:
+            if cancel is not None and cancel.cancelled:
+                raise SearchCancelledError
+            with span("memory"):
+                rows = engine.search(dep, agt, classifier, label,
+                                     self.sort_order(agt, classifier), after, limit)
+            yield from rows
+            return
+
+        # use the precomputed search index when it is available (see lux_index.py)
+        index_file = ensure_index(self._db_file)
+        use_index = index_file is not None
+        if use_index:
+            db_file = index_file
+            columns = QUERY_LUX_INDEXED_COLUMNS
+        else:
+            db_file = self._db_file
+            columns = QUERY_LUX_COLUMNS
+
+        with get_pool(db_file, pool).connection() as connection, \
+                cancellable(connection, cancel):
+            with closing(connection.cursor()) as cursor:
+                # query backbone and the prebuilt WHERE clause of the given terms
+                terms = (dep, label, agt, classifier)
+                given = tuple(bool(term) for term in terms)
+                smt_str = ((QUERY_LUX_INDEXED if use_index else QUERY_LUX)
+                           + QUERY_LUX_WHERE[use_index, given])
+                smt_count = sum(given)
+                smt_params = [f"%{term}%" for term in terms if term]
+                match_terms = [(column, term) for column, term
+                               in zip(QUERY_LUX_FILTERS, terms) if term]
+
+                # narrow the LIKE scan down to the candidates or with the trigram index
+                match_str = ""
+                if candidates is not None:
+                    smt_str += " AND" if smt_count >= 1 else " WHERE"
+                    smt_str += f" {columns['id']} IN (SELECT value FROM json_each(?))"
+                    smt_params.append(json.dumps(list(candidates)))
+                    smt_count += 1
+                elif use_index:
+                    match_str = self.match_expression(match_terms)
+                # a broad match is left to the LIKE predicates, checked on the rows as
+                # they are read in rank order until the page is full
+                if match_str and not self.broad_match(cursor, match_str):
+                    smt_str += f" AND {QUERY_LUX_INDEXED_MATCH}"
+                    smt_params.append(match_str)
+
+                # create the sort order for the query based on present args,
+                # with the object id last so every row has a unique position
+                sort_list = [columns[column] for column in self.sort_keys(agt, classifier)]
+
+                # continue after the last row of the previous page
+                if after is not None:
+                    keyset_str, keyset_params = self.keyset_predicate(sort_list, after)
+                    smt_str += " AND" if smt_count >= 1 else " WHERE"
+                    smt_str += f" {keyset_str}"
+                    smt_params.extend(keyset_params)
+
+                # the index ranks every object in the sort order, so the rows are read
+                # in the order of the rank index instead of all being sorted
+                if use_index:
+                    rank = QUERY_LUX_INDEXED_RANKS[self.sort_order(agt, classifier)]
+                    if after is not None:
+                        rank_str, rank_params = self.rank_predicate(rank, sort_list, after)
+                        smt_str += f" AND {rank_str}"
+                        smt_params.extend(rank_params)
+                    smt_str += f" GROUP BY {rank} ORDER BY {rank}"
+                else:
+                    smt_str += f" GROUP BY {columns['id']}, {columns['label']}"
+                    smt_str += " ORDER BY " + ", ".join(sort_list)
+                if limit is not None:
+                    smt_str += f" LIMIT {int(limit)}"
+
+                # execute the statement and stream the results; only the time spent
+                # in SQLite counts as sql, not the time the caller takes between rows
+                start = time.perf_counter()
                 cursor.execute(smt_str, smt_params)
-                data = cursor.fetchall()
-                search_count = len(data)
-        return self.convert_to_json(search_count, data)
+                rows = cursor.fetchmany(FETCH_BATCH)
+                sql_seconds = time.perf_counter() - start
+                add_time("sql", sql_seconds)
+                try:
+                    while rows:
+                        yield from rows
+                        start = time.perf_counter()
+                        rows = cursor.fetchmany(FETCH_BATCH)
+                        elapsed = time.perf_counter() - start
+                        add_time("sql", elapsed)
+                        sql_seconds += elapsed
+                finally:
+                    observe("sql", sql_seconds)
+                    log_slow_query(cursor, smt_str, smt_params, sql_seconds)
+
+    @staticmethod
+    def sort_order(agt, classifier):
+        """Returns the columns the results are sorted by after label and date:
+        the agent and classifier columns with the filtered ones first.
+
+        Args:
+            agt (str): selected agent
+            classifer: selected slassifer
+        Return:
+            tuple: column names, e.g. ("artist", "classification")
+        """
+
+        sort_list = []
+        # keyed by the search terms, so equal terms collapse into a single column
+        params_list = {
+            agt: 'artist',
+            classifier: 'classification',
+        }
+
+        for key, value in params_list.items():
+            if key:
+                sort_list.append(value)
+
+        for key, value in params_list.items():
+            if not key:
+                sort_list.append(value)
+
+        return tuple(sort_list)
+
+    def sort_keys(self, agt, classifier):
+        """Returns every column the results are sorted by, ending with the object id.
+
+        Args:
+            agt (str): selected agent
+            classifer: selected slassifer
+        Return:
+            tuple: column names, e.g. ("label", "date", "artist", "classification", "id")
+        """
+
+        return ("label", "date") + self.sort_order(agt, classifier) + ("id",)
+
+    @staticmethod
+    def keyset_predicate(sort_list, values):
+        """Builds the WHERE predicate selecting the rows that sort after the given values.
+
+        SQLite sorts NULL first, so nothing sorts before a NULL, and IS is used for
+        the equality tests so NULLs compare equal to each other.
+
+        Args:
+            sort_list (list): the ORDER BY columns
+            values (list): the sort key values of the last row already seen
+        Return:
+            tuple: (predicate str, list of its parameters)
+        """
+
+        clauses = []
+        params = []
+        for index, value in enumerate(values):
+            parts = []
+            for column, prev_value in zip(sort_list[:index], values[:index]):
+                parts.append(f"{column} IS ?")
+                params.append(prev_value)
+            if value is None:
+                parts.append(f"{sort_list[index]} IS NOT NULL")
+            else:
+                parts.append(f"{sort_list[index]} > ?")
+                params.append(value)
+            clauses.append("(" + " AND ".join(parts) + ")")
+        predicate = "(" + " OR ".join(clauses) + ")"
+
+        # a redundant bound on the first column lets an index on it seek past the key
+        if values[0] is not None:
+            predicate = f"{sort_list[0]} >= ? AND {predicate}"
+            params.insert(0, values[0])
+        return predicate, params
+
+    @staticmethod
+    def rank_predicate(rank, sort_list, values):
+        """Builds the WHERE predicate selecting the rows ranked after the row with the
+        given sort key values, so the rank index is read from there on.
+
+        A row that is no longer in the index (the token was made before it changed)
+        gives no bound, leaving the rows to keyset_predicate alone.
+
+        Args:
+            rank (str): the rank column, see QUERY_LUX_INDEXED_RANKS
+            sort_list (list): the ORDER BY columns, ending with the object id
+            values (list): the sort key values of the last row already seen
+        Return:
+            tuple: (predicate str, list of its parameters)
+        """
+
+        tests = " AND ".join(f"{column} IS ?" for column in sort_list)
+        return (f"{rank} > COALESCE((SELECT {rank} FROM search_rows WHERE {tests} LIMIT 1), 0)",
+                list(values))
+
+    @staticmethod
+    def broad_match(cursor, match_str):
+        """Returns whether a trigram MATCH expression matches RANK_SCAN_MATCHES rows or
+        more, which are better read in rank order than looked up and sorted.
+
+        Args:
+            cursor: cursor on the search index
+            match_str (str): FTS5 MATCH expression, see match_expression
+        """
+
+        cursor.execute(QUERY_LUX_INDEXED_MATCH_COUNT, [match_str, RANK_SCAN_MATCHES])
+        return cursor.fetchone()[0] >= RANK_SCAN_MATCHES
+
+    @staticmethod
+    def encode_page_token(keys, row):
+        """Returns the opaque token for the page following the given row.
+
+        Args:
+            keys (tuple): the sort key columns
+            row (tuple): the last row of the current page
+        Return:
+            str: url-safe token
+        """
+
+        values = [row[QUERY_LUX_ROW.index(key)] for key in keys]
+        token = json.dumps([keys, values], separators=(",", ":"))
+        return base64.urlsafe_b64encode(token.encode()).decode().rstrip("=")
+
+    @staticmethod
+    def decode_page_token(token, keys):
+        """Returns the sort key values stored in a token made by encode_page_token.
+
+        Args:
+            token (str): the token
+            keys (tuple): the sort key columns of the current search
+        Return:
+            list: sort key values
+        Raises:
+            InvalidPageTokenError: if the token is malformed or was made for other keys
+        """
+
+        try:
+            padded = token + "=" * (-len(token) % 4)
+            token_keys, values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        except (ValueError, TypeError) as err_message:
+            raise InvalidPageTokenError("malformed page token") from err_message
+
+        # only the column values a row can hold may reach the query parameters
+        if not isinstance(token_keys, list) or not isinstance(values, list) \
+                or any(type(value) not in (str, int, float) and value is not None
+                       for value in values):
+            raise InvalidPageTokenError("malformed page token")
+        if tuple(token_keys) != tuple(keys) or len(values) != len(keys):
+            raise InvalidPageTokenError("page token does not belong to this search")
+        return values
+
+    @staticmethod
+    def match_expression(terms):
+        """Builds an FTS5 MATCH expression for the trigram index out of the search terms.
+
+        Terms shorter than three characters cannot be looked up in a trigram index and
+        terms containing LIKE wildcards (% or _) do not match literally, so those are
+        left to the LIKE predicates alone. The LIKE predicates are always kept, which
+        keeps the results identical to the unindexed query.
+
+        Args:
+            terms (list): (column, term) pairs
+        Return:
+            str: MATCH expression, empty if no term can use the index
+        """
+
+        phrases = []
+        for column, term in terms:
+            if len(term) < 3 or "%" in term or "_" in term:
+                continue
+            phrase = term.replace('"', '""')
+            phrases.append(f'{column} : "{phrase}"')
+
+        return " AND ".join(phrases)
 
     def convert_to_json(self, data1, data2):
-        """Takes in the search_count and data and convert it to a json format
-        while parsing the data to split agent and part and switching object date and object agent.
+        """Takes in the search_count and data and convert it to a json format.
 
         Args:
             data1: search_count (int)
@@ -153,28 +835,29 @@ class LuxQuery(Query):
             str: json string
         """
 
-        search_count = data1
-        data = data2
+        return json.dumps(self.convert_to_dict(data1, data2))
 
-        for index, row in enumerate(data):
-            # drop department
-            row = row[:4] + row[5:]
+    def convert_to_dict(self, data1, data2):
+        """Takes in the search_count and data and convert it to the response dictionary.
+        The rows are already selected in the order of the columns (see QUERY_LUX_ROW),
+        so they are used as they are, without copying.
 
-            # switch object date and object agent
-            object_date = row[3]
-            object_agent = row[2]
-            row = row[:2] + (object_date,) + (object_agent, ) + row[4:]
+        Args:
+            data1: search_count (int)
+            data2: data (list)
 
-            data[index] = row
+        Return:
+            dict: search_count, columns, format_str and data
+        """
 
         database_response = {
-            "search_count": search_count,
+            "search_count": data1,
             "columns": self._columns,
             "format_str": self._format_str,
-            "data": data
+            "data": data2
         }
 
-        return json.dumps(database_response)
+        return database_response
 
     def format_data(self, data):
         pass
@@ -198,7 +881,7 @@ class LuxDetailsQuery(Query):
         self._format_str_information = ["w", "w"]
 
     def search(self, obj_id):
-        """Opens a connection to the database and uses the given argument to create a
+        """Borrows a pooled connection to the database and uses the given argument to create a
         SQL statement that query the database by object id and returns the object's information.
 
         Args:
@@ -208,68 +891,209 @@ class LuxDetailsQuery(Query):
             str: json formatted data of the object
         """
 
-        with connect(self._db_file, isolation_level=None, uri=True) as connection:
-            with closing(connection.cursor()) as cursor:
-                # objects.label, productions.part, agents.name, nationalities.descriptor,
-                # agents.begin_date, agents.end_date, classifiers.name
-                smt_str = "SELECT DISTINCT objects.label, productions.part, agents.name,"
-                smt_str += "agents.begin_date, agents.end_date,"
-                smt_str += " nationalities.descriptor, classifiers.name,"
-                smt_str += " \"references\".type, \"references\".content, agents.id,"
-                # fetch additional data
-                smt_str += " objects.accession_no, objects.date, places.label"
-                # joining objects and agents using productions
-                smt_str += " FROM objects LEFT OUTER JOIN"
-                smt_str += " productions ON productions.obj_id = objects.id"
-                smt_str += " LEFT OUTER JOIN agents on productions.agt_id = agents.id"
-                # joining nationalities using agents_nationalities
-                smt_str += " LEFT OUTER JOIN agents_nationalities"
-                smt_str += " ON agents_nationalities.agt_id = agents.id"
-                smt_str += " LEFT OUTER JOIN nationalities ON"
-                smt_str += " nationalities.id = agents_nationalities.nat_id"
-                # joining references
-                smt_str += " LEFT OUTER JOIN \"references\" ON \"references\".obj_id = objects.id"
-                # joining classifiers using objects_classifiers
-                smt_str += " LEFT OUTER JOIN objects_classifiers ON"
-                smt_str += " objects_classifiers.obj_id = objects.id"
-                smt_str += " LEFT OUTER JOIN classifiers"
-                smt_str += " ON classifiers.id = objects_classifiers.cls_id"
-                # joining places using objects_places
-                smt_str += " LEFT OUTER JOIN objects_places ON objects_places.obj_id = objects.id"
-                smt_str += " LEFT OUTER JOIN places ON objects_places.pl_id = places.id"
-                smt_str += " WHERE objects.id = ?"
-                smt_params = [obj_id]
-
-                # execute the statement and fetch the results
-                cursor.execute(smt_str, smt_params)
-                data = cursor.fetchall()
-                if not data:
-                    raise NoSearchResultsError
+        return json.dumps(self.search_results(obj_id))
+
+    def search_results(self, obj_id):
+        """Same as search, but returns the object's information as a dictionary
+        instead of a json string.
+
+        Args:
+            obj_id (str): object's id
+
+        Return:
+            dict: columns, formats, agents and object of the object's information
+            (shared with the detail cache, so it must not be modified)
+        """
+
+        # details only change with the database, so serve them from the detail cache
+        cache = get_cache(self._db_file, "details")
+        version = database_version(self._db_file)
+        if version is not None:
+            with span("cache"):
+                cached = cache.get(str(obj_id), version)
+            if cached is not None:
+                return cached
+
+        with span("sql"):
+            with get_pool(self._db_file).connection() as connection:
+                with closing(connection.cursor()) as cursor:
+                    # read every relation from the same snapshot of the database
+                    cursor.execute("BEGIN")
+                    try:
+                        data = self.fetch_details(cursor, obj_id)
+                    finally:
+                        cursor.execute("COMMIT")
+
+        result = self.build_result(data)
+        if version is not None:
+            cache.put(str(obj_id), version, result)
+        return result
+
+    def search_many(self, obj_ids):
+        """Returns the information of many objects, reading all the ones not in the
+        detail cache with one query per relation instead of one per object.
+
+        Args:
+            obj_ids (list): objects' ids (str)
+
+        Return:
+            dict: for each distinct id, in the given order, the same dictionary
+            search_results returns, or None if there is no object with the id
+            (shared with the detail cache, so they must not be modified)
+        """
+
+        obj_ids = list(dict.fromkeys(str(obj_id) for obj_id in obj_ids))
+        cache = get_cache(self._db_file, "details")
+        version = database_version(self._db_file)
+
+        results = {}
+        if version is not None:
+            with span("cache"):
+                for obj_id in obj_ids:
+                    cached = cache.get(obj_id, version)
+                    if cached is not None:
+                        results[obj_id] = cached
+        missing = [obj_id for obj_id in obj_ids if obj_id not in results]
+
+        if missing:
+            with span("sql"):
+                with get_pool(self._db_file).connection() as connection:
+                    with closing(connection.cursor()) as cursor:
+                        # read every relation from the same snapshot of the database
+                        cursor.execute("BEGIN")
+                        try:
+                            data_by_id = self.fetch_details_many(cursor, missing)
+                        finally:
+                            cursor.execute("COMMIT")
+
+            for obj_id in missing:
+                data = data_by_id.get(obj_id)
+                if data is None:
+                    results[obj_id] = None
+                    continue
+                results[obj_id] = self.build_result(data)
+                if version is not None:
+                    cache.put(obj_id, version, results[obj_id])
+
+        return {obj_id: results[obj_id] for obj_id in obj_ids}
+
+    def build_result(self, data):
+        """Turns the rows read for an object into its information.
+
+        Args:
+            data (dict): rows of each relation, as returned by fetch_details
+        Return:
+            dict: columns, formats, agents and object of the object's information
+        """
 
         # data cleaning
-        agent_dict, obj_dict = self.clean_data(data)
+        with span("clean_data"):
+            agent_dict, obj_dict = self.clean_data(data)
 
-        # sort ordering
-        obj_dict['classifier'].sort()
+        with span("sort"):
+            # sort ordering
+            obj_dict['classifier'].sort()
 
-        obj_dict['ref_type'], obj_dict['ref_content'] = self.sort_by_order_ref(
-            obj_dict['ref_type'], obj_dict['ref_content'])
+            obj_dict['ref_type'], obj_dict['ref_content'] = self.sort_by_order_ref(
+                obj_dict['ref_type'], obj_dict['ref_content'])
 
-        # sorting agents
-        sorted_agents = sorted(agent_dict.items(), key=lambda x: (
-            x[1]['name'], x[1]['part'], sorted(x[1]['nationality']), x[1]['timespan']))
+            # sorting agents
+            sorted_agents = sorted(agent_dict.items(), key=lambda x: (
+                x[1]['name'], x[1]['part'], sorted(x[1]['nationality']), x[1]['timespan']))
 
-        sorted_agent_dict = {}
-        for attributes, val in sorted_agents:
-            sorted_agent_dict[attributes] = {
-                'part': val['part'], 'name': val['name'],
-                'nationality': val['nationality'], 'timespan': val['timespan']}
+            sorted_agent_dict = {}
+            for attributes, val in sorted_agents:
+                sorted_agent_dict[attributes] = {
+                    'part': val['part'], 'name': val['name'],
+                    'nationality': val['nationality'], 'timespan': val['timespan']}
 
-        agent_dict = sorted_agent_dict
+            agent_dict = sorted_agent_dict
 
         # data formatting
-        agent_rows_list = self.format_data(agent_dict)
-        return self.convert_to_json(agent_rows_list, obj_dict)
+        with span("format_data"):
+            agent_rows_list = self.format_data(agent_dict)
+        with span("convert"):
+            return self.convert_to_dict(agent_rows_list, obj_dict)
+
+    @staticmethod
+    def fetch_details(cursor, obj_id):
+        """Runs one query per relation of the object (agents, nationalities, classifiers,
+        references, place) instead of joining them all, so the number of rows read is
+        the sum rather than the product of the relations' sizes.
+
+        Args:
+            cursor: cursor of an open connection
+            obj_id (str): object's id
+        Return:
+            dict: the rows of each relation, keyed by relation
+        Raises:
+            NoSearchResultsError: if there is no object with the id
+        """
+
+        smt_params = [obj_id]
+
+        def fetch(smt_str):
+            start = time.perf_counter()
+            cursor.execute(smt_str, smt_params)
+            rows = cursor.fetchall()
+            log_slow_query(cursor, smt_str, smt_params, time.perf_counter() - start)
+            return rows
+
+        obj_rows = fetch(QUERY_DETAILS_OBJECT)
+        if not obj_rows:
+            raise NoSearchResultsError
+
+        data = {"object": obj_rows[0]}
+        for relation, smt_str in (("agents", QUERY_DETAILS_AGENTS),
+                                  ("nationalities", QUERY_DETAILS_NATIONALITIES),
+                                  ("classifiers", QUERY_DETAILS_CLASSIFIERS),
+                                  ("references", QUERY_DETAILS_REFERENCES)):
+            data[relation] = fetch(smt_str)
+
+        place_rows = fetch(QUERY_DETAILS_PLACES)
+        data["place"] = place_rows[0][0] if place_rows else None
+        return data
+
+    @staticmethod
+    def fetch_details_many(cursor, obj_ids):
+        """Same as fetch_details for many objects, with one query per relation for all
+        of them.
+
+        Args:
+            cursor: cursor of an open connection
+            obj_ids (list): distinct objects' ids (str)
+        Return:
+            dict: the rows of each relation keyed by relation, by object id; ids
+            without an object are left out
+        """
+
+        smt_params = [json.dumps(obj_ids)]
+
+        def fetch(smt_str):
+            start = time.perf_counter()
+            cursor.execute(smt_str, smt_params)
+            rows = cursor.fetchall()
+            log_slow_query(cursor, smt_str, smt_params, time.perf_counter() - start)
+            return rows
+
+        data_by_id = {}
+        for row in fetch(QUERY_DETAILS_MANY_OBJECTS):
+            data_by_id[row[0]] = {"object": row[1:], "agents": [], "nationalities": [],
+                                  "classifiers": [], "references": [], "place": None}
+        if not data_by_id:
+            return data_by_id
+
+        for relation, smt_str in (("agents", QUERY_DETAILS_MANY_AGENTS),
+                                  ("nationalities", QUERY_DETAILS_MANY_NATIONALITIES),
+                                  ("classifiers", QUERY_DETAILS_MANY_CLASSIFIERS),
+                                  ("references", QUERY_DETAILS_MANY_REFERENCES)):
+            for row in fetch(smt_str):
+                data_by_id[row[0]][relation].append(row[1:])
+
+        for obj_id, place in fetch(QUERY_DETAILS_MANY_PLACES):
+            if obj_id in data_by_id:
+                data_by_id[obj_id]["place"] = place
+        return data_by_id
 
     def sort_by_order_ref(self, x_data, y_data):
         """Function that sort the references by type and content
@@ -303,6 +1127,19 @@ class LuxDetailsQuery(Query):
             str: json string
         """
 
+        return json.dumps(self.convert_to_dict(data1, data2))
+
+    def convert_to_dict(self, data1, data2):
+        """Takes in the agent list and object dictionary and convert it to the response dictionary
+
+        Args:
+           data1: agent_list (list): list of agent data
+           data2: obj_dict (dict): dictionary containing object data
+
+        Return:
+            dict: columns, formats, agents and object
+        """
+
         agents_list = data1
         obj_dict = data2
 
@@ -315,7 +1152,7 @@ class LuxDetailsQuery(Query):
             "object": obj_dict
         }
 
-        return json.dumps(database_response)
+        return database_response
 
     def format_data(self, data):
         """Transform each agent's dictionary into a list to fit the Table class requirements.
@@ -354,7 +1191,7 @@ class LuxDetailsQuery(Query):
         Stores them in master dictionaries (obj_dict, agent_dict). agent_dict has agent's id as key.
 
         Args:
-            data (list): data returned from cursor.fetchall()
+            data (dict): rows of each relation, as returned by fetch_details
         Returns:
             agent_dict (dict):
                 key: agent's id
@@ -363,82 +1200,54 @@ class LuxDetailsQuery(Query):
                 value: dictionary with all information relevant to the obhect
         """
 
-        # master dictionary
+        label, obj_accession_no, obj_date = data["object"]
+
+        # classifiers without duplicates, in the order they were read;
+        # dictionaries keep insertion order and make the duplicate checks O(1)
+        classifiers = dict.fromkeys(row[0] for row in data["classifiers"]) or {None: None}
+
+        # each reference content is listed once, with the first type it appeared with
+        references = {}
+        for ref_type, ref_content in data["references"]:
+            references.setdefault(ref_content, ref_type)
+        if not references:
+            references = {None: None}
+
+        obj_dict = {
+            "label": label,
+            "classifier": list(classifiers),
+            "ref_type": list(references.values()),
+            "ref_content": list(references),
+            "accession_no": obj_accession_no,
+            "date": obj_date,
+            "place": data["place"],
+        }
+
+        # nationalities of each agent without duplicates, in the order they were read
+        nationalities = {}
+        for agent_id, nationality in data["nationalities"]:
+            nationalities.setdefault(agent_id, {})[nationality] = None
+
+        # master dictionary; an object without productions still gets one empty agent
         agent_dict = {}
-        obj_dict = {}
-
-        # loop through each row in the data, get the relevant data,
-        # and store them in the dictionary for the relevant object
-        for row in data:
-            label = row[0]
-            part_produced = row[1]
-            produced_by = row[2]
-            begin_date = row[3]
-            end_date = row[4]
-            nationality = row[5]
-            classifier = row[6]
-            ref_type = row[7]
-            ref_content = row[8]
-            agent_id = row[9]
-            obj_accession_no = row[10]
-            obj_date = row[11]
-            obj_place = row[12]
-
-            timespan = self.parse_date(begin_date, end_date)
-
-            # create dictionary for object if not already done
-            if not obj_dict:
-                obj_dict = {
-                    "label": label,
-                    "classifier": [classifier],
-                    "ref_type": [ref_type],
-                    "ref_content": [ref_content],
-                    "accession_no": obj_accession_no,
-                    "date": obj_date,
-                    "place": obj_place,
-                }
-            # if dictionary has already been created, then we append classifiers
-            else:
-                if classifier not in obj_dict["classifier"]:
-                    obj_dict['classifier'].append(classifier)
-                # if ref_type not in obj_dict['ref_type'] and :
-                obj_dict['ref_type'].append(ref_type)
-                if ref_content not in obj_dict['ref_content']:
-                    obj_dict['ref_content'].append(ref_content)
-                else:
-                    if ref_type:
-                        obj_dict['ref_type'].pop()
-
-            # if agent has not been stored in agent_dict yet
-
-            if agent_id not in agent_dict:
-                agent_dict[agent_id] = {
-                    "part": part_produced,
-                    "name": produced_by,
-                    "timespan": timespan,
-                    "nationality": [nationality],
-                }
-            # if agent has information stored in dictionary, then we append nationality
-            else:
-                if nationality not in agent_dict[agent_id]['nationality']:
-                    agent_dict[agent_id]['nationality'].append(nationality)
+        for part_produced, produced_by, begin_date, end_date, agent_id in (
+                data["agents"] or [(None, None, None, None, None)]):
+            # an agent with several productions keeps its first part
+            if agent_id in agent_dict:
+                continue
+            agent_dict[agent_id] = {
+                "part": part_produced,
+                "name": produced_by,
+                "timespan": self.parse_date(begin_date, end_date),
+                "nationality": list(nationalities.get(agent_id) or [None]),
+            }
 
         return agent_dict, obj_dict
 
     def parse_date(self, begin_date, end_date):
         """Given a begin_date (str) and end_date (str)
         formats the timespan needed for table in the form of {begin_year}-{end_year}.
+        Years are parsed once per distinct date, see parse_year.
         """
 
-        begin_year = ""
-        end_year = ""
-
-        if begin_date:
-            begin_date_dt = datetime.strptime(begin_date, '%Y-%m-%d')
-            begin_year = begin_date_dt.year
-
-        if end_date:
-            end_date_dt = datetime.strptime(end_date, '%Y-%m-%d')
-            end_year = end_date_dt.year
-
-        return f"{begin_year}-{end_year}"
+        return f"{parse_year(begin_date)}-{parse_year(end_date)}"
@@ -1,7 +1,68 @@
 """Code for running server."""
 import argparse
 import sys
-from luxapp import app
+import lux_memory
+import lux_server
+import lux_snapshot
+
+
+def read_prewarm_ids(args):
+    """Returns the ids of the objects to prewarm given on the command line."""
+
+    # pylint: disable=import-outside-toplevel
+    from lux_prewarm import read_access_log, read_id_list
+
+    prewarm_ids = []
+    if args.prewarm_log:
+        prewarm_ids += read_access_log(args.prewarm_log, args.prewarm_top)
+    if args.prewarm_ids:
+        prewarm_ids += read_id_list(args.prewarm_ids, args.prewarm_top)
+    return prewarm_ids
+
+
+def preload_app():
+    """Imports the application and compiles its templates, so the workers forked
+    afterwards start with both done instead of each doing them again.
+    """
+
+    # pylint: disable=import-outside-toplevel
+    import luxapp
+
+    luxapp.precompile_templates()
+
+
+def load_app(args):
+    """Imports the application, compiles its templates, loads the in-memory search
+    engine if it is used and prewarms the detail cache.
+
+    In production mode this runs in every worker after it is forked, so each worker
+    opens its own connections and fills its own caches.
+    """
+
+    # pylint: disable=import-outside-toplevel
+    import luxapp
+    from lux_prewarm import prewarm
+
+    # a no-op for templates compiled by preload_app before the fork
+    luxapp.precompile_templates()
+
+    db_file = lux_snapshot.current_database()
+
+    # load the catalog before serving, instead of on the first search
+    if args.engine == "memory":
+        engine = lux_memory.get_engine(db_file, wait=True)
+        if engine is not None:
+            report = engine.memory_report()
+            print(f"Loaded {report['objects']} objects in memory"
+                  f" ({report['total_bytes'] / 2 ** 20:.1f} MiB)")
+
+    # load the details of the most viewed objects into the detail cache
+    prewarm_ids = read_prewarm_ids(args)
+    if prewarm_ids:
+        loaded = prewarm(db_file, prewarm_ids)
+        print(f"Prewarmed {loaded} object pages")
+    return luxapp.app
+
 
 if __name__ == '__main__':
 
@@ -11,6 +72,50 @@ if __name__ == '__main__':
 
     parser.add_argument(
         "port", help="the port at which the server should listen",)
+    parser.add_argument(
+        "--database", metavar="PATH", default=lux_snapshot.SNAPSHOT_SETTINGS["path"],
+        help="the database to serve, or a symlink to the current snapshot of it, which is"
+             " switched to without a restart when the link changes"
+             f" (default: {lux_snapshot.SNAPSHOT_SETTINGS['path']})")
+    parser.add_argument(
+        "--prewarm-log", metavar="LOG",
+        help="access log whose most requested object pages are cached at startup")
+    parser.add_argument(
+        "--prewarm-ids", metavar="FILE",
+        help="file with object ids (one per line) whose pages are cached at startup")
+    parser.add_argument(
+        "--prewarm-top", metavar="N", type=int, default=100,
+        help="number of objects to cache at startup (default: 100)")
+    parser.add_argument(
+        "--engine", choices=lux_memory.ENGINES, default=lux_memory.ENGINE_SETTINGS["engine"],
+        help="search with SQLite or with the catalog loaded in memory"
+             f" (default: {lux_memory.ENGINE_SETTINGS['engine']})")
+    parser.add_argument(
+        "--production", action="store_true",
+        help="serve with pre-forked worker processes instead of the debug server")
+    parser.add_argument(
+        "--preload", action="store_true",
+        help="import the application and compile its templates once in the master in"
+             " production mode, so workers start faster; code changes then need a"
+             " restart rather than a SIGHUP")
+    parser.add_argument(
+        "--workers", metavar="N", type=int, default=lux_server.WORKERS,
+        help=f"worker processes in production mode (default: {lux_server.WORKERS})")
+    parser.add_argument(
+        "--threads", metavar="N", type=int, default=lux_server.THREADS,
+        help=f"threads per worker in production mode (default: {lux_server.THREADS})")
+    parser.add_argument(
+        "--queue-size", metavar="N", type=int, default=lux_server.QUEUE_SIZE,
+        help="connections a worker queues before answering 503"
+             f" (default: {lux_server.QUEUE_SIZE})")
+    parser.add_argument(
+        "--keepalive", metavar="SECONDS", type=float, default=lux_server.KEEPALIVE,
+        help=f"idle keep-alive timeout (default: {lux_server.KEEPALIVE:g})")
+    parser.add_argument(
+        "--graceful-timeout", metavar="SECONDS", type=float,
+        default=lux_server.GRACEFUL_TIMEOUT,
+        help="time a stopping worker may take to finish its requests"
+             f" (default: {lux_server.GRACEFUL_TIMEOUT:g})")
 
     args = parser.parse_args()
     port = args.port
@@ -22,9 +127,34 @@ if __name__ == '__main__':
         print("error: port must be an integer 0-65535", file=sys.stderr)
         sys.exit(1)
 
+    if min(args.workers, args.threads, args.queue_size) < 1:
+        print("error: workers, threads and queue size must be at least 1", file=sys.stderr)
+        sys.exit(1)
+
+    lux_memory.configure(engine=args.engine)
+    lux_snapshot.configure(path=args.database)
+
+    # make sure the prewarm files can be read before any worker starts
+    try:
+        for prewarm_file in (args.prewarm_log, args.prewarm_ids):
+            if prewarm_file:
+                with open(prewarm_file, encoding="utf-8"):
+                    pass
+    except OSError as err_message:
+        print(f"error: unable to read prewarm file: {err_message}", file=sys.stderr)
+        sys.exit(1)
+
     # starts the server with the port
     try:
-        app.run(host='0.0.0.0', port=port, debug=True)
+        if args.production:
+            if args.preload:
+                preload_app()
+            lux_server.PreforkServer(
+                lambda: load_app(args), '0.0.0.0', port, workers=args.workers,
+                threads=args.threads, queue_size=args.queue_size,
+                keepalive=args.keepalive, graceful_timeout=args.graceful_timeout).run()
+        else:
+            load_app(args).run(host='0.0.0.0', port=port, debug=True)
     except Exception as err_message:
         print("The server has crashed, error: ", err_message, file=sys.stderr)
         sys.exit(1)
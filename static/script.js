@@ -3,18 +3,46 @@
 /**
  * Take in the response from the GET request and set the #results field in the page as the response.
  * @param  response - response from GET request
+ * @param  status - status text of the request
+ * @param  jqXHR - the request, carrying the token of the next page
  * @return [None]
  */
-function handleSetTable(response) {
+function handleSetTable(response, status, jqXHR) {
 	$("#results").html(response);
+	next_page = jqXHR.getResponseHeader("X-Next-Page");
+	request_results = null;
+}
+
+/**
+ * Take in the response from a GET request for a further page and append its rows to the table.
+ * @param  response - response from GET request
+ * @param  status - status text of the request
+ * @param  jqXHR - the request, carrying the token of the next page
+ * @return [None]
+ */
+function handleAppendRows(response, status, jqXHR) {
+	$("#results tbody").append(response);
+	next_page = jqXHR.getResponseHeader("X-Next-Page");
+	request_page = null;
 }
 
 /**
  * Take in the error from the GET request and prints out the error in the console.
+ * Requests aborted for a newer search are not errors.
+ * The failed request is forgotten either way, so the next page can still be requested.
  * @param  error - error from GET request
  * @return [None]
  */
 function handleError(err) {
+	if (err === request_page) {
+		request_page = null;
+	}
+	if (err === request_results) {
+		request_results = null;
+	}
+	if (err.statusText === "abort" || err.status === 409) {
+		return;
+	}
 	console.log("Error:", err);
 }
 
@@ -22,6 +50,17 @@ function handleError(err) {
 
 let request_results = null;
 
+// identifies this page's searches to the server, so a new search cancels the previous one
+const SEARCH_SESSION = Math.random().toString(36).slice(2) + Date.now().toString(36);
+
+// number of rows requested per page, further pages are loaded on scroll
+const PAGE_SIZE = 100;
+
+// url of the current search, token of its next page and the request loading it
+let search_url = null;
+let next_page = null;
+let request_page = null;
+
 /**
  * Change the #dateTime field to be the current date and time of when the user opened the page.
  * @param  [None]
@@ -50,21 +89,54 @@ function getTableResults() {
 	agent = encodeURIComponent(agent);
 	dep = encodeURIComponent(dep);
 
-	let url = `/search?l=${label}&c=${classifier}&a=${agent}&d=${dep}`;
+	let url = `/search?l=${label}&c=${classifier}&a=${agent}&d=${dep}&page_size=${PAGE_SIZE}`;
+	search_url = url;
+	next_page = null;
+
+	if (request_page != null) {
+		request_page.abort();
+		request_page = null;
+	}
 
 	if (request_results != null) {
 		request_results.abort();
 	}
 
 	//Get request to get the table information from the backend
-	request = $.ajax({
+	request_results = $.ajax({
 		type: "GET",
 		url: url,
+		headers: { "X-Search-Session": SEARCH_SESSION },
 		success: handleSetTable,
 		error: handleError,
 	});
 }
 
+/**
+ * Request the next page of the current search once the user scrolls near the bottom of the page.
+ * @param  [None]
+ * @return [None]
+ */
+function getNextPage() {
+	if (next_page == null || request_page != null) {
+		return;
+	}
+
+	let bottom = $(window).scrollTop() + $(window).height();
+	if (bottom < $(document).height() - 500) {
+		return;
+	}
+
+	//Get request to get the following rows of the table from the backend
+	request_page = $.ajax({
+		type: "GET",
+		url: `${search_url}&after=${encodeURIComponent(next_page)}`,
+		headers: { "X-Search-Session": SEARCH_SESSION },
+		success: handleAppendRows,
+		error: handleError,
+	});
+}
+
 /**
  * Have each input field called getTableResults() upon user input, and initially set the day and time.
  * @param  [None]
@@ -72,6 +144,7 @@ function getTableResults() {
  */
 function setup() {
 	getDateTime();
+	$(window).on("scroll", getNextPage);
 	$("#label-input").on("input", getTableResults);
 	$("#agent-input").on("input", getTableResults);
 	$("#classifier-input").on("input", getTableResults);
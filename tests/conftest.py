@@ -0,0 +1,44 @@
+"""Fixtures shared by the tests: small synthetic collections written by lux_synth.py."""
+
+import shutil
+
+import pytest
+
+import lux_snapshot
+import lux_synth
+import luxapp
+
+# objects in the synthetic collection
+OBJECTS = 3000
+
+
+@pytest.fixture(scope="session")
+def synth_db(tmp_path_factory):
+    """Returns a synthetic collection shared by the tests that only read it. Its index,
+    caches and engine are shared as well, so tests needing their own use fresh_db.
+    """
+
+    db_file = str(tmp_path_factory.mktemp("lux") / "lux.sqlite")
+    lux_synth.generate(db_file, OBJECTS, seed=0)
+    return db_file
+
+
+@pytest.fixture
+def fresh_db(synth_db, tmp_path):
+    """Returns a copy of the synthetic collection in a directory of its own, so it has
+    no index yet and its caches start empty.
+    """
+
+    db_file = str(tmp_path / "lux.sqlite")
+    shutil.copyfile(synth_db, db_file)
+    return db_file
+
+
+@pytest.fixture
+def client(fresh_db):
+    """Returns a test client of the application serving a fresh copy of the collection."""
+
+    path = lux_snapshot.SNAPSHOT_SETTINGS["path"]
+    lux_snapshot.configure(path=fresh_db)
+    yield luxapp.app.test_client()
+    lux_snapshot.configure(path=path)
@@ -0,0 +1,153 @@
+"""Tests of the result cache (lux_cache.py) and of the searches it serves."""
+
+import os
+import time
+
+import pytest
+
+from lux_cache import ResultCache, configure, estimate_size, get_cache, normalize_term
+from query import LuxQuery, database_version
+
+from test_search import baseline_search
+
+ROWS = ((1, "Portrait", "1850", "Smith (artist)", "paintings"),)
+
+
+def make_cache(**settings):
+    """Returns a cache with the given settings and room for everything else."""
+
+    return ResultCache(**dict({"max_entries": 100, "max_bytes": 1 << 20, "ttl": 60.0},
+                              **settings))
+
+
+def test_hit_and_miss():
+    cache = make_cache()
+    assert cache.get(("a",), 1) is None
+    cache.put(("a",), 1, ROWS)
+    assert cache.get(("a",), 1) == ROWS
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"]) == (1, 1, 1)
+    assert stats["bytes"] == estimate_size(ROWS)
+
+
+def test_entries_expire():
+    cache = make_cache(ttl=0.01)
+    cache.put(("a",), 1, ROWS)
+    time.sleep(0.02)
+    assert cache.get(("a",), 1) is None
+    stats = cache.stats()
+    assert (stats["expirations"], stats["entries"], stats["bytes"]) == (1, 0, 0)
+
+
+def test_least_recently_used_is_evicted():
+    cache = make_cache(max_entries=2)
+    cache.put(("a",), 1, ROWS)
+    cache.put(("b",), 1, ROWS)
+    cache.get(("a",), 1)
+    cache.put(("c",), 1, ROWS)
+    assert cache.get(("b",), 1) is None
+    assert cache.get(("a",), 1) == ROWS
+    assert cache.get(("c",), 1) == ROWS
+    assert cache.stats()["evictions"] == 1
+    assert cache.recent_keys(2) == [("c",), ("a",)]
+
+
+def test_byte_bound():
+    size = estimate_size(ROWS)
+    cache = make_cache(max_bytes=2 * size)
+    for key in "abc":
+        cache.put((key,), 1, ROWS)
+    assert cache.stats()["entries"] == 2
+    assert cache.stats()["bytes"] == 2 * size
+    # a value larger than the whole cache is not stored
+    cache.put(("d",), 1, ROWS * 3)
+    assert cache.get(("d",), 1) is None
+    assert cache.get(("c",), 1) == ROWS
+
+
+def test_new_version_invalidates():
+    cache = make_cache()
+    cache.put(("a",), 1, ROWS)
+    cache.remember_ids(("a", "", "", ""), 1, [1])
+    assert cache.get(("a",), 2) is None
+    assert cache.find_candidates(("ab", "", "", ""), 2) is None
+    stats = cache.stats()
+    assert (stats["invalidations"], stats["entries"], stats["bytes"]) == (1, 0, 0)
+
+
+def test_shared_cache(tmp_path):
+    path = str(tmp_path / "shared.sqlite")
+    first, second = make_cache(shared_path=path), make_cache(shared_path=path)
+    first.put(("a",), 1, ROWS)
+    assert second.get(("a",), 1) == ROWS
+    assert second.stats()["shared_hits"] == 1
+    assert second.get(("a",), 2) is None
+
+
+def test_configure_rejects_unknown_settings():
+    with pytest.raises(ValueError, match="unknown cache settings: size"):
+        configure(size=1)
+
+
+def test_normalize_term():
+    assert normalize_term(None) == ""
+    assert normalize_term("PorTRAIT") == "portrait"
+    # LIKE only folds ASCII letters
+    assert normalize_term("ÉLISE") == "Élise"
+
+
+def test_search_is_cached_by_folded_terms(fresh_db):
+    lux_query = LuxQuery(fresh_db, "sql")
+    results = lux_query.search_results(label="portrait")
+    assert lux_query.search_results(label="PORTRAIT") == results
+    assert get_cache(fresh_db).stats()["hits"] == 1
+
+
+def test_changed_database_is_searched_again(fresh_db):
+    lux_query = LuxQuery(fresh_db, "sql")
+    lux_query.search_results(label="portrait")
+    version = database_version(fresh_db)
+    os.utime(fresh_db, ns=(0, version[2] + 1))
+    assert database_version(fresh_db) != version
+    lux_query.search_results(label="portrait")
+    stats = get_cache(fresh_db).stats()
+    assert (stats["hits"], stats["misses"], stats["invalidations"]) == (0, 2, 1)
+
+
+def test_find_candidates_narrows_the_smallest_search():
+    cache = make_cache()
+    cache.remember_ids(("p", "", "", ""), 1, [1, 2, 3])
+    cache.remember_ids(("po", "", "", ""), 1, [1, 2])
+    cache.remember_ids(("", "print", "", ""), 1, [4])
+    assert cache.find_candidates(("por", "", "", ""), 1) == {1, 2}
+    assert cache.find_candidates(("por", "prints", "", ""), 1) == {4}
+    assert cache.find_candidates(("x", "", "", ""), 1) is None
+    # a term in another column does not narrow a search
+    assert cache.find_candidates(("", "", "po", ""), 1) is None
+    assert cache.stats()["refinements"] == 2
+
+
+@pytest.mark.parametrize("first, refined", [
+    (("stud", "", "", ""), ("study", "", "", "")),
+    (("vas", "", "", ""), ("vase", "", "", "")),
+    (("vas", "", "", ""), ("VASE", "ceramics", "", "art")),
+    (("", "", "", "asian"), ("a", "", "e", "asian art")),
+])
+def test_refined_search_matches_baseline(fresh_db, first, refined):
+    lux_query = LuxQuery(fresh_db, "sql")
+    label, classifier, agt, dep = first
+    lux_query.search_results(dep, agt, classifier, label)
+    label, classifier, agt, dep = refined
+    rows = [tuple(row) for row in lux_query.iter_rows(dep, agt, classifier, label)]
+    assert get_cache(fresh_db).stats()["refinements"] == 1
+    assert rows == baseline_search(fresh_db, dep, agt, classifier, label)
+
+
+def test_refined_page_matches_baseline(fresh_db):
+    lux_query = LuxQuery(fresh_db, "sql")
+    lux_query.search_results(label="stud")
+    page, after = lux_query.fetch_page(classifier="print", label="study", page_size=20)
+    assert get_cache(fresh_db).stats()["refinements"] == 1
+    expected = baseline_search(fresh_db, "", "", "print", "study")
+    assert [tuple(row) for row in page] == expected[:20]
+    assert (after is None) == (len(expected) <= 20)
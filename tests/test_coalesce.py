@@ -0,0 +1,98 @@
+"""Tests of coalescing identical concurrent searches (lux_coalesce.py)."""
+
+import threading
+import time
+
+import pytest
+
+from lux_coalesce import SingleFlight, get_single_flight
+from query import LuxQuery
+
+from test_search import baseline_search
+
+
+def run_concurrently(function, count):
+    """Calls function in count threads at once and returns their results."""
+
+    results = [None] * count
+
+    def run(index):
+        results[index] = function()
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def wait_for(condition, timeout=5.0):
+    """Waits until condition() is true."""
+
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def test_waiters_share_the_leader_result():
+    flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def search():
+        calls.append(1)
+        release.wait()
+        return len(calls)
+
+    threads, results = run_concurrently(lambda: flight.run(("a",), search), 3)
+    wait_for(lambda: flight.stats()["coalesced"] == 2)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert results == [1, 1, 1]
+    assert flight.stats() == {"leaders": 1, "coalesced": 2, "abandoned": 0, "running": 0}
+
+
+def test_waiters_run_themselves_when_the_leader_fails():
+    flight = SingleFlight()
+    call, leader = flight.join(("a",))
+    assert leader
+    threads, results = run_concurrently(lambda: flight.run(("a",), lambda: "own"), 1)
+    wait_for(lambda: flight.stats()["coalesced"] == 1)
+    flight.leave(("a",), call, ok=False)
+    threads[0].join()
+    assert results == ["own"]
+    assert flight.stats()["abandoned"] == 1
+
+
+def test_failed_leader_raises():
+    flight = SingleFlight()
+
+    def search():
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        flight.run(("a",), search)
+    assert flight.run(("a",), lambda: "again") == "again"
+
+
+def test_identical_searches_run_once(fresh_db, monkeypatch):
+    release = threading.Event()
+    fetch_rows = LuxQuery.fetch_rows
+    calls = []
+
+    def slow_fetch_rows(self, *args, **kwargs):
+        calls.append(args)
+        release.wait()
+        yield from fetch_rows(self, *args, **kwargs)
+
+    monkeypatch.setattr(LuxQuery, "fetch_rows", slow_fetch_rows)
+    lux_query = LuxQuery(fresh_db, "sql")
+    threads, results = run_concurrently(lambda: lux_query.search_results(label="vase"), 2)
+    wait_for(lambda: get_single_flight(fresh_db).stats()["coalesced"] == 1)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(calls) == 1
+    assert results[0] == results[1]
+    assert results[0]["data"] == baseline_search(fresh_db, "", "", "", "vase")
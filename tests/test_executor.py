@@ -0,0 +1,87 @@
+"""Tests of the search executor (lux_executor.py) and of cancelling searches."""
+
+import threading
+
+from contextlib import closing
+from sqlite3 import connect
+
+import pytest
+
+from lux_executor import CancelToken, ExecutorBusyError, SearchExecutor
+from query import LuxQuery, SearchCancelledError, cancellable
+
+# a statement running until it is interrupted
+ENDLESS = """WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n)
+SELECT COUNT(*) FROM n"""
+
+
+def test_cancel_interrupts_running_statement():
+    token = CancelToken()
+    timer = threading.Timer(0.1, token.cancel)
+    timer.start()
+    with closing(connect(":memory:")) as connection:
+        with pytest.raises(SearchCancelledError):
+            with cancellable(connection, token):
+                connection.execute(ENDLESS).fetchall()
+    timer.join()
+
+
+def test_cancelled_search_does_not_start(fresh_db):
+    token = CancelToken()
+    token.cancel()
+    with pytest.raises(SearchCancelledError):
+        LuxQuery(fresh_db, "sql").search_results(label="portrait", cancel=token)
+
+
+def test_new_search_supersedes_session():
+    executor = SearchExecutor(workers=1, queue_size=1, sessions=10)
+    first = executor.start("session")
+    second = executor.start("session")
+    other = executor.start("other")
+    assert first.cancelled
+    assert not second.cancelled and not other.cancelled
+    assert executor.stats()["superseded"] == 1
+    # a superseded search waiting for the debounce window does not start
+    with pytest.raises(SearchCancelledError):
+        SearchExecutor(1, 1, 10, debounce=1.0).debounce("session", first)
+
+
+def test_full_queue_rejects_searches():
+    executor = SearchExecutor(workers=1, queue_size=0, sessions=10)
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    with pytest.raises(ExecutorBusyError):
+        executor.submit(release.wait)
+    release.set()
+    assert executor.wait(running, CancelToken()) is True
+    assert executor.stats()["rejected"] == 1
+
+
+def test_cancelled_queued_search_never_runs():
+    executor = SearchExecutor(workers=1, queue_size=1, sessions=10)
+    release = threading.Event()
+    ran = []
+    running = executor.submit(release.wait)
+    token = executor.start("session")
+    queued = executor.submit(ran.append, "queued")
+    executor.start("session")
+    with pytest.raises(SearchCancelledError):
+        executor.wait(queued, token)
+    release.set()
+    executor.wait(running, CancelToken())
+    assert not ran
+    assert executor.stats()["cancelled"] == 1
+
+
+@pytest.mark.parametrize("args", [{"l": "vase"}, {"l": "vase", "page_size": "10"}])
+def test_busy_executor_rejects_route(client, monkeypatch, args):
+    executor = SearchExecutor(workers=1, queue_size=0, sessions=10)
+    release = threading.Event()
+    running = executor.submit(release.wait)
+    monkeypatch.setattr("luxapp.get_executor", lambda: executor)
+    # the streamed table is read on the executor too
+    response = client.get("/search", query_string=args)
+    release.set()
+    executor.wait(running, CancelToken())
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
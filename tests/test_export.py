@@ -0,0 +1,109 @@
+"""Tests of exporting the full results of a search (lux_export.py)."""
+
+import csv
+import gzip
+import io
+import json
+
+import pytest
+
+import lux_export
+import lux_pool
+from lux_export import ExportFormatError, check_format, export_chunks
+from lux_index import ensure_index
+from lux_query_sql import QUERY_LUX_ROW
+from query import LuxQuery
+
+from test_search import baseline_search
+
+
+def export(db_file, fmt, compress=False, **terms):
+    """Returns a whole export of a search as bytes."""
+
+    rows = LuxQuery(db_file, "sql").export_rows(**terms)
+    return b"".join(export_chunks(rows, fmt, compress))
+
+
+def read_csv(data):
+    """Returns the header and the rows of a CSV export, with the ids as integers."""
+
+    header, *rows = csv.reader(io.StringIO(data.decode()))
+    return header, [(int(row[0]),) + tuple(value or None for value in row[1:])
+                    for row in rows]
+
+
+def without_empty(rows):
+    """Returns the rows with empty strings as NULLs, the way CSV reads them back."""
+
+    return [tuple(value if value != "" else None for value in row) for row in rows]
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_csv(synth_db, compress):
+    data = export(synth_db, "csv", compress)
+    if compress:
+        data = gzip.decompress(data)
+    header, rows = read_csv(data)
+    assert header == list(QUERY_LUX_ROW)
+    # every row, more than the 1000 of a search, read in EXPORT_BATCH chunks
+    assert rows == without_empty(baseline_search(synth_db, "", "", "", "", limit=None))
+
+
+def test_csv_without_rows(synth_db):
+    assert read_csv(export(synth_db, "csv", label="zzz")) == (list(QUERY_LUX_ROW), [])
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_ndjson(synth_db, compress):
+    data = export(synth_db, "ndjson", compress, label="vase", classifier="print")
+    if compress:
+        data = gzip.decompress(data)
+    rows = [tuple(json.loads(line)[name] for name in QUERY_LUX_ROW)
+            for line in data.decode().splitlines()]
+    assert rows == baseline_search(synth_db, "", "", "print", "vase", limit=None)
+
+
+def test_parquet(synth_db):
+    parquet = pytest.importorskip("pyarrow.parquet")
+    table = parquet.read_table(io.BytesIO(export(synth_db, "parquet", label="vase")))
+    assert table.column_names == list(QUERY_LUX_ROW)
+    assert [tuple(row.values()) for row in table.to_pylist()] == \
+        baseline_search(synth_db, "", "", "", "vase", limit=None)
+
+
+def test_unknown_format():
+    with pytest.raises(ExportFormatError, match="unknown format xml"):
+        check_format("xml")
+
+
+def test_parquet_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(lux_export, "PARQUET_AVAILABLE", False)
+    assert lux_export.available_formats() == ["csv", "ndjson"]
+    with pytest.raises(ExportFormatError, match="needs pyarrow"):
+        check_format("parquet")
+
+
+def test_export_route(client, fresh_db):
+    response = client.get("/export", query_string={"l": "vase", "format": "ndjson",
+                                                   "gzip": "1"})
+    assert response.status_code == 200
+    assert response.content_type == "application/gzip"
+    assert 'filename="lux-export.ndjson.gz"' in response.headers["Content-Disposition"]
+    assert len(gzip.decompress(response.data).splitlines()) == \
+        len(baseline_search(fresh_db, "", "", "", "vase", limit=None))
+    assert client.get("/export", query_string={"format": "xml"}).status_code == 400
+
+
+def test_exports_have_their_own_pool(client, fresh_db, monkeypatch):
+    monkeypatch.setitem(lux_pool.POOL_KINDS, "export", (1, 0.0))
+    assert ensure_index(fresh_db, wait=True) is not None
+    # a download in progress holds the only export connection
+    download = LuxQuery(fresh_db, "sql").export_rows(label="vase")
+    next(download)
+    response = client.get("/export", query_string={"l": "vase"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    # searches do not wait for it
+    assert client.get("/api/search", query_string={"l": "vase"}).status_code == 200
+    download.close()
+    assert client.get("/export", query_string={"l": "vase"}).status_code == 200
@@ -0,0 +1,65 @@
+"""Tests of the facet counts of searches (LuxQuery.facet_counts)."""
+
+from collections import defaultdict
+from contextlib import closing
+from sqlite3 import connect
+
+import pytest
+
+import query
+from lux_cache import get_cache
+from lux_index import ensure_index
+from lux_memory import FACETS, get_engine
+from lux_query_sql import QUERY_FACET_VALUES
+from query import LuxQuery
+
+from test_search import SEARCHES, baseline_search
+
+
+def expected_facets(db_file, dep, agt, classifier, label, size):
+    """Counts the facets of every object the original search matches, in Python."""
+
+    matches = {row[0] for row in baseline_search(db_file, dep, agt, classifier, label,
+                                                 limit=None)}
+    counts = {"total": len(matches)}
+    with closing(connect(db_file)) as connection:
+        for facet in FACETS:
+            objects = defaultdict(set)
+            for obj_id, value in connection.execute(QUERY_FACET_VALUES[facet]):
+                if obj_id in matches:
+                    objects[value].add(obj_id)
+            top = sorted(objects.items(), key=lambda item: (-len(item[1]), item[0]))
+            counts[facet] = [[value, len(ids)] for value, ids in top[:size]]
+    return counts
+
+
+@pytest.fixture(params=["sql", "indexed", "memory"])
+def engine_query(request, synth_db, monkeypatch):
+    """Returns a LuxQuery counting with SQL on the collection, with SQL on the search
+    index or with the in-memory engine, with an empty facet cache.
+    """
+
+    get_cache(synth_db, "facets").clear()
+    if request.param == "sql":
+        monkeypatch.setattr(query, "ensure_index", lambda db_file, wait=False: None)
+        return LuxQuery(synth_db, "sql")
+    if request.param == "indexed":
+        assert ensure_index(synth_db, wait=True) is not None
+        return LuxQuery(synth_db, "sql")
+    assert get_engine(synth_db, wait=True) is not None
+    return LuxQuery(synth_db, "memory")
+
+
+# l=a matches more than half the objects, so the index counts the objects not matching
+@pytest.mark.parametrize("label, classifier, agt, dep", SEARCHES)
+def test_facets_match_baseline(engine_query, synth_db, label, classifier, agt, dep):
+    counts = engine_query.facet_counts(dep, agt, classifier, label, size=5)
+    assert counts == expected_facets(synth_db, dep, agt, classifier, label, 5)
+
+
+def test_facets_are_cached(fresh_db):
+    lux_query = LuxQuery(fresh_db, "sql")
+    counts = lux_query.facet_counts(label="VASE", size=3)
+    assert lux_query.facet_counts(label="vase", size=3) is counts
+    assert get_cache(fresh_db, "facets").stats()["hits"] == 1
+    assert lux_query.facet_counts(label="vase", size=4) is not counts
@@ -0,0 +1,65 @@
+"""Tests of building and checking the search index (lux_index.py)."""
+
+import os
+
+from contextlib import closing
+from sqlite3 import connect
+
+import lux_index
+from lux_index import ensure_index, index_path, read_meta, INDEX_VERSION
+from query import LuxQuery
+
+from test_coalesce import wait_for
+from test_search import baseline_search
+
+
+def test_index_builds_in_background(fresh_db):
+    assert ensure_index(fresh_db) is None
+    wait_for(lambda: ensure_index(fresh_db) is not None)
+    meta = read_meta(index_path(fresh_db))
+    assert meta["version"] == INDEX_VERSION
+    with closing(connect(fresh_db)) as connection:
+        assert meta["objects"] == connection.execute("SELECT COUNT(*) FROM objects").fetchone()[0]
+
+
+def test_touched_database_keeps_its_index(fresh_db, monkeypatch):
+    target = ensure_index(fresh_db, wait=True)
+    stat = os.stat(fresh_db)
+    os.utime(fresh_db, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+
+    def build_index(db_file):
+        raise AssertionError(f"{db_file} rebuilt")
+
+    monkeypatch.setattr(lux_index, "build_index", build_index)
+    assert ensure_index(fresh_db, wait=True) == target
+
+
+def test_changed_database_is_reindexed(fresh_db):
+    assert ensure_index(fresh_db, wait=True) is not None
+    with closing(connect(fresh_db)) as connection, connection:
+        connection.execute("INSERT INTO objects (id, label) VALUES (999999, 'Zqx vase')")
+    assert ensure_index(fresh_db, wait=True) is not None
+    rows = list(LuxQuery(fresh_db, "sql").fetch_rows(label="zqx"))
+    assert [row[0] for row in rows] == [999999]
+
+
+def test_failed_build_is_remembered(fresh_db, monkeypatch):
+    os.mkdir(index_path(fresh_db))
+    assert ensure_index(fresh_db, wait=True) is None
+
+    def refresh_index(db_file, signature):
+        raise AssertionError(f"{db_file} {signature} tried again")
+
+    # neither a search nor another check tries to build it again
+    monkeypatch.setattr(lux_index, "refresh_index", refresh_index)
+    assert ensure_index(fresh_db) is None
+    assert ensure_index(fresh_db, wait=True) is None
+    rows = list(LuxQuery(fresh_db, "sql").fetch_rows(label="vase"))
+    assert rows == baseline_search(fresh_db, "", "", "", "vase")
+
+    # until the database changes
+    monkeypatch.undo()
+    os.rmdir(index_path(fresh_db))
+    stat = os.stat(fresh_db)
+    os.utime(fresh_db, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert ensure_index(fresh_db, wait=True) == index_path(fresh_db)
@@ -0,0 +1,59 @@
+"""Tests of loading the in-memory search engine (lux_memory.py)."""
+
+import threading
+
+import pytest
+
+import lux_memory
+from lux_memory import (ENGINE_SETTINGS, MemoryBudgetError, configure, engine_stats,
+                        estimate_bytes, get_engine, load_engine)
+from query import LuxQuery
+
+from test_coalesce import wait_for
+from test_search import baseline_search
+
+
+def test_over_budget_is_refused_before_loading(synth_db, monkeypatch):
+    def load_rows(db_file):
+        raise AssertionError(f"{db_file} loaded")
+
+    monkeypatch.setattr(lux_memory, "load_rows", load_rows)
+    with pytest.raises(MemoryBudgetError, match="at least"):
+        load_engine(synth_db, budget=estimate_bytes(synth_db) - 1)
+
+
+def test_over_budget_once_loaded(synth_db):
+    with pytest.raises(MemoryBudgetError, match="takes [0-9]+ bytes"):
+        load_engine(synth_db, budget=estimate_bytes(synth_db))
+
+
+def test_over_budget_is_searched_with_sql(fresh_db, monkeypatch):
+    monkeypatch.setitem(ENGINE_SETTINGS, "budget", 1)
+    assert get_engine(fresh_db, wait=True) is None
+    assert "over the budget" in engine_stats()["databases"][fresh_db]["error"]
+    rows = list(LuxQuery(fresh_db, "memory").fetch_rows(label="vase"))
+    assert rows == baseline_search(fresh_db, "", "", "", "vase")
+
+
+def test_engine_loads_in_background(fresh_db, monkeypatch):
+    release = threading.Event()
+    load_rows = lux_memory.load_rows
+
+    def slow_load_rows(db_file):
+        release.wait()
+        return load_rows(db_file)
+
+    monkeypatch.setattr(lux_memory, "load_rows", slow_load_rows)
+    lux_query = LuxQuery(fresh_db, "memory")
+    # the search does not wait for the engine
+    rows = list(lux_query.fetch_rows(label="vase"))
+    assert rows == baseline_search(fresh_db, "", "", "", "vase")
+    assert get_engine(fresh_db) is None
+    release.set()
+    wait_for(lambda: get_engine(fresh_db) is not None)
+    assert engine_stats()["databases"][fresh_db]["objects"] > 0
+
+
+def test_configure_rejects_unknown_engine():
+    with pytest.raises(ValueError, match="unknown engine: bitmap"):
+        configure(engine="bitmap")
@@ -0,0 +1,124 @@
+"""Tests of the keyset pagination of searches (LuxQuery.fetch_page) and its tokens."""
+
+import base64
+import json
+
+import pytest
+
+from lux_cache import get_cache
+from lux_index import ensure_index
+from lux_memory import get_engine
+from query import InvalidPageTokenError, LuxQuery
+
+from test_search import SEARCHES, baseline_search
+
+KEYS = ("label", "date", "artist", "classification", "id")
+
+
+def make_token(payload):
+    """Returns a page token holding any JSON value, the way a client could craft one."""
+
+    token = json.dumps(payload).encode()
+    return base64.urlsafe_b64encode(token).decode().rstrip("=")
+
+
+def read_pages(lux_query, page_size, label="", classifier="", agt="", dep=""):
+    """Returns every row of a search, read page by page, and the number of pages."""
+
+    rows = []
+    pages = 0
+    after = None
+    while True:
+        page, after = lux_query.fetch_page(dep, agt, classifier, label, page_size, after)
+        rows.extend(tuple(row) for row in page)
+        pages += 1
+        if after is None:
+            return rows, pages
+
+
+@pytest.mark.parametrize("row", [
+    (1, "Portrait", "1850", "Smith (artist)", "paintings"),
+    (2, None, None, None, None),
+    (3, "Vase é\"=,", "ca. 1850", "", "prints, drawings"),
+    (4, "Figure", 1850, "A (maker)", "coins"),
+    (5, "Head", 12.5, "B (after)", None),
+])
+def test_page_token_round_trip(row):
+    token = LuxQuery.encode_page_token(KEYS, row)
+    assert "=" not in token
+    assert LuxQuery.decode_page_token(token, KEYS) == [row[1], row[2], row[3], row[4], row[0]]
+
+
+@pytest.mark.parametrize("token", [
+    "not a token!",
+    base64.urlsafe_b64encode(b"not json").decode(),
+    make_token({"keys": list(KEYS)}),
+    make_token([list(KEYS)]),
+    make_token(["label", [None, None, None, None, 1]]),
+    make_token([list(KEYS), "values"]),
+    make_token([list(KEYS), ["a", None, None, None, {"id": 1}]]),
+    make_token([list(KEYS), ["a", None, None, None, [1]]]),
+    make_token([list(KEYS), ["a", None, None, None, True]]),
+])
+def test_malformed_page_token(token):
+    with pytest.raises(InvalidPageTokenError, match="malformed"):
+        LuxQuery.decode_page_token(token, KEYS)
+
+
+@pytest.mark.parametrize("token", [
+    make_token([["label", "date", "classification", "artist", "id"],
+                ["a", None, None, None, 1]]),
+    make_token([list(KEYS), ["a", None, None, 1]]),
+])
+def test_page_token_of_another_search(token):
+    with pytest.raises(InvalidPageTokenError, match="does not belong"):
+        LuxQuery.decode_page_token(token, KEYS)
+
+
+def test_fetch_page_rejects_token_of_another_order(synth_db):
+    lux_query = LuxQuery(synth_db, "sql")
+    _, after = lux_query.fetch_page(page_size=10)
+    with pytest.raises(InvalidPageTokenError):
+        lux_query.fetch_page(classifier="print", page_size=10, after=after)
+
+
+@pytest.mark.parametrize("engine", ["sql", "memory"])
+@pytest.mark.parametrize("label, classifier, agt, dep", SEARCHES[1:])
+def test_pages_match_baseline(synth_db, engine, label, classifier, agt, dep):
+    assert ensure_index(synth_db, wait=True) is not None
+    if engine == "memory":
+        assert get_engine(synth_db, wait=True) is not None
+    # the caches hold the pages of either engine
+    get_cache(synth_db).clear()
+    get_cache(synth_db, "pages").clear()
+    expected = baseline_search(synth_db, dep, agt, classifier, label, limit=None)
+    rows, pages = read_pages(LuxQuery(synth_db, engine), 250, label, classifier, agt, dep)
+    assert rows == expected
+    assert pages == len(expected) // 250 + 1
+
+
+def test_pages_are_cached(fresh_db):
+    lux_query = LuxQuery(fresh_db, "sql")
+    first = read_pages(lux_query, 100, label="portrait")
+    hits = get_cache(fresh_db, "pages").stats()["hits"]
+    assert read_pages(lux_query, 100, label="portrait") == first
+    assert get_cache(fresh_db, "pages").stats()["hits"] == hits + first[1]
+
+
+def test_first_page_is_cut_from_cached_results(fresh_db):
+    lux_query = LuxQuery(fresh_db, "sql")
+    results = lux_query.search_results(label="portrait")
+    page, after = lux_query.fetch_page(label="portrait", page_size=20)
+    assert [tuple(row) for row in page] == [tuple(row) for row in results["data"][:20]]
+    assert after == LuxQuery.encode_page_token(lux_query.sort_keys("", ""), page[-1])
+    assert get_cache(fresh_db, "pages").stats()["misses"] == 1
+    assert get_cache(fresh_db).stats()["hits"] == 1
+
+
+def test_api_rejects_crafted_page_token(client):
+    token = make_token([list(KEYS), ["a", None, None, None, {"id": 1}]])
+    response = client.get("/api/search", query_string={"page_size": 10, "after": token})
+    assert response.status_code == 400
+    assert "malformed" in response.get_json()["error"]
+    response = client.get("/search", query_string={"l": "a", "page_size": 10, "after": token})
+    assert response.status_code == 400
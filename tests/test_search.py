@@ -0,0 +1,109 @@
+"""Tests comparing every search engine with the original search (QUERY_LUX)."""
+
+from contextlib import closing
+from sqlite3 import connect
+
+import pytest
+
+import query
+from lux_index import ensure_index
+from lux_memory import get_engine
+from lux_query_sql import QUERY_SEARCH_ROWS
+from query import LuxQuery, MAX_RESULTS
+
+# (label, classifier, agent, department) searches, covering capped and empty results,
+# case folding, LIKE wildcards, equal agent and classifier terms and NULL values
+SEARCHES = [
+    ("", "", "", ""),
+    ("a", "", "", ""),
+    ("portrait", "", "", ""),
+    ("PORTRAIT", "", "", ""),
+    ("Vase", "print", "", ""),
+    ("", "", "arba", ""),
+    ("", "", "(maker)", ""),
+    ("", "", "", "asian"),
+    ("", "ceramics", "", "art of"),
+    ("a", "e", "i", "o"),
+    ("", "ar", "ar", ""),
+    ("por%", "", "", ""),
+    ("a_d", "", "", ""),
+    ("zzz", "", "", ""),
+    ("é", "", "", ""),
+]
+
+
+def baseline_search(db_file, dep, agt, classifier, label, limit=MAX_RESULTS):
+    """Runs a search the way LuxQuery.search did before the index, the engines and the
+    caches: QUERY_SEARCH_ROWS is its statement. The object id is added as the last sort
+    key, since the original order left ties unordered.
+
+    Return:
+        list: (id, label, date, artist, classification) rows
+    """
+
+    smt_str = QUERY_SEARCH_ROWS
+    clauses = []
+    smt_params = []
+    for column, term in (("department.dep_name", dep), ("objects.label", label),
+                         ("agent.artist", agt), ("classifier.classification", classifier)):
+        if term:
+            clauses.append(f"{column} LIKE ?")
+            smt_params.append(f"%{term}%")
+    if clauses:
+        smt_str += " WHERE " + " AND ".join(clauses)
+    smt_str += " GROUP BY objects.id, objects.label"
+
+    params_list = {agt: "agent.artist", classifier: "classifier.classification"}
+    sort_list = [value for key, value in params_list.items() if key]
+    sort_list += [value for key, value in params_list.items() if not key]
+    smt_str += " ORDER BY objects.label, objects.date, " + ", ".join(sort_list)
+    smt_str += ", objects.id"
+    if limit is not None:
+        smt_str += f" LIMIT {limit}"
+
+    with closing(connect(db_file)) as connection:
+        rows = connection.execute(smt_str, smt_params).fetchall()
+    # drop the department and show the date before the agents
+    return [(obj_id, obj_label, date, artist, classification)
+            for obj_id, obj_label, artist, date, _, classification in rows]
+
+
+@pytest.fixture(params=["sql", "indexed", "memory"])
+def engine_query(request, synth_db, monkeypatch):
+    """Returns a LuxQuery searching with SQL on the collection, with SQL on the search
+    index or with the in-memory engine.
+    """
+
+    if request.param == "sql":
+        monkeypatch.setattr(query, "ensure_index", lambda db_file, wait=False: None)
+        return LuxQuery(synth_db, "sql")
+    if request.param == "indexed":
+        assert ensure_index(synth_db, wait=True) is not None
+        return LuxQuery(synth_db, "sql")
+    assert get_engine(synth_db, wait=True) is not None
+    return LuxQuery(synth_db, "memory")
+
+
+@pytest.mark.parametrize("label, classifier, agt, dep", SEARCHES)
+def test_search_matches_baseline(engine_query, synth_db, label, classifier, agt, dep):
+    expected = baseline_search(synth_db, dep, agt, classifier, label)
+    rows = [tuple(row) for row in engine_query.fetch_rows(dep, agt, classifier, label)]
+    assert rows == expected
+
+
+@pytest.mark.parametrize("label, classifier, agt, dep", SEARCHES[:3])
+def test_unlimited_search_matches_baseline(engine_query, synth_db, label, classifier, agt,
+                                           dep):
+    expected = baseline_search(synth_db, dep, agt, classifier, label, limit=None)
+    rows = [tuple(row) for row in
+            engine_query.fetch_rows(dep, agt, classifier, label, limit=None)]
+    assert len(rows) > MAX_RESULTS or label
+    assert rows == expected
+
+
+def test_search_results(synth_db):
+    results = LuxQuery(synth_db, "sql").search_results(label="portrait")
+    expected = baseline_search(synth_db, "", "", "", "portrait")
+    assert results["search_count"] == len(expected)
+    assert results["columns"] == ["ID", "Label", "Date", "Produced By", "Classified As"]
+    assert [tuple(row) for row in results["data"]] == expected
@@ -0,0 +1,96 @@
+"""Tests of the production server (lux_server.py), through real connections."""
+
+import http.client
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import pytest
+
+from lux_server import PreforkServer
+
+# parts of the streamed response, sent without a Content-Length
+CHUNKS = [b"first ", b"second ", b"third"]
+
+
+def app_factory():
+    """Returns a WSGI application answering /fixed with a Content-Length and anything
+    else with a body of unknown length.
+    """
+
+    def app(environ, start_response):
+        if environ["PATH_INFO"] == "/fixed":
+            start_response("200 OK", [("Content-Type", "text/plain"),
+                                      ("Content-Length", "5")])
+            return [b"fixed"]
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return iter(CHUNKS)
+    return app
+
+
+def free_port():
+    """Returns a port nothing listens on."""
+
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+@pytest.fixture
+def server_port():
+    """Runs a PreforkServer with two workers in a separate process and returns its port."""
+
+    port = free_port()
+    server = PreforkServer(app_factory, "127.0.0.1", port, workers=2, threads=2,
+                           keepalive=5.0, graceful_timeout=5.0)
+    process = multiprocessing.get_context("fork").Process(target=server.run)
+    process.start()
+    deadline = time.monotonic() + 10.0
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1.0).close()
+            break
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+    yield port
+    os.kill(process.pid, signal.SIGTERM)
+    process.join(10.0)
+    assert process.exitcode == 0
+
+
+def test_keepalive_and_chunked_responses(server_port):
+    connection = http.client.HTTPConnection("127.0.0.1", server_port, timeout=5.0)
+    try:
+        connection.request("GET", "/fixed")
+        response = connection.getresponse()
+        assert response.read() == b"fixed"
+        assert not response.will_close
+        sock = connection.sock
+
+        # a body of unknown length is chunked, and the connection still stays open
+        connection.request("GET", "/stream")
+        response = connection.getresponse()
+        assert response.getheader("Transfer-Encoding") == "chunked"
+        assert response.read() == b"".join(CHUNKS)
+        assert not response.will_close
+
+        connection.request("GET", "/fixed")
+        assert connection.getresponse().read() == b"fixed"
+        assert connection.sock is sock
+    finally:
+        connection.close()
+
+
+def test_request_with_body_closes_connection(server_port):
+    connection = http.client.HTTPConnection("127.0.0.1", server_port, timeout=5.0)
+    try:
+        connection.request("POST", "/fixed", body=b"ignored")
+        response = connection.getresponse()
+        assert response.read() == b"fixed"
+        assert response.will_close
+    finally:
+        connection.close()
@@ -0,0 +1,142 @@
+"""Tests of switching to a new database snapshot without a restart (lux_snapshot.py)."""
+
+import os
+import shutil
+
+from contextlib import closing
+from sqlite3 import connect
+
+import pytest
+
+import lux_snapshot
+from lux_cache import cache_stats, get_cache
+from lux_index import index_path
+from lux_snapshot import SNAPSHOT_SETTINGS, current_database, snapshot_stats
+from query import LuxQuery, database_version
+
+from test_coalesce import wait_for
+from test_search import baseline_search
+
+
+def publish(link, db_file):
+    """Points the snapshot link at a database file, atomically."""
+
+    tmp_link = f"{link}.tmp"
+    os.symlink(db_file, tmp_link)
+    os.replace(tmp_link, link)
+
+
+@pytest.fixture
+def snapshot_link(fresh_db, tmp_path):
+    """Returns the path of a symlink to the collection, served as the current snapshot
+    and checked for a new one on every request.
+    """
+
+    settings = dict(SNAPSHOT_SETTINGS)
+    link = str(tmp_path / "current.sqlite")
+    publish(link, fresh_db)
+    lux_snapshot.configure(path=link, check_interval=0.0, retire_after=0.0)
+    yield link
+    lux_snapshot.configure(**settings)
+
+
+def test_new_snapshot_is_prepared_then_served(fresh_db, snapshot_link, tmp_path):
+    old_file = os.path.realpath(fresh_db)
+    assert current_database() == old_file
+    lux_query = LuxQuery(old_file, "sql")
+    lux_query.search_results(label="vase")
+    lux_query.fetch_page(label="vase", page_size=10)
+    lux_query.facet_counts(label="vase", size=3)
+
+    new_file = str(tmp_path / "lux-new.sqlite")
+    shutil.copyfile(fresh_db, new_file)
+    with closing(connect(new_file)) as connection, connection:
+        connection.execute("INSERT INTO objects (id, label) VALUES (999999, 'Zqx vase')")
+    publish(snapshot_link, new_file)
+
+    # requests read the old snapshot until the new one is ready
+    wait_for(lambda: current_database() == new_file)
+    stats = snapshot_stats()
+    assert (stats["switches"], stats["failures"], stats["last_warmed"]) == (1, 0, 3)
+    assert os.path.isfile(index_path(new_file))
+
+    # the searches of the old snapshot were rerun on the new one
+    lux_query = LuxQuery(new_file, "sql")
+    hits = get_cache(new_file).stats()["hits"]
+    results = lux_query.search_results(label="vase")
+    assert get_cache(new_file).stats()["hits"] == hits + 1
+    assert results["data"] == baseline_search(new_file, "", "", "", "vase")
+    assert 999999 in [row[0] for row in results["data"]]
+
+    # the old snapshot is retired at the next check
+    current_database()
+    assert old_file not in cache_stats()["search"]
+    assert snapshot_stats()["retired"] == 1
+
+
+def test_unreadable_snapshot_is_not_served(fresh_db, snapshot_link, tmp_path):
+    assert current_database() == os.path.realpath(fresh_db)
+    broken_file = str(tmp_path / "broken.sqlite")
+    with open(broken_file, "wb") as broken:
+        broken.write(b"not a database")
+    publish(snapshot_link, broken_file)
+    current_database()
+    wait_for(lambda: snapshot_stats()["failures"] == 1)
+    assert current_database() == os.path.realpath(fresh_db)
+
+
+def test_unexpected_error_is_a_failed_switch(fresh_db, snapshot_link, tmp_path, monkeypatch):
+    assert current_database() == os.path.realpath(fresh_db)
+
+    def prepare(db_file, old_file):
+        raise ValueError(f"{db_file} {old_file}")
+
+    monkeypatch.setattr(lux_snapshot, "prepare", prepare)
+    new_file = str(tmp_path / "lux-new.sqlite")
+    shutil.copyfile(fresh_db, new_file)
+    publish(snapshot_link, new_file)
+    current_database()
+    wait_for(lambda: snapshot_stats()["failures"] == 1)
+    # the snapshot is not left preparing, and the old one is still served
+    assert lux_snapshot._state["preparing"] is None  # pylint: disable=protected-access
+    assert current_database() == os.path.realpath(fresh_db)
+
+
+def test_failed_warm_entry_does_not_block_switch(fresh_db, snapshot_link, tmp_path):
+    old_file = os.path.realpath(fresh_db)
+    assert current_database() == old_file
+    lux_query = LuxQuery(old_file, "sql")
+    lux_query.search_results(label="vase")
+    # a page whose token the new snapshot cannot read
+    get_cache(old_file, "pages").put(("vase", "", "", "", lux_query.sort_order("", ""),
+                                      10, "garbage"), database_version(old_file), ((), None))
+
+    new_file = str(tmp_path / "lux-new.sqlite")
+    shutil.copyfile(fresh_db, new_file)
+    publish(snapshot_link, new_file)
+    current_database()
+    wait_for(lambda: current_database() == new_file)
+    stats = snapshot_stats()
+    assert (stats["switches"], stats["failures"], stats["last_warmed"]) == (1, 0, 1)
+
+
+def test_route_reads_new_snapshot(client, fresh_db, tmp_path):
+    settings = dict(SNAPSHOT_SETTINGS)
+    link = str(tmp_path / "current.sqlite")
+    publish(link, fresh_db)
+    lux_snapshot.configure(path=link, check_interval=0.0)
+    try:
+        assert current_database() == os.path.realpath(fresh_db)
+        assert client.get("/api/search", query_string={"l": "zqx"}).get_json()[
+            "search_count"] == 0
+        new_file = str(tmp_path / "lux-new.sqlite")
+        shutil.copyfile(fresh_db, new_file)
+        with closing(connect(new_file)) as connection, connection:
+            connection.execute("INSERT INTO objects (id, label) VALUES (999999, 'Zqx')")
+        publish(link, new_file)
+        current_database()
+        wait_for(lambda: current_database() == new_file)
+        response = client.get("/api/search", query_string={"l": "zqx"})
+        assert [row[0] for row in response.get_json()["data"]] == [999999]
+    finally:
+        lux_snapshot.configure(**settings)